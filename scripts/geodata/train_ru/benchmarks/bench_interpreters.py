@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+'''
+Records/sec of the converters on different Python interpreters.
+
+Every converter is run end to end over the same synthetic input in a fresh
+process of each interpreter, and the digest of its output files is compared
+to the first interpreter's, so a faster interpreter only counts if it writes
+the same training data:
+
+    python -m geodata.train_ru.benchmarks.bench_interpreters -n 200000 --python python2.7,python3,pypy3
+
+The registry converter is deterministic. The training data converters are
+run with --seed, and random.choice and friends draw differently on Python 2
+and Python 3, so their digests only match between interpreters of the same
+major version.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from geodata.train_ru.benchmarks.fixtures import write_healthcare_tsv, write_license_xml, write_osm_xml
+
+OSM = 'osm'
+TSV = 'tsv'
+REGISTRY = 'registry'
+
+CONVERTERS = (REGISTRY, TSV, OSM)
+
+FIXTURES = {
+    OSM: ('.osm', write_osm_xml),
+    TSV: ('.tsv', write_healthcare_tsv),
+    REGISTRY: ('.xml', write_license_xml),
+}
+
+QUIET_METRICS = {'interval': 0}
+
+
+def output_digest(out_dir):
+    digest = hashlib.md5()
+    for name in sorted(os.listdir(out_dir)):
+        digest.update(name.encode('utf-8'))
+        with open(os.path.join(out_dir, name), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def run_converter(converter, path, out_dir, seed):
+    if converter == REGISTRY:
+        from geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_to_csv import HealthcareLicensesRUFormatter
+        build = lambda: HealthcareLicensesRUFormatter().build_prepare_csv_data(path, out_dir, metrics_options=QUIET_METRICS)
+    elif converter == TSV:
+        from geodata.train_ru.tsv_to_training_data import HealthcareLicensesRUFormatter
+        build = lambda: HealthcareLicensesRUFormatter().build_training_data(path, out_dir, seed=seed, metrics_options=QUIET_METRICS)
+    else:
+        from geodata.train_ru.osm_to_training_data import OSMAddressRUFormatter
+        build = lambda: OSMAddressRUFormatter().build_training_data(path, out_dir, seed=seed, metrics_options=QUIET_METRICS)
+
+    start = time.time()
+    build()
+    return time.time() - start
+
+
+def measure(converter, path, records, seed):
+    '''
+    Runs converter in this process and returns its timing and output digest
+    '''
+    out_dir = tempfile.mkdtemp()
+    try:
+        seconds = run_converter(converter, path, out_dir, seed)
+        return {
+            'interpreter': '{} {}'.format(platform.python_implementation(), platform.python_version()),
+            'converter': converter,
+            'records': records,
+            'seconds': seconds,
+            'records_per_sec': records / seconds if seconds else 0.0,
+            'digest': output_digest(out_dir),
+        }
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def run_interpreter(python, converter, path, records, seed):
+    output = subprocess.check_output([python, '-m', 'geodata.train_ru.benchmarks.bench_interpreters',
+                                      '--run', converter, '--input', path,
+                                      '-n', str(records), '--seed', str(seed)])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converter throughput and output on different Python interpreters')
+
+    parser.add_argument('-n', '--records',
+                        type=int,
+                        default=100000,
+                        help='Number of synthetic input records')
+
+    parser.add_argument('--python',
+                        default=sys.executable,
+                        help='Comma separated interpreters to compare, the first one is the baseline')
+
+    parser.add_argument('--converters',
+                        default=','.join(CONVERTERS),
+                        help='Comma separated converters to run ({})'.format(', '.join(CONVERTERS)))
+
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='Runs per interpreter, the fastest one is reported (the first run of PyPy warms up)')
+
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Seed of the training data converters')
+
+    parser.add_argument('--run',
+                        choices=CONVERTERS,
+                        help='Run a converter over --input in the current process and print JSON')
+
+    parser.add_argument('--input')
+
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(measure(args.run, args.input, args.records, args.seed)))
+        sys.exit(0)
+
+    pythons = args.python.split(',')
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for converter in args.converters.split(','):
+            suffix, write_fixture = FIXTURES[converter]
+            path = os.path.join(tmp_dir, converter + suffix)
+            write_fixture(path, args.records)
+
+            baseline = None
+            for python in pythons:
+                results = [run_interpreter(python, converter, path, args.records, args.seed) for i in range(args.repeat)]
+                result = max(results, key=lambda r: r['records_per_sec'])
+                if baseline is None:
+                    baseline = result
+
+                line = '{converter} on {interpreter}: {records_per_sec:.0f} records/sec'.format(**result)
+                if result is not baseline:
+                    line += ', {:.2f}x'.format(result['records_per_sec'] / baseline['records_per_sec'])
+                    line += ', same output' if result['digest'] == baseline['digest'] else ', DIFFERENT output'
+                print(line)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from geodata.train_ru.benchmarks.fixtures import write_license_xml
+from geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_reader import license_xml_gz_reader
+
+MODES = ('events', 'streaming')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def read_all(path, mode):
+    start = time.time()
+    n = 0
+    for record in license_xml_gz_reader(path, streaming=mode == 'streaming'):
+        n += 1
+    seconds = time.time() - start
+    return {
+        'mode': mode,
+        'records': n,
+        'seconds': seconds,
+        'records_per_sec': n / seconds if seconds else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_mode(path, mode):
+    # every mode runs in a fresh interpreter so peak RSS is not shared
+    output = subprocess.check_output([sys.executable, '-m', 'geodata.train_ru.benchmarks.bench_reader',
+                                      '--read', path, '--mode', mode])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory and throughput of the registry XML reader modes')
+
+    parser.add_argument('-n', '--records',
+                        type=int,
+                        default=2000000,
+                        help='Number of synthetic address_place records')
+
+    parser.add_argument('-z', '--gzip',
+                        action='store_true',
+                        default=False,
+                        help='Compress the synthetic XML')
+
+    parser.add_argument('--modes',
+                        default=','.join(MODES),
+                        help='Comma separated reader modes to run')
+
+    parser.add_argument('--read',
+                        help='Read an existing XML file in the current process and print JSON')
+
+    parser.add_argument('--mode',
+                        choices=MODES,
+                        default='streaming')
+
+    args = parser.parse_args()
+
+    if args.read:
+        print(json.dumps(read_all(args.read, args.mode)))
+        sys.exit(0)
+
+    fd, path = tempfile.mkstemp(suffix='.xml.gz' if args.gzip else '.xml')
+    os.close(fd)
+    try:
+        write_license_xml(path, args.records, compress=args.gzip)
+        print('file: {:.1f} MB, {} records'.format(os.path.getsize(path) / 1048576.0, args.records))
+        for mode in args.modes.split(','):
+            result = run_mode(path, mode)
+            print('{mode}: {records} records, {records_per_sec:.0f} records/sec, peak RSS {peak_rss_mb:.1f} MB'.format(**result))
+    finally:
+        os.remove(path)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from geodata.train_ru.benchmarks.fixtures import write_license_xml
+from geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_reader import license_xml_gz_reader
+from geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_to_csv import HealthcareLicensesRUFormatter
+
+MODES = ('dicts', 'records')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def gc_collections():
+    if not hasattr(gc, 'get_stats'):
+        return None
+    return sum(generation['collections'] for generation in gc.get_stats())
+
+
+def normalize_all(path, mode):
+    '''
+    Reads, normalizes and expands every record, holding on to the normalized
+    components like a backlog of full pipeline queues would
+    '''
+    formatter = HealthcareLicensesRUFormatter()
+    formatter.use_records = mode == 'records'
+    header_indices = formatter.header_indices()
+
+    held = []
+    collections = gc_collections()
+    baseline_rss = peak_rss_mb()
+    start = time.time()
+    for row in license_xml_gz_reader(path, records=formatter.use_records):
+        components = formatter.normalized_components(row, header_indices)
+        if components is None:
+            continue
+        held.append(components)
+        formatter.expanded_components(components)
+    seconds = time.time() - start
+
+    n = len(held)
+    rss = peak_rss_mb()
+    return {
+        'mode': mode,
+        'records': n,
+        'seconds': seconds,
+        'records_per_sec': n / seconds if seconds else 0.0,
+        'peak_rss_mb': rss,
+        'bytes_per_record': (rss - baseline_rss) * 1048576.0 / n if n else 0.0,
+        'gc_collections': gc_collections() - collections if collections is not None else None,
+    }
+
+
+def run_mode(path, mode):
+    # every mode runs in a fresh interpreter so peak RSS is not shared
+    output = subprocess.check_output([sys.executable, '-m', 'geodata.train_ru.benchmarks.bench_records',
+                                      '--read', path, '--mode', mode])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory and GC pressure of dict and slotted records on the registry path')
+
+    parser.add_argument('-n', '--records',
+                        type=int,
+                        default=2000000,
+                        help='Number of synthetic address_place records')
+
+    parser.add_argument('--modes',
+                        default=','.join(MODES),
+                        help='Comma separated record modes to run')
+
+    parser.add_argument('--read',
+                        help='Normalize an existing XML file in the current process and print JSON')
+
+    parser.add_argument('--mode',
+                        choices=MODES,
+                        default='records')
+
+    args = parser.parse_args()
+
+    if args.read:
+        print(json.dumps(normalize_all(args.read, args.mode)))
+        sys.exit(0)
+
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    os.close(fd)
+    try:
+        write_license_xml(path, args.records)
+        print('file: {:.1f} MB, {} records'.format(os.path.getsize(path) / 1048576.0, args.records))
+        for mode in args.modes.split(','):
+            result = run_mode(path, mode)
+            line = '{mode}: {records} records, {records_per_sec:.0f} records/sec, peak RSS {peak_rss_mb:.1f} MB, ' \
+                   '{bytes_per_record:.0f} bytes/record'.format(**result)
+            if result['gc_collections'] is not None:
+                line += ', {} GC collections'.format(result['gc_collections'])
+            print(line)
+    finally:
+        os.remove(path)
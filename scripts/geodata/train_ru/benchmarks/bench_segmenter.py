@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import time
+
+from geodata.train_ru.benchmarks.fixtures import license_components
+from geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_to_csv import HealthcareLicensesRUFormatter
+
+
+def expand_all(formatter, records, use_segmenter):
+    formatter.use_segmenter = use_segmenter
+    start = time.time()
+    columns = [formatter.expanded_components(dict(components)) for components in records]
+    return columns, time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the composite street segmenter with the try_move_* chain')
+
+    parser.add_argument('-n', '--records',
+                        type=int,
+                        default=200000,
+                        help='Number of synthetic records')
+
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Seed for the synthetic records')
+
+    args = parser.parse_args()
+
+    formatter = HealthcareLicensesRUFormatter()
+    records = list(license_components(args.records, seed=args.seed))
+
+    legacy_columns, legacy_seconds = expand_all(formatter, records, False)
+    columns, seconds = expand_all(formatter, records, True)
+
+    mismatches = sum(1 for a, b in zip(legacy_columns, columns) if a != b)
+
+    print('records: {}'.format(len(records)))
+    print('try_move_* chain: {:.0f} records/sec'.format(len(records) / legacy_seconds))
+    print('segmenter: {:.0f} records/sec'.format(len(records) / seconds))
+    print('speedup: {:.2f}x'.format(legacy_seconds / seconds))
+    print('mismatched rows: {}'.format(mismatches))
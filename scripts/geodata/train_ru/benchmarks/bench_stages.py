@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+'''
+Throughput and memory of every converter stage on synthetic inputs.
+
+Each converter runs parse -> normalize -> expand -> format -> write one stage
+at a time over the whole fixture, so every stage is timed on its own. A second
+pass repeats the stages under tracemalloc to get the peak memory each stage
+allocates (tracemalloc slows Python down, so it is kept out of the timings).
+The RNG is reseeded before every pass so two runs format the same addresses.
+
+    python -m geodata.train_ru.benchmarks.bench_stages -n 20000 -o before.json
+    python -m geodata.train_ru.benchmarks.bench_stages -n 20000 -o after.json
+    python -m geodata.train_ru.benchmarks.bench_stages --compare before.json after.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from geodata.train_ru.benchmarks.fixtures import write_healthcare_tsv, write_license_xml, write_osm_xml
+
+PARSE = 'parse'
+NORMALIZE = 'normalize'
+EXPAND = 'expand'
+FORMAT = 'format'
+WRITE = 'write'
+
+STAGES = (PARSE, NORMALIZE, EXPAND, FORMAT, WRITE)
+
+OSM = 'osm'
+TSV = 'tsv'
+REGISTRY = 'registry'
+
+CONVERTERS = (OSM, TSV, REGISTRY)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def mapped(func, drop_empty=True):
+    def stage(values):
+        results = (func(value) for value in values)
+        if drop_empty:
+            return [r for r in results if r]
+        return list(results)
+    return stage
+
+
+def written(sink_factory, rows_func):
+    def stage(values):
+        with sink_factory() as sink:
+            for value in values:
+                sink(rows_func(value))
+        return [sink.rows]
+    return stage
+
+
+def osm_stages(path, out_dir):
+    from geodata.osm.extract import parse_osm
+    from geodata.train_ru.osm_to_training_data import OSMAddressRUFormatter
+    from geodata.train_ru.sinks import TSVSink
+
+    formatter = OSMAddressRUFormatter()
+
+    def formatted(expanded):
+        address_components, country, language = expanded
+        return formatter.formatted_expanded_addresses(expanded), country, language
+
+    return [
+        (PARSE, lambda values: [value for node_id, value, deps in parse_osm(path)]),
+        (NORMALIZE, mapped(formatter.normalized_components, drop_empty=False)),
+        (EXPAND, mapped(formatter.expanded_components)),
+        (FORMAT, mapped(formatted, drop_empty=False)),
+        (WRITE, written(lambda: TSVSink(os.path.join(out_dir, 'osm.tsv')),
+                        lambda value: formatter.address_rows(*value))),
+    ]
+
+
+def tsv_stages(path, out_dir):
+    from geodata.train_ru.tsv_to_training_data import HealthcareLicensesRUFormatter
+    from geodata.train_ru.sinks import TSVSink
+
+    formatter = HealthcareLicensesRUFormatter()
+    header_indices = {}
+
+    def parse(values):
+        reader, indices = formatter.open_reader(path)
+        header_indices.update(indices)
+        return list(reader)
+
+    return [
+        (PARSE, parse),
+        (NORMALIZE, mapped(lambda row: formatter.normalized_components(row, header_indices))),
+        (EXPAND, mapped(formatter.expanded_components)),
+        (FORMAT, mapped(formatter.formatted_expanded_addresses, drop_empty=False)),
+        (WRITE, written(lambda: TSVSink(os.path.join(out_dir, 'tsv.tsv')), formatter.address_rows)),
+    ]
+
+
+def registry_stages(path, out_dir):
+    from geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_to_csv import HealthcareLicensesRUFormatter
+    from geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_reader import license_xml_gz_reader
+    from geodata.train_ru.sinks import TSVSink
+
+    formatter = HealthcareLicensesRUFormatter()
+    header_indices = formatter.header_indices()
+
+    return [
+        (PARSE, lambda values: list(license_xml_gz_reader(path))),
+        (NORMALIZE, mapped(lambda row: formatter.normalized_components(row, header_indices))),
+        (EXPAND, mapped(formatter.expanded_components)),
+        (FORMAT, mapped(formatter.formatted_columns, drop_empty=False)),
+        (WRITE, written(lambda: TSVSink(os.path.join(out_dir, 'registry.tsv')), lambda row: [row])),
+    ]
+
+
+FIXTURES = OrderedDict([
+    (OSM, ('.osm', write_osm_xml, osm_stages)),
+    (TSV, ('.tsv', write_healthcare_tsv, tsv_stages)),
+    (REGISTRY, ('.xml', write_license_xml, registry_stages)),
+])
+
+
+def run_stages(stages, seed, trace_memory=False):
+    random.seed(seed)
+
+    results = OrderedDict()
+    values = []
+    for name, stage in stages:
+        records = len(values)
+
+        if trace_memory:
+            tracemalloc.start()
+        start = time.time()
+        values = stage(values)
+        seconds = time.time() - start
+
+        result = OrderedDict()
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result['peak_alloc_mb'] = peak / 1048576.0
+        else:
+            # parse has no input records, rate it by what it read
+            if name == PARSE:
+                records = len(values)
+            result['records'] = records
+            result['seconds'] = seconds
+            result['records_per_sec'] = records / seconds if seconds else 0.0
+        results[name] = result
+
+    return results
+
+
+def run_converter(converter, n, seed, work_dir, trace_memory=True):
+    suffix, write_fixture, build_stages = FIXTURES[converter]
+    path = os.path.join(work_dir, converter + suffix)
+    write_fixture(path, n, seed=seed)
+
+    results = run_stages(build_stages(path, work_dir), seed)
+    if trace_memory and tracemalloc is not None:
+        for name, memory in run_stages(build_stages(path, work_dir), seed, trace_memory=True).items():
+            results[name].update(memory)
+
+    for result in results.values():
+        result.setdefault('peak_alloc_mb', None)
+
+    return OrderedDict([
+        ('input_mb', os.path.getsize(path) / 1048576.0),
+        ('stages', results),
+        ('peak_rss_mb', peak_rss_mb()),
+    ])
+
+
+def run(converters, n, seed, trace_memory=True):
+    os.environ.setdefault('TEMP', tempfile.gettempdir())
+
+    report = OrderedDict([
+        ('created', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', '{} {}'.format(platform.python_implementation(), platform.python_version())),
+        ('machine', platform.machine()),
+        ('records', n),
+        ('seed', seed),
+        ('converters', OrderedDict()),
+    ])
+
+    work_dir = tempfile.mkdtemp(prefix='train_ru_bench_')
+    try:
+        for converter in converters:
+            report['converters'][converter] = run_converter(converter, n, seed, work_dir, trace_memory=trace_memory)
+    finally:
+        shutil.rmtree(work_dir)
+
+    return report
+
+
+def print_report(report):
+    print('{python}, {records} records, seed {seed}'.format(**report))
+    for converter, result in report['converters'].items():
+        print('{} ({:.1f} MB input, peak RSS {:.1f} MB)'.format(converter, result['input_mb'], result['peak_rss_mb']))
+        for name, stage in result['stages'].items():
+            memory = stage['peak_alloc_mb']
+            print('  {:<10} {:>10.0f} records/sec {:>10}'.format(
+                name, stage['records_per_sec'], '{:.1f} MB'.format(memory) if memory is not None else '-'))
+
+
+def print_comparison(before, after):
+    print('before: {python}, {records} records, {created}'.format(**before))
+    print('after:  {python}, {records} records, {created}'.format(**after))
+    for converter, result in after['converters'].items():
+        base = before['converters'].get(converter)
+        if base is None:
+            continue
+        print(converter)
+        for name, stage in result['stages'].items():
+            base_stage = base['stages'].get(name)
+            if base_stage is None:
+                continue
+            speedup = stage['records_per_sec'] / base_stage['records_per_sec'] if base_stage['records_per_sec'] else 0.0
+            line = '  {:<10} {:>10.0f} -> {:>10.0f} records/sec ({:.2f}x)'.format(
+                name, base_stage['records_per_sec'], stage['records_per_sec'], speedup)
+            if stage['peak_alloc_mb'] is not None and base_stage['peak_alloc_mb'] is not None:
+                line += ', {:.1f} -> {:.1f} MB'.format(base_stage['peak_alloc_mb'], stage['peak_alloc_mb'])
+            print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Records/sec and peak memory per converter stage on synthetic data')
+
+    parser.add_argument('-n', '--records',
+                        type=int,
+                        default=20000,
+                        help='Number of synthetic records per converter')
+
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Seed for the fixtures and the formatters')
+
+    parser.add_argument('--converters',
+                        default=','.join(CONVERTERS),
+                        help='Comma separated converters to run: {}'.format(', '.join(CONVERTERS)))
+
+    parser.add_argument('--no-memory',
+                        action='store_true',
+                        default=False,
+                        help='Skip the tracemalloc pass')
+
+    parser.add_argument('-o', '--output',
+                        help='Save the results as JSON')
+
+    parser.add_argument('--compare',
+                        nargs=2,
+                        metavar=('BEFORE', 'AFTER'),
+                        help='Compare two saved results instead of running')
+
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        print_comparison(before, after)
+        sys.exit(0)
+
+    report = run(args.converters.split(','), args.records, args.seed, trace_memory=not args.no_memory)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import io
+import random
+
+from xml.sax.saxutils import escape
+
+REGIONS = [
+    u'Московская область',
+    u'г. Москва',
+    u'Ленинградская область',
+    u'Республика Татарстан',
+    u'Свердловская область',
+    u'Краснодарский край',
+    u'Новосибирская область',
+    u'Республика Башкортостан',
+]
+
+DISTRICTS = [
+    u'Одинцовский район',
+    u'Кировский район',
+    u'Мытищинский муниципальный район',
+    u'Зеленодольский р-н',
+    u'Нижнекамский с/с',
+]
+
+CITIES = [
+    u'г. Одинцово',
+    u'город Кировск',
+    u'пгт Васильево',
+    u'п.г.т. Кольцово',
+    u'с. Ивановское',
+    u'Казань',
+    u'Екатеринбург',
+]
+
+SUBURBS = [
+    u'мкр Северный',
+    u'микрорайон Южный',
+    u'Октябрьский р-н',
+    u'Ленинский р-он',
+    u'Советский район',
+]
+
+STREETS = [
+    u'ул. Ленина',
+    u'улица Мира',
+    u'пр-т Победы',
+    u'проспект Ленина',
+    u'Садовая ул.',
+    u'пер. Школьный',
+    u'шоссе Энтузиастов',
+    u'бульвар Гагарина',
+]
+
+HOUSE_NUMBERS = [u'1', u'5', u'12а', u'д. 7', u'дом 3', u'д.15, корп. 2', u'27/1', u'4, стр. 1']
+
+UNITS = [u'пом. 3', u'помещение 12', u'кв. 5', u'комната 2', u'этаж 1', u'к. 4', u'нп 1', u'Пом. II']
+
+POSTCODES = [u'0', u'101000', u'420111', u'630090', u'']
+
+OSM_STATES = [
+    u'Московская область',
+    u'Москва',
+    u'Татарстан',
+    u'Свердловская область',
+    u'Башкортостан',
+    u'Кемеровская область',
+]
+
+OSM_DISTRICTS = [u'Одинцовский район', u'Зеленодольский район', u'городской округ Мытищи']
+
+OSM_CITIES = [u'Одинцово', u'Мытищи', u'Казань', u'Екатеринбург', u'Уфа', u'Кемерово']
+
+OSM_CITY_STATUSES = [u'ru:город', u'ru:посёлок', u'ru:село']
+
+OSM_SUBURBS = [u'Северный', u'Южный', u'Вахитовский район', u'микрорайон Солнечный']
+
+OSM_STREETS = [
+    u'улица Ленина',
+    u'Садовая улица',
+    u'проспект Победы',
+    u'Школьный переулок',
+    u'шоссе Энтузиастов',
+    u'бульвар Гагарина',
+    u'1-я Парковая улица',
+    u'Малая Пионерская улица, 12',
+]
+
+OSM_HOUSE_NUMBERS = [u'1', u'5', u'12', u'12а', u'27/1', u'15 к2', u'4 с1', u'7Б']
+
+
+def composite_street(rnd):
+    parts = []
+    if rnd.random() < 0.2:
+        parts.append(rnd.choice(DISTRICTS))
+    if rnd.random() < 0.3:
+        parts.append(rnd.choice(CITIES))
+    if rnd.random() < 0.2:
+        parts.append(rnd.choice(SUBURBS))
+    parts.append(rnd.choice(STREETS))
+    if rnd.random() < 0.9:
+        parts.append(rnd.choice(HOUSE_NUMBERS))
+    if rnd.random() < 0.4:
+        parts.append(rnd.choice(UNITS))
+    if rnd.random() < 0.05:
+        parts.insert(rnd.randrange(len(parts) + 1), u' ')
+
+    separators = [u', ', u',', u' ,  ']
+    street = parts[0]
+    for part in parts[1:]:
+        street += rnd.choice(separators) + part
+    return street
+
+
+def license_components(n, seed=0):
+    '''
+    Normalized component dicts like the ones the registry CSV converter builds
+    from license_xml_gz_reader records.
+    '''
+    rnd = random.Random(seed)
+    for i in range(n):
+        components = {'state': rnd.choice(REGIONS), 'road': composite_street(rnd)}
+        postcode = rnd.choice(POSTCODES)
+        if postcode:
+            components['postcode'] = postcode
+        if rnd.random() < 0.3:
+            components['city'] = rnd.choice(CITIES)
+        yield components
+
+
+def osm_address_tags(n, seed=0):
+    '''
+    addr:* tag dicts like the ones parse_osm yields for Russian buildings.
+    '''
+    rnd = random.Random(seed)
+    for i in range(n):
+        tags = {
+            'addr:street': rnd.choice(OSM_STREETS),
+            'addr:housenumber': rnd.choice(OSM_HOUSE_NUMBERS),
+        }
+        if rnd.random() < 0.7:
+            tags['addr:city'] = rnd.choice(OSM_CITIES)
+            if rnd.random() < 0.3:
+                tags['addr:city_official_status'] = rnd.choice(OSM_CITY_STATUSES)
+        if rnd.random() < 0.6:
+            tags['addr:region'] = rnd.choice(OSM_STATES)
+        if rnd.random() < 0.3:
+            tags['addr:district'] = rnd.choice(OSM_DISTRICTS)
+        if rnd.random() < 0.2:
+            tags['addr:suburb'] = rnd.choice(OSM_SUBURBS)
+        postcode = rnd.choice(POSTCODES)
+        if postcode and postcode != u'0':
+            tags['addr:postcode'] = postcode
+        if rnd.random() < 0.1:
+            tags['building'] = u'yes'
+        yield tags
+
+
+OSM_XML_HEADER = u'''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="train_ru benchmarks">
+'''
+
+OSM_XML_FOOTER = u'''</osm>
+'''
+
+OSM_NODE_TEMPLATE = u'''  <node id="{id}" version="1" lat="{lat:.7f}" lon="{lon:.7f}">
+{tags}  </node>
+'''
+
+ATTRIBUTE_ENTITIES = {'"': '&quot;'}
+
+OSM_TAG_TEMPLATE = u'''    <tag k="{k}" v="{v}"/>
+'''
+
+
+def open_text(path, compress=False):
+    if compress:
+        return io.TextIOWrapper(gzip.open(path, 'wb'), encoding='utf-8')
+    return io.open(path, 'w', encoding='utf-8')
+
+
+def write_osm_xml(path, n, seed=0):
+    '''
+    Writes n tagged nodes as an OSM XML extract that parse_osm can read.
+    '''
+    rnd = random.Random(seed)
+    with open_text(path) as f:
+        f.write(OSM_XML_HEADER)
+        for i, tags in enumerate(osm_address_tags(n, seed=seed)):
+            f.write(OSM_NODE_TEMPLATE.format(
+                id=i + 1,
+                lat=rnd.uniform(43.0, 68.0),
+                lon=rnd.uniform(30.0, 60.0),
+                tags=u''.join(OSM_TAG_TEMPLATE.format(k=k, v=escape(v, ATTRIBUTE_ENTITIES)) for k, v in sorted(tags.items())),
+            ))
+        f.write(OSM_XML_FOOTER)
+    return n
+
+
+HEALTHCARE_TSV_FIELDS = ('index', 'region', 'district', 'city', 'suburb', 'street', 'house_number', 'level', 'unit')
+
+
+def healthcare_rows(n, seed=0):
+    '''
+    Rows in the column layout of the healthcare licenses TSV, with the empty
+    and placeholder values real exports contain.
+    '''
+    rnd = random.Random(seed)
+    for i in range(n):
+        yield (
+            rnd.choice(POSTCODES),
+            rnd.choice(REGIONS),
+            rnd.choice(DISTRICTS) if rnd.random() < 0.2 else u'',
+            rnd.choice(CITIES) if rnd.random() < 0.6 else u'',
+            rnd.choice(SUBURBS) if rnd.random() < 0.1 else u'',
+            rnd.choice(STREETS) if rnd.random() < 0.95 else u'-',
+            rnd.choice(HOUSE_NUMBERS) if rnd.random() < 0.9 else u'',
+            u'{}'.format(rnd.randint(1, 5)) if rnd.random() < 0.1 else u'',
+            rnd.choice(UNITS) if rnd.random() < 0.2 else u'',
+        )
+
+
+def write_healthcare_tsv(path, n, seed=0):
+    '''
+    Writes n rows with a header line, readable with the tsv_no_quote dialect.
+    '''
+    with open_text(path) as f:
+        f.write(u'\t'.join(HEALTHCARE_TSV_FIELDS) + u'\n')
+        for row in healthcare_rows(n, seed=seed):
+            f.write(u'\t'.join(row) + u'\n')
+    return n
+
+
+LICENSE_XML_HEADER = u'''<?xml version="1.0" encoding="utf-8"?>
+<licenses>
+'''
+
+LICENSE_XML_FOOTER = u'''</licenses>
+'''
+
+LICENSE_XML_TEMPLATE = u'''  <license>
+    <name>ООО "Клиника №{i}"</name>
+    <inn>{inn}</inn>
+    <number>ЛО-{i:08d}</number>
+    <work_address_list>
+{addresses}    </work_address_list>
+    <works>Работы (услуги) по терапии, педиатрии, стоматологии и рентгенологии</works>
+  </license>
+'''
+
+ADDRESS_PLACE_TEMPLATE = u'''      <address_place>
+        <index>{index}</index>
+        <region>{region}</region>
+        <city>{city}</city>
+        <street>{street}</street>
+      </address_place>
+'''
+
+
+def write_license_xml(path, n, seed=0, compress=False, addresses_per_license=2):
+    '''
+    Writes a synthetic registry dump with n address_place records in the layout
+    license_xml_gz_reader expects. Output is streamed, so n can be in the millions.
+    '''
+    rnd = random.Random(seed)
+    with open_text(path, compress=compress) as f:
+        f.write(LICENSE_XML_HEADER)
+        written = 0
+        i = 0
+        while written < n:
+            addresses = []
+            for j in range(min(rnd.randint(1, addresses_per_license * 2 - 1), n - written)):
+                addresses.append(ADDRESS_PLACE_TEMPLATE.format(
+                    index=rnd.choice(POSTCODES) or u'0',
+                    region=escape(rnd.choice(REGIONS)),
+                    city=escape(rnd.choice(CITIES)) if rnd.random() < 0.5 else u'',
+                    street=escape(composite_street(rnd)),
+                ))
+            written += len(addresses)
+            f.write(LICENSE_XML_TEMPLATE.format(i=i, inn=rnd.randint(10 ** 9, 10 ** 10 - 1),
+                                                addresses=u''.join(addresses)))
+            i += 1
+        f.write(LICENSE_XML_FOOTER)
+    return written
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from collections import OrderedDict
+
+DEFAULT_MAX_SIZE = 100000
+
+_missing = object()
+
+
+class LRUCache(object):
+    '''
+    Bounded least-recently-used mapping with hit/miss counters. Safe to share
+    between the threads of a pipeline stage.
+    '''
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.data.pop(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def get_or_compute(self, key, func, *args):
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = func(*args)
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def stats(self):
+        with self.lock:
+            size, hits, misses = len(self.data), self.hits, self.misses
+        lookups = hits + misses
+        return OrderedDict([
+            ('size', size),
+            ('max_size', self.max_size),
+            ('hits', hits),
+            ('misses', misses),
+            ('hit_rate', float(hits) / lookups if lookups else 0.0),
+        ])
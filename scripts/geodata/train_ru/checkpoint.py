@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+'''
+Checkpoints for long training data builds.
+
+A checkpoint records how many input records have been completely written,
+the size of the output file at that point and the state of the random
+module. It is written next to the output as <output>.checkpoint, through a
+temporary file and a rename, so it is never seen half written. --resume
+truncates the output back to the recorded size and skips the records that
+were already done.
+
+The input position is a record count: parse_osm, unicode_csv_reader and
+license_xml_gz_reader have no stable byte offsets, so resuming re-reads the
+skipped records but does not normalize or format them again.
+
+With --seed the RNG is reseeded per batch and checkpoints are only taken on
+batch boundaries, so a resumed build writes exactly what an uninterrupted one
+would. Without a seed the RNG state is restored, which reproduces the run in
+serial mode, while with --pipeline the stages draw ahead of the writer and the
+rest of the output is only statistically the same.
+'''
+
+import itertools
+import json
+import os
+import random
+
+from collections import OrderedDict
+
+DEFAULT_CHECKPOINT_INTERVAL = 100000
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def checkpoint_path(output_path):
+    return output_path + CHECKPOINT_SUFFIX
+
+
+def write_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def rng_state():
+    version, internal, gauss_next = random.getstate()
+    return [version, list(internal), gauss_next]
+
+
+def set_rng_state(state):
+    version, internal, gauss_next = state
+    random.setstate((version, tuple(internal), gauss_next))
+
+
+def load_checkpoint(output_path):
+    path = checkpoint_path(output_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def skip_records(records, n):
+    if not n:
+        return records
+    return itertools.islice(records, n, None)
+
+
+class Checkpointer(object):
+    '''
+    Pipeline progress callback that saves a checkpoint every `every` records.
+    The sink must have sync(), tell() and a rows counter, like TSVSink.
+
+    params identify the run (input, seed, batch size, ...) and must match
+    when resuming.
+    '''
+
+    def __init__(self, sink, every=DEFAULT_CHECKPOINT_INTERVAL, params=None, batch_size=None):
+        if batch_size:
+            # round up so checkpoints fall on the batch boundaries of seeded runs
+            every = -(-every // batch_size) * batch_size
+        self.sink = sink
+        self.path = checkpoint_path(sink.path)
+        self.every = max(int(every), 1)
+        self.params = OrderedDict(sorted((params or {}).items()))
+        self.skipped = 0
+        self.records = 0
+
+    def resume(self):
+        '''
+        Loads the checkpoint for the sink's output, truncates the output to the
+        checkpointed size and restores the RNG. Returns the number of input
+        records to skip, 0 when there is no checkpoint.
+        '''
+        checkpoint = load_checkpoint(self.sink.path)
+        if checkpoint is None:
+            self.sink.truncate(0)
+            return 0
+
+        params = checkpoint.get('params', {})
+        if params != self.params:
+            raise CheckpointError('{} was written with {}, not {}'.format(self.path, params, dict(self.params)))
+
+        self.sink.truncate(checkpoint['output_size'])
+        self.sink.rows = checkpoint['rows']
+        set_rng_state(checkpoint['rng_state'])
+        self.skipped = self.records = checkpoint['records']
+        return self.skipped
+
+    def __call__(self, records):
+        # the pipeline counts from the first record after the skipped ones
+        records += self.skipped
+        self.records = records
+        if records % self.every == 0:
+            self.save()
+
+    def save(self):
+        self.sink.sync()
+
+        checkpoint = OrderedDict([
+            ('records', self.records),
+            ('rows', self.sink.rows),
+            ('output_size', self.sink.tell()),
+            ('params', self.params),
+            ('rng_state', rng_state()),
+        ])
+        write_atomic(self.path, json.dumps(checkpoint))
+
+    def finish(self):
+        '''
+        Removes the checkpoint once the output is complete
+        '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def resumable(sink, checkpoint=False, resume=False, every=DEFAULT_CHECKPOINT_INTERVAL, params=None, batch_size=None):
+    '''
+    Returns (checkpointer, number of input records to skip), or (None, 0)
+    when neither checkpoints nor resuming were asked for.
+    '''
+    if not (checkpoint or resume):
+        return None, 0
+    if not hasattr(sink, 'truncate'):
+        raise ValueError('Checkpoints need a plain, uncompressed and unsharded output file')
+
+    checkpointer = Checkpointer(sink, every=every, params=params, batch_size=batch_size)
+    skip = checkpointer.resume() if resume else 0
+    if skip:
+        print('resuming after {} records, {} rows'.format(skip, sink.rows))
+    return checkpointer, skip
+
+
+def checkpoint_every(args):
+    '''
+    The checkpoint interval of the command line, None without --checkpoint
+    or --resume
+    '''
+    if args.checkpoint or args.resume:
+        return args.checkpoint_every
+    return None
+
+
+def add_arguments(parser):
+    parser.add_argument('--checkpoint',
+                        action='store_true',
+                        default=False,
+                        help='Periodically save the input position, RNG state and output size')
+
+    parser.add_argument('--checkpoint-every',
+                        type=int,
+                        default=DEFAULT_CHECKPOINT_INTERVAL,
+                        help='Input records between two checkpoints')
+
+    parser.add_argument('--resume',
+                        action='store_true',
+                        default=False,
+                        help='Continue from the last checkpoint of the output file, implies --checkpoint')
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+'''
+Dictionary-encoded column batches.
+
+Columns like region, district, city and suburb of the healthcare TSV have a
+few thousand distinct values over millions of rows, and cleaning a cell
+(regexes, strip, validators, encoding fix) only depends on its column and
+value. With --column-batch N the normalize stage takes N rows at a time,
+dictionary-encodes every column, cleans each distinct value of a column once
+and maps the results back to the rows by code. Rows sharing a value then also
+share the cleaned string.
+
+Only the deterministic steps are batched. The dropout, abbreviations and
+hyphenation draw random numbers and still run once per row in row order, so
+the output is the same as without batching, for any --seed.
+'''
+
+DEFAULT_COLUMN_BATCH = 0
+
+
+class ColumnBatch(object):
+    '''
+    A chunk of rows with the given columns dictionary-encoded. values[i]
+    lists the distinct values of column i, codes[i] the code of every row's
+    value. Missing rows (None) get the value None.
+    '''
+
+    def __init__(self, rows, columns):
+        self.size = len(rows)
+        self.values = {}
+        self.codes = {}
+
+        for i in columns:
+            index = {}
+            values = []
+            codes = []
+            for row in rows:
+                value = row[i] if row is not None else None
+                code = index.get(value)
+                if code is None:
+                    code = index[value] = len(values)
+                    values.append(value)
+                codes.append(code)
+            self.values[i] = values
+            self.codes[i] = codes
+
+    def distinct(self):
+        return sum(len(values) for values in self.values.values())
+
+    def mapped(self, i, func):
+        '''
+        func applied once per distinct value of column i, as a list with the
+        result for every row
+        '''
+        results = [func(value) for value in self.values[i]]
+        return [results[code] for code in self.codes[i]]
+
+
+def batched(func, items, size):
+    '''
+    Calls func with lists of up to size items and yields the results it
+    returns, one per item
+    '''
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            for result in func(chunk):
+                yield result
+            chunk = []
+
+    if chunk:
+        for result in func(chunk):
+            yield result
+
+
+def add_arguments(parser):
+    parser.add_argument('--column-batch',
+                        type=int,
+                        default=DEFAULT_COLUMN_BATCH,
+                        metavar='N',
+                        help='Normalize N rows at a time, cleaning every distinct value of a column once (0 = per row)')
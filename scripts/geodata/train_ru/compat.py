@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+'''
+File handling that differs between Python 2 and Python 3 (CPython or PyPy).
+
+The csv module reads and writes byte strings on Python 2 and text on
+Python 3, so TSV files are opened in binary mode on 2 and as UTF-8 text with
+newline='' on 3. Cells coming from the geodata helpers can still be UTF-8
+bytes on 3 (tsv_string encodes), which csv would write as b'...', so rows
+pass through native_row before they are written.
+'''
+
+import csv
+import io
+
+import six
+
+# registers the tsv_no_quote dialect
+from geodata.csv_utils import unicode_csv_reader
+
+
+def open_tsv(path, mode='r'):
+    '''
+    Opens path for csv.reader (mode 'r') or csv.writer (mode 'w' or 'a')
+    '''
+    if six.PY2:
+        return open(path, mode + 'b')
+    return io.open(path, mode, encoding='utf-8', newline='')
+
+
+def tsv_reader(f, dialect='tsv_no_quote'):
+    '''
+    Reader of a file from open_tsv, yielding rows of unicode cells
+    '''
+    if six.PY2:
+        return unicode_csv_reader(f, dialect=dialect)
+    return csv.reader(f, dialect=dialect)
+
+
+def text_buffer():
+    '''
+    In-memory file for a csv.writer, its value is encoded to UTF-8 on write
+    '''
+    return six.BytesIO() if six.PY2 else io.StringIO()
+
+
+if six.PY2:
+    def native_row(row):
+        return row
+else:
+    def native_row(row):
+        return [value.decode('utf-8') if isinstance(value, bytes) else value for value in row]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import re
+import threading
+
+from collections import OrderedDict
+
+import ftfy
+import six
+
+from geodata.encoding import safe_decode
+from geodata.train_ru.cache import LRUCache
+from geodata.train_ru.records import Record
+
+DEFAULT_MEMO_SIZE = 20000
+
+# Columns with few distinct values repeated on most records
+MEMO_FIELDS = ('state', 'state_district', 'region', 'city', 'city_district', 'suburb')
+
+# Mojibake of UTF-8 always contains the decoding of a continuation byte
+# (0x80-0xBF). In the charsets ftfy tries none of those is ASCII or one of
+# А-я (cp1251 puts Ё and ё there, so they are not in the class), so text made
+# of these characters alone is returned unchanged by ftfy.fix_encoding.
+clean_text_regex = re.compile(u'^[\x00-\x7fА-я]*$', re.UNICODE)
+
+
+class EncodingFixer(object):
+    '''
+    Runs ftfy.fix_encoding only on values that can be mojibake, and memoizes
+    the result for the high-repeat columns. Safe to share between the threads
+    of a pipeline stage.
+    '''
+
+    def __init__(self, memo_fields=MEMO_FIELDS, memo_size=DEFAULT_MEMO_SIZE):
+        self.memo_fields = frozenset(memo_fields)
+        self.memo = LRUCache(memo_size)
+        self.lock = threading.Lock()
+        self.values = 0
+        self.skipped = 0
+        self.ftfy_calls = 0
+
+    def fix_text(self, value):
+        with self.lock:
+            self.ftfy_calls += 1
+        return ftfy.fix_encoding(value)
+
+    def fix(self, value, key=None):
+        value = safe_decode(value)
+        clean = clean_text_regex.match(value)
+        with self.lock:
+            self.values += 1
+            if clean:
+                self.skipped += 1
+        if clean:
+            return value
+        if key in self.memo_fields:
+            return self.memo.get_or_compute(value, self.fix_text, value)
+        return self.fix_text(value)
+
+    def fix_components(self, components):
+        if isinstance(components, Record):
+            # records are fixed in place instead of copied
+            for k, v in components.items():
+                setattr(components, k, self.fix(v, k))
+            return components
+        return {k: self.fix(v, k) for k, v in six.iteritems(components)}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def stats(self):
+        with self.lock:
+            values, skipped, ftfy_calls = self.values, self.skipped, self.ftfy_calls
+        return OrderedDict([
+            ('values', values),
+            ('skipped', skipped),
+            ('ftfy_calls', ftfy_calls),
+            ('ftfy_rate', float(ftfy_calls) / values if values else 0.0),
+            ('memo', self.memo.stats()),
+        ])
+
+
+encoding_fixer = EncodingFixer()
+
+
+def fix_component_encodings(components):
+    return encoding_fixer.fix_components(components)
+
+
+def fix_component_encoding(value, key=None):
+    return encoding_fixer.fix(value, key)
+
+
+def encoding_stats():
+    return encoding_fixer.stats()
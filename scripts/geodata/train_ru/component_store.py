@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+'''
+Length-prefixed binary file of normalized component records.
+
+Layout (little endian):
+
+    magic            8 bytes
+    record count     uint64, patched when the writer is closed
+    metadata size    uint32
+    metadata         JSON object, "fields" is the list of component names
+    records          uint32 payload size, then per component:
+                     uint8 field index, uint32 value size, UTF-8 value
+
+Writing it once with --ingest lets repeated builds skip reading, regex
+cleaning, validation and ftfy, and read the records straight from a
+memory-mapped file.
+'''
+
+import json
+import mmap
+import struct
+
+import six
+
+MAGIC = b'RUCOMPS1'
+
+HEADER = struct.Struct('<8sQI')
+COUNT = struct.Struct('<Q')
+RECORD_SIZE = struct.Struct('<I')
+FIELD = struct.Struct('<BI')
+
+MAX_FIELDS = 256
+
+
+class ComponentStoreError(Exception):
+    pass
+
+
+class ComponentStoreWriter(object):
+    def __init__(self, path, fields, metadata=None):
+        fields = list(fields)
+        if len(fields) > MAX_FIELDS:
+            raise ComponentStoreError('At most {} fields are supported'.format(MAX_FIELDS))
+
+        self.path = path
+        self.fields = fields
+        self.field_ids = {f: i for i, f in enumerate(fields)}
+        self.count = 0
+
+        metadata = dict(metadata or {})
+        metadata['fields'] = fields
+        meta = json.dumps(metadata).encode('utf-8')
+
+        self.f = open(path, 'wb')
+        self.f.write(HEADER.pack(MAGIC, 0, len(meta)))
+        self.f.write(meta)
+
+    def write(self, components):
+        payload = []
+        for key, value in six.iteritems(components):
+            field_id = self.field_ids.get(key)
+            if field_id is None:
+                raise ComponentStoreError('Unknown field {!r}, known fields: {}'.format(key, self.fields))
+            if isinstance(value, six.text_type):
+                value = value.encode('utf-8')
+            payload.append(FIELD.pack(field_id, len(value)))
+            payload.append(value)
+
+        payload = b''.join(payload)
+        self.f.write(RECORD_SIZE.pack(len(payload)))
+        self.f.write(payload)
+        self.count += 1
+
+    __call__ = write
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.f.seek(len(MAGIC))
+        self.f.write(COUNT.pack(self.count))
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ComponentStoreReader(object):
+    '''
+    Iterates over the records of a component store as dicts, reading from a
+    memory map so the file is never loaded as a whole.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, self.count, meta_size = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ComponentStoreError('{} is not a component store'.format(path))
+            self.metadata = json.loads(f.read(meta_size).decode('utf-8'))
+
+        self.fields = self.metadata['fields']
+        self.data_offset = HEADER.size + meta_size
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        fields = self.fields
+        record_size = RECORD_SIZE.size
+        field_size = FIELD.size
+        unpack_record = RECORD_SIZE.unpack_from
+        unpack_field = FIELD.unpack_from
+
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offset = self.data_offset
+                end = len(data)
+                while offset + record_size <= end:
+                    size, = unpack_record(data, offset)
+                    offset += record_size
+                    record_end = offset + size
+                    if record_end > end:
+                        # the writer did not finish the last record
+                        break
+
+                    components = {}
+                    while offset < record_end:
+                        field_id, value_size = unpack_field(data, offset)
+                        offset += field_size
+                        components[fields[field_id]] = data[offset:offset + value_size].decode('utf-8')
+                        offset += value_size
+
+                    yield components
+            finally:
+                data.close()
+
+
+def add_arguments(parser):
+    parser.add_argument('--ingest',
+                        metavar='STORE',
+                        help='Only normalize the input and write the component records to STORE')
+
+    parser.add_argument('--from-store',
+                        metavar='STORE',
+                        help='Read normalized component records from STORE written by --ingest instead of the input file')
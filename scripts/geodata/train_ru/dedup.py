@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+'''
+Deduplication of output rows across records.
+
+formatted_expanded_addresses only removes the duplicates of one record, but
+dropout variants like "город Москва" or "Московская область" come out of
+millions of records. A RowDeduplicator sits in front of the sink and drops
+every row that was already written, in one of two modes:
+
+exact   the 16-byte digests of written rows are kept in an on-disk SQLite
+        set, so memory stays flat however many rows there are
+bloom   the digests are checked against a Bloom filter sized for an
+        expected row count and false positive rate, capped at a memory
+        ceiling. A false positive drops a row that was not written before.
+
+Rows are checked in the order they are written, so with the same input and
+seed the output is the same in every mode of the pipeline.
+'''
+
+import hashlib
+import math
+import os
+import sqlite3
+import struct
+
+from collections import OrderedDict
+
+from geodata.encoding import safe_encode
+
+from geodata.train_ru.sinks import parse_size
+
+EXACT = 'exact'
+BLOOM = 'bloom'
+
+DEDUP_MODES = (EXACT, BLOOM)
+
+DEFAULT_CAPACITY = 50000000
+DEFAULT_FALSE_POSITIVE_RATE = 0.001
+DEFAULT_MAX_MEMORY = 256 << 20
+DEFAULT_COMMIT_INTERVAL = 100000
+
+DEDUP_STORE_SUFFIX = '.dedup.sqlite'
+
+
+def row_digest(row):
+    # formatted cells are UTF-8 bytes from tsv_string, language and country text
+    return hashlib.md5(b'\t'.join(safe_encode(cell) for cell in row)).digest()
+
+
+class ExactRowSet(object):
+    '''
+    Set of row digests in a temporary SQLite table, which only ever holds the
+    rows of one run and is removed on close
+    '''
+
+    def __init__(self, path, commit_every=DEFAULT_COMMIT_INTERVAL):
+        self.path = path
+        self.commit_every = commit_every
+        self.pending = 0
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode = OFF')
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('CREATE TABLE digests (digest BLOB PRIMARY KEY) WITHOUT ROWID')
+
+    def add(self, digest):
+        '''
+        Adds a digest, returns False if it was already in the set
+        '''
+        added = self.db.execute('INSERT OR IGNORE INTO digests (digest) VALUES (?)',
+                                (sqlite3.Binary(digest),)).rowcount > 0
+        if added:
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.db.commit()
+                self.pending = 0
+        return added
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        os.remove(self.path)
+
+    def stats(self):
+        return OrderedDict([
+            ('mode', EXACT),
+            ('store', self.path),
+        ])
+
+
+class BloomRowSet(object):
+    '''
+    Bloom filter over row digests. The bit array is sized for capacity rows at
+    false_positive_rate, or max_memory bytes if that is smaller, in which case
+    the false positive rate at capacity is correspondingly higher.
+    '''
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE,
+                 max_memory=DEFAULT_MAX_MEMORY):
+        capacity = max(int(capacity), 1)
+        bits = int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        if max_memory:
+            bits = min(bits, int(max_memory) * 8)
+        self.bits = max(bits, 8)
+        self.hashes = max(int(round(float(self.bits) / capacity * math.log(2))), 1)
+        self.capacity = capacity
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def expected_false_positive_rate(self, n=None):
+        n = self.capacity if n is None else n
+        return (1.0 - math.exp(-float(self.hashes) * n / self.bits)) ** self.hashes
+
+    def add(self, digest):
+        '''
+        Adds a digest, returns False if it was (probably) already in the filter
+        '''
+        h1, h2 = struct.unpack('<QQ', digest)
+        bits = self.bits
+        array = self.array
+        added = False
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % bits
+            byte = bit >> 3
+            mask = 1 << (bit & 7)
+            if not array[byte] & mask:
+                array[byte] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def close(self):
+        self.array = None
+
+    def stats(self):
+        return OrderedDict([
+            ('mode', BLOOM),
+            ('memory_bytes', (self.bits + 7) // 8),
+            ('hashes', self.hashes),
+            ('capacity', self.capacity),
+            ('capacity_false_positive_rate', self.expected_false_positive_rate()),
+            ('false_positive_rate', self.expected_false_positive_rate(self.count)),
+        ])
+
+
+class RowDeduplicator(object):
+    '''
+    Callable filter for the rows of one record, returning those not seen before
+    '''
+
+    def __init__(self, row_set):
+        self.row_set = row_set
+        self.rows = 0
+        self.suppressed = 0
+
+    def __call__(self, rows):
+        add = self.row_set.add
+        unique = [row for row in rows if add(row_digest(row))]
+        self.rows += len(rows)
+        self.suppressed += len(rows) - len(unique)
+        return unique
+
+    def close(self):
+        self.row_set.close()
+
+    def stats(self):
+        stats = OrderedDict([
+            ('rows', self.rows),
+            ('suppressed', self.suppressed),
+            ('suppressed_rate', float(self.suppressed) / self.rows if self.rows else 0.0),
+        ])
+        stats.update(self.row_set.stats())
+        return stats
+
+    def report(self):
+        print('dedup ({mode}): {rows} rows, {suppressed} suppressed ({suppressed_rate:.1%})'.format(**self.stats()))
+
+
+def open_deduplicator(output_path, mode, capacity=DEFAULT_CAPACITY,
+                      false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE, max_memory=DEFAULT_MAX_MEMORY):
+    '''
+    Returns a RowDeduplicator for the rows written to output_path. The exact
+    mode keeps its digests next to the output and removes them when done.
+    '''
+    if mode == EXACT:
+        row_set = ExactRowSet(output_path + DEDUP_STORE_SUFFIX)
+    elif mode == BLOOM:
+        row_set = BloomRowSet(capacity=capacity, false_positive_rate=false_positive_rate, max_memory=max_memory)
+        if row_set.expected_false_positive_rate() > false_positive_rate * 1.01:
+            print('dedup: bloom filter capped at {} bytes, false positive rate {:.4%} at {} rows'.format(
+                len(row_set.array), row_set.expected_false_positive_rate(), capacity))
+    else:
+        raise ValueError('Unknown dedup mode {!r}, expected one of {}'.format(mode, DEDUP_MODES))
+    return RowDeduplicator(row_set)
+
+
+def dedup_options(args):
+    if not args.dedup:
+        return None
+    return {
+        'mode': args.dedup,
+        'capacity': args.dedup_capacity,
+        'false_positive_rate': args.dedup_fpr,
+        'max_memory': args.dedup_memory,
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--dedup',
+                        choices=DEDUP_MODES,
+                        default=None,
+                        help='Drop rows already written for an earlier record, exactly or with a Bloom filter')
+
+    parser.add_argument('--dedup-capacity',
+                        type=int,
+                        default=DEFAULT_CAPACITY,
+                        help='Expected number of distinct rows for --dedup bloom')
+
+    parser.add_argument('--dedup-fpr',
+                        type=float,
+                        default=DEFAULT_FALSE_POSITIVE_RATE,
+                        help='Target false positive rate for --dedup bloom')
+
+    parser.add_argument('--dedup-memory',
+                        type=parse_size,
+                        default=DEFAULT_MAX_MEMORY,
+                        help='Memory ceiling of the --dedup bloom filter, e.g. 512M')
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from collections import namedtuple
+
+DISTRICT = 'district'
+CITY = 'city'
+SUBURB = 'suburb'
+
+MAX_CACHED_SEGMENTS = 100000
+
+SegmentedStreet = namedtuple('SegmentedStreet', 'district, city, suburb, street, house_number, unit')
+
+
+class CompositeStreetSegmenter(object):
+    '''
+    Splits a composite street like "Кировский район, г. Кировск, ул. Ленина, 5, кв. 3"
+    with one split on commas.
+
+    All district, city and suburb tokens are compiled into a single regex whose
+    lookahead reports every (possibly overlapping) token in a segment, so a
+    segment is classified with one scan. Registry addresses repeat the same
+    segments ("г. Москва", "Одинцовский район") constantly, so classes are also
+    memoized per segment string. The segments are walked once, applying the
+    same rules as the try_move_*_from_street and split_composite_street_house
+    methods of the CSV converter. Tokens are plain substrings, matched
+    case-sensitively like str.find, and may not contain a comma.
+    '''
+
+    max_cached_segments = MAX_CACHED_SEGMENTS
+
+    def __init__(self, district_tokens, city_tokens, suburb_tokens, unit_tokens):
+        token_classes = {}
+        for cls, tokens in ((DISTRICT, district_tokens), (CITY, city_tokens), (SUBURB, suburb_tokens)):
+            for token in tokens:
+                token_classes.setdefault(token, set()).add(cls)
+
+        # A match of a longer token hides the shorter tokens it contains, so
+        # every token also carries the classes of its substrings
+        self.token_classes = {}
+        for token in token_classes:
+            classes = set()
+            for other, other_classes in token_classes.items():
+                if other in token:
+                    classes |= other_classes
+            self.token_classes[token] = frozenset(classes)
+
+        self.segment_regex = self.lookahead_regex(token_classes)
+        self.classes_cache = {}
+        self.unit_regex = re.compile(u'|'.join(re.escape(t) for t in self.longest_first(unit_tokens)), re.UNICODE)
+
+    @classmethod
+    def longest_first(cls, tokens):
+        return sorted(set(tokens), key=lambda t: (-len(t), t))
+
+    @classmethod
+    def lookahead_regex(cls, tokens):
+        alternatives = u'|'.join(re.escape(t) for t in cls.longest_first(tokens))
+        return re.compile(u'(?=({}))'.format(alternatives), re.UNICODE)
+
+    def segment_classes(self, segment):
+        classes = self.classes_cache.get(segment)
+        if classes is None:
+            classes = frozenset()
+            for token in self.segment_regex.findall(segment):
+                classes = classes | self.token_classes[token]
+            if len(self.classes_cache) >= self.max_cached_segments:
+                self.classes_cache.clear()
+            self.classes_cache[segment] = classes
+        return classes
+
+    def split(self, composite, has_city):
+        '''
+        Returns a SegmentedStreet. district, city, suburb and unit are None when
+        nothing was moved, house_number is None when the street has no comma.
+        '''
+        segments = composite.split(u',')
+        n = len(segments) - 1
+
+        district = city = suburb = house_number = unit = None
+        # k is the index of the first segment not moved yet, offset is where it starts
+        k = 0
+        offset = 0
+
+        if not has_city:
+            if k < n and DISTRICT in self.segment_classes(segments[k]):
+                district = segments[k]
+                offset += len(segments[k]) + 1
+                k += 1
+            if k < n and CITY in self.segment_classes(segments[k]):
+                city = segments[k].lstrip() if k else segments[k]
+                offset += len(segments[k]) + 1
+                k += 1
+
+        if (has_city or city) and k < n and SUBURB in self.segment_classes(segments[k]):
+            suburb = segments[k].lstrip() if k else segments[k]
+            offset += len(segments[k]) + 1
+            k += 1
+
+        street = composite[offset:].strip() if k else composite
+        if street and k < n:
+            house_number = composite[offset + len(segments[k]) + 1:].strip()
+            street = (segments[k].lstrip() if k else segments[k]) or street
+            if house_number:
+                house_number, unit = self.split_unit(house_number)
+
+        return SegmentedStreet(district, city, suburb, street, house_number or None, unit)
+
+    def split_unit(self, house_number):
+        '''
+        Splits at the last comma before the first unit token, returns (house_number, unit)
+        '''
+        if u',' not in house_number:
+            return house_number, None
+
+        match = self.unit_regex.search(house_number.lower())
+        if not match:
+            return house_number, None
+
+        idx_sep = house_number.rfind(u',', 0, match.start())
+        if idx_sep == -1:
+            return house_number, None
+
+        return house_number[:idx_sep], house_number[idx_sep + 1:].strip()
@@ -1,10 +1,11 @@
 ﻿# -*- coding: utf-8 -*-
 
-import fileinput
 from lxml import etree
 import os
 
 from geodata.address_formatting.formatter import AddressFormatter
+from geodata.train_ru.records import Interner, Record
+from geodata.train_ru.sources import open_source
 
 #class AddressFormatter(object):
 #	CATEGORY = 'category'
@@ -35,9 +36,82 @@ from geodata.address_formatting.formatter import AddressFormatter
 #	WORLD_REGION = 'world_region'
 
 
-def license_xml_gz_reader(gz_filename):
+ADDRESS_PLACE_TAG = 'address_place'
 
-	with fileinput.hook_compressed(gz_filename, "rb") as fi:
+# the same few regions and cities repeat on most records
+INTERNED_TAGS = ('region', 'city')
+
+
+def license_xml_gz_header():
+	return ["index", "region", "city", "street"]
+
+
+class LicenseRecord(Record):
+	'''
+	One address_place element, its fields readable by header index or tag
+	'''
+	fields = tuple(license_xml_gz_header())
+
+
+def license_xml_gz_reader(gz_filename, streaming=True, records=False):
+	'''
+	Yields one record per address_place element, a dict from header index to
+	text or with records=True a LicenseRecord.
+
+	The streaming mode lets the parser report only address_place elements,
+	looks fields up in a dict and frees every processed record, so memory stays
+	flat on the full registry dump. streaming=False keeps the original reader,
+	which walks every start/end event and always yields dicts.
+	'''
+	if streaming:
+		return license_xml_gz_streaming_reader(gz_filename, records=records)
+	return license_xml_gz_events_reader(gz_filename)
+
+
+def license_xml_gz_streaming_reader(gz_filename, records=False):
+	# records are filled by field name, dicts by header index
+	tag_keys = {tag: tag if records else i for i, tag in enumerate(license_xml_gz_header())}
+	store = setattr if records else dict.__setitem__
+	interners = {tag: Interner() for tag in INTERNED_TAGS}
+
+	with open_source(gz_filename) as fi:
+		parser = etree.iterparse(fi, events=("end",), tag=ADDRESS_PLACE_TAG)
+
+		for (event, elem) in parser:
+			record = LicenseRecord() if records else {}
+			for child in elem.iterdescendants():
+				tag = child.tag
+				key = tag_keys.get(tag)
+				if key is not None:
+					intern = interners.get(tag)
+					store(record, key, intern(child.text) if intern is not None else child.text)
+
+			release_element(elem)
+
+			for val in record.values():
+				if val is not None:
+					yield record
+					break
+
+
+def release_element(elem):
+	'''
+	Clears a processed element and drops everything parsed before it. Only the
+	chain of open ancestors is walked, so this is O(depth) per record.
+	'''
+	elem.clear()
+	node = elem
+	while node is not None:
+		parent = node.getparent()
+		if parent is not None:
+			while node.getprevious() is not None:
+				del parent[0]
+		node = parent
+
+
+def license_xml_gz_events_reader(gz_filename):
+
+	with open_source(gz_filename) as fi:
 		parser = etree.iterparse(fi, events=("start", "end"))
 
 		match_tag = license_xml_gz_header()
@@ -80,8 +154,4 @@ def license_xml_gz_reader(gz_filename):
 			# Also eliminate now-empty references from the root node to elem
 			for ancestor in elem.xpath('ancestor-or-self::*'):
 				while ancestor.getprevious() is not None:
-					del ancestor.getparent()[0]
-
-
-def license_xml_gz_header():
-	return ["index", "region", "city", "street"]
\ No newline at end of file
+					del ancestor.getparent()[0]
\ No newline at end of file
@@ -3,18 +3,24 @@
 import fileinput
 from lxml import etree
 import os
-import csv
 import argparse
 import six
-import ftfy
 
 from collections import OrderedDict
+from functools import partial
 
 #from geodata.address_formatting.formatter import AddressFormatter
-from geodata.encoding import safe_decode
 from geodata.csv_utils import tsv_string
 
-from fed_nadzor_zdrav_reestr_license_reader import license_xml_gz_header, license_xml_gz_reader
+from geodata.train_ru import checkpoint, instrumentation, metrics, pipeline, sampling, sinks, sources
+from geodata.train_ru.component_encodings import fix_component_encodings
+from geodata.train_ru.instrumentation import NullProfiler
+from geodata.train_ru.pipeline import Pipeline, Stage
+from geodata.train_ru.records import Record
+from geodata.train_ru.sinks import open_sink
+
+from geodata.train_ru.fed_med_nadzor.address_segmenter import CompositeStreetSegmenter
+from geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_reader import license_xml_gz_header, license_xml_gz_reader
 
 
 FED_ZGDAR_SEPARATE_DATA_FILENAME = 'license_separate_addresses.tsv'
@@ -98,8 +104,20 @@ class HealthcareLicensesRUFormatter(object):
 
     MIN_TOKEN_START = 65535
 
+    # split composite streets with one CompositeStreetSegmenter scan instead of
+    # the try_move_* chain below, the output columns are the same
+    use_segmenter = True
+
+    # dicts by default, use_records carries records as slotted
+    # LicenseRecord/LicenseComponents updated in place (--records)
+    use_records = False
+
+    def __init__(self):
+        self.segmenter = CompositeStreetSegmenter(self.district_tokens, self.city_tokens,
+                                                  self.suburb_tokens, self.unit_tokens)
+
     def fix_component_encodings(self, components):
-        return {k: ftfy.fix_encoding(safe_decode(v)) for k, v in six.iteritems(components)}
+        return fix_component_encodings(components)
 
     def split_composite_street_house(self, composite_street_house):
         if not composite_street_house:
@@ -200,91 +218,196 @@ class HealthcareLicensesRUFormatter(object):
 
         return components
 
-    def formatted_addresses(self, path):
-        reader = license_xml_gz_reader(path)
+    def header_indices(self):
         headers = license_xml_gz_header()
+        return {i: self.field_map[k] for i, k in enumerate(headers) if k in self.field_map}
 
-        header_indices = {i: self.field_map[k] for i, k in enumerate(headers) if k in self.field_map}
+    def normalized_components(self, row, header_indices):
+        components = LicenseComponents() if self.use_records else {}
 
-        for row in reader:
-            components = {}
+        for i, key in six.iteritems(header_indices):
+            value = row.get(i)
+            if not value:
+                continue
+            value = value.strip()
+            if not value:
+                continue
 
-            for i, key in six.iteritems(header_indices):
-                value = row[i]
-                if not value:
-                    continue
-                value = row[i].strip()
-                if not value:
-                    continue
+            #if not_applicable_regex.match(value) or null_regex.match(value) or unknown_regex.match(value):
+            #    continue
 
-                #if not_applicable_regex.match(value) or null_regex.match(value) or unknown_regex.match(value):
-                #    continue
+            value = value.strip(', -')
 
-                value = value.strip(', -')
+            #validator = self.component_validators.get(key, None)
 
-                #validator = self.component_validators.get(key, None)
+            #if validator is not None and not validator(value):
+            #    continue
 
-                #if validator is not None and not validator(value):
-                #    continue
+            if value:
+                components[key] = value
 
-                if value:
-                    components[key] = value
+        if not components:
+            return None
 
+        return self.fix_component_encodings(components)
 
-            if components:
-                components = self.fix_component_encodings(components)
+    def segmented_components(self, components):
+        composite = components.get(AddressFormatter.ROAD, None)
+        if not composite:
+            return components
 
-                index = components.get(AddressFormatter.POSTCODE, None)
-                if index == "0":
-                    components.pop(AddressFormatter.POSTCODE)
+        segments = self.segmenter.split(composite, has_city=components.get(AddressFormatter.CITY, None) is not None)
 
-                city = components.get(AddressFormatter.CITY, None)
-                if city is None:
-                    components = self.try_move_district_from_street(components)
-                    components = self.try_move_city_from_street(components)
+        if segments.district is not None:
+            components[AddressFormatter.STATE_DISTRICT] = segments.district
+        if segments.city is not None:
+            components[AddressFormatter.CITY] = segments.city
+        if segments.suburb is not None:
+            components[AddressFormatter.CITY_DISTRICT] = segments.suburb
 
-                city = components.get(AddressFormatter.CITY, None)
-                if city:
-                    components = self.try_move_suburb_from_street(components)
+        components[AddressFormatter.ROAD] = segments.street
 
-                composite = components.get(AddressFormatter.ROAD, None)
-                if composite:
-                    (street, house_number) = self.split_composite_street_house(composite)
-                    if street:
-                        components[AddressFormatter.ROAD] = street
-                    if house_number:
-                        components[AddressFormatter.HOUSE_NUMBER] = house_number
-                        components = self.try_move_unit_from_house_number(components)
+        if segments.house_number:
+            components[AddressFormatter.HOUSE_NUMBER] = segments.house_number
+        if segments.unit is not None:
+            components[AddressFormatter.UNIT] = segments.unit
 
-                if len(components) == 1 and AddressFormatter.STATE in components.keys():
-                    continue
+        return components
 
-                yield tuple(components.get(v, '') for v in self.field_map.values())
+    def expanded_components(self, components):
+        index = components.get(AddressFormatter.POSTCODE, None)
+        if index == "0":
+            components.pop(AddressFormatter.POSTCODE)
+
+        if self.use_segmenter:
+            components = self.segmented_components(components)
+        else:
+            components = self.moved_components(components)
+
+        if len(components) == 1 and AddressFormatter.STATE in components.keys():
+            return None
+
+        if isinstance(components, Record):
+            return components.as_tuple(default='')
+        return tuple(components.get(v, '') for v in self.field_map.values())
+
+    def moved_components(self, components):
+        city = components.get(AddressFormatter.CITY, None)
+        if city is None:
+            components = self.try_move_district_from_street(components)
+            components = self.try_move_city_from_street(components)
+
+        city = components.get(AddressFormatter.CITY, None)
+        if city:
+            components = self.try_move_suburb_from_street(components)
+
+        composite = components.get(AddressFormatter.ROAD, None)
+        if composite:
+            (street, house_number) = self.split_composite_street_house(composite)
+            if street:
+                components[AddressFormatter.ROAD] = street
+            if house_number:
+                components[AddressFormatter.HOUSE_NUMBER] = house_number
+                components = self.try_move_unit_from_house_number(components)
 
+        return components
 
-    def build_prepare_csv_data(self, infile, out_dir):
-        formatted_tagged_file = open(os.path.join(out_dir, FED_ZGDAR_SEPARATE_DATA_FILENAME), 'wb')
-        writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
+    def formatted_columns(self, columns):
+        row = []
+        for col in columns:
+            col = col.replace('"', '')
+            col = tsv_string(col)
+            row.append(col)
+        return row
 
-        writer.writerow(self.field_map.keys())
+    def formatted_addresses(self, path):
+        header_indices = self.header_indices()
+
+        for row in license_xml_gz_reader(path, records=self.use_records):
+            components = self.normalized_components(row, header_indices)
+            if components is None:
+                continue
+
+            columns = self.expanded_components(components)
+            if columns is None:
+                continue
+
+            yield columns
+
+    def build_prepare_csv_data(self, infile, out_dir, threaded=False, queue_size=pipeline.DEFAULT_QUEUE_SIZE,
+                               stage_workers=None, ordered=False, profiler=None, checkpoint_every=None, resume=False,
+                               sink_options=None, read_ahead=pipeline.DEFAULT_READ_AHEAD, sample_options=None,
+                               metrics_options=None):
+        '''
+        infile is the registry XML or a list of them, merged into one output
+        '''
+        paths = sources.input_paths(infile)
+        sink = open_sink(os.path.join(out_dir, FED_ZGDAR_SEPARATE_DATA_FILENAME), append=resume,
+                         header=list(self.field_map.keys()), **(sink_options or {}))
+
+        checkpointer, skip = checkpoint.resumable(sink, checkpoint=bool(checkpoint_every), resume=resume,
+                                                  every=checkpoint_every or checkpoint.DEFAULT_CHECKPOINT_INTERVAL,
+                                                  params={'input': sources.input_key(paths), 'sample': sample_options})
+        if checkpointer is not None:
+            # checkpoints need every record before the saved position to be written
+            ordered = True
+
+        monitor = metrics.create_metrics('fed_med_nadzor', paths, metrics_options)
+
+        def write_row(row):
+            monitor.sunk(1)
+            sink.writerow(row)
+            i = sink.rows
+            if i % 1000 == 0 and i > 0:
+                sink.flush()
+
+        header_indices = self.header_indices()
+        state_index = [i for i, key in six.iteritems(header_indices) if key == AddressFormatter.STATE]
+        sampler = sampling.StratifiedSampler(sampling.field_getter(state_index[0] if state_index else None),
+                                             **sample_options) if sample_options else None
+
+        stage_workers = stage_workers or {}
+        profiler = profiler or NullProfiler()
+        profiler.instrument(self, ('fix_component_encodings',))
+        profiler.instrument(self.segmenter, ('split',), prefix='segmenter.')
+
+        stages = [
+            Stage(pipeline.NORMALIZE,
+                  profiler.wrap(pipeline.NORMALIZE, partial(self.normalized_components, header_indices=header_indices), memory=True),
+                  workers=stage_workers.get(pipeline.NORMALIZE)),
+            Stage(pipeline.EXPAND, profiler.wrap(pipeline.EXPAND, self.expanded_components, memory=True),
+                  workers=stage_workers.get(pipeline.EXPAND)),
+            Stage(pipeline.FORMAT, profiler.wrap(pipeline.FORMAT, self.formatted_columns, memory=True),
+                  workers=stage_workers.get(pipeline.FORMAT)),
+        ]
 
-        i = 0
         #for post_code, region, district, city, suburb, street, house_number, unit in self.formatted_addresses(infile):
-        for columns in self.formatted_addresses(infile):
-            #if not formatted_address or not formatted_address.strip():
-            #    continue
+        profiler.start()
+        try:
+            with sink:
+                records = monitor.counted(sources.merged([license_xml_gz_reader(path, records=self.use_records)
+                                                          for path in paths]))
+                if sampler is not None:
+                    records = sampler(records)
+                records = pipeline.read_ahead(checkpoint.skip_records(records, skip), read_ahead)
+                p = Pipeline(records, stages,
+                             profiler.wrap(pipeline.SINK, write_row, memory=True),
+                             queue_size=queue_size, ordered=ordered, threaded=threaded, progress=checkpointer)
+                monitor.attach(p)
+                p.run()
+        finally:
+            profiler.stop()
+            monitor.close()
 
-            row = []
-            for col in columns:
-                col = col.replace('"', '')
-                col = tsv_string(col)
-                row.append(col)
+        if sampler is not None:
+            sampler.report()
+
+        if checkpointer is not None:
+            checkpointer.finish()
 
-            writer.writerow(row)
-            i += 1
-            if i % 1000 == 0 and i > 0:
-                formatted_tagged_file.flush()
-                print('did {} formatted addresses'.format(i))
+
+class LicenseComponents(Record):
+    fields = HealthcareLicensesRUFormatter.field_map.values()
 
 
 
@@ -300,10 +423,47 @@ if __name__ == '__main__':
                         default=os.getcwd(),
                         help='Output directory')
 
+    parser.add_argument('--ordered',
+                        action='store_true',
+                        default=False,
+                        help='Keep output rows in input order when a stage has several workers')
+
+    parser.add_argument('--records',
+                        action='store_true',
+                        default=False,
+                        help='Carry records as slotted records instead of dicts (less memory, slower)')
+
+    pipeline.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    checkpoint.add_arguments(parser)
+    sinks.add_arguments(parser)
+    sampling.add_arguments(parser)
+    metrics.add_arguments(parser)
+    sources.add_arguments(parser)
+
     args = parser.parse_args()
+    sources.check_arguments(parser, args)
+
+    inputs = sources.input_paths(args.healthcare_licenses_ru_file, args.sources)
 
-    if args.healthcare_licenses_ru_file:
+    def build(infile, out_dir, source=None):
         hl_formatter = HealthcareLicensesRUFormatter()
-        hl_formatter.build_prepare_csv_data(args.healthcare_licenses_ru_file, args.out_dir)
+        hl_formatter.use_records = args.records
+        profiler = instrumentation.create_profiler(args.profile, trace_memory=args.profile_memory)
+        try:
+            hl_formatter.build_prepare_csv_data(infile, out_dir, threaded=args.pipeline,
+                                                queue_size=args.queue_size, stage_workers=args.stage_workers,
+                                                ordered=args.ordered, profiler=profiler,
+                                                checkpoint_every=checkpoint.checkpoint_every(args),
+                                                resume=args.resume, sink_options=sinks.sink_options(args),
+                                                read_ahead=args.read_ahead, sample_options=sampling.sample_options(args),
+                                                metrics_options=metrics.metrics_options(args, source=source))
+        finally:
+            profiler.write_report(instrumentation.report_path(args, out_dir, source=source))
+
+    if inputs and args.per_source:
+        sources.run_per_source(build, inputs, args.out_dir, processes=args.source_processes)
+    elif inputs:
+        build(inputs, args.out_dir)
     else:
         print(parser.format_usage())
\ No newline at end of file
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+
+from geodata.encoding import safe_decode
+
+from geodata.train_ru import checkpoint, column_batches, component_store, dedup, incremental, instrumentation, metrics, parallel, pipeline, sampling, sinks, sources, startup
+from geodata.train_ru.sinks import open_sink
+from geodata.train_ru.tsv_to_training_data import HealthcareLicensesRUFormatter as TrainingDataFormatter
+
+from geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_to_csv import FED_ZGDAR_SEPARATE_DATA_FILENAME
+from geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_to_csv import HealthcareLicensesRUFormatter as SeparateAddressesFormatter
+
+
+class HealthcareLicensesRUTrainingFormatter(TrainingDataFormatter):
+    '''
+    Formats training data straight from the registry XML in one pass. The
+    registry converter splits the composite streets, and its columns reach the
+    TSV formatter as the rows it would read back from
+    license_separate_addresses.tsv, without writing and re-parsing the file.
+
+    The rows are converted on the source side of the pipeline (on the reader
+    thread with --read-ahead), so that license_separate_addresses.tsv can
+    still be written alongside in input order when asked for.
+    '''
+
+    def __init__(self, snapshot=None, separate_addresses=None):
+        super(HealthcareLicensesRUTrainingFormatter, self).__init__(snapshot=snapshot)
+        self.separate = SeparateAddressesFormatter()
+        self.separate_addresses = separate_addresses
+
+    def separate_header(self):
+        return list(self.separate.field_map.keys())
+
+    def open_reader(self, path):
+        header_indices = {i: self.field_map[k] for i, k in enumerate(self.separate_header()) if k in self.field_map}
+        return self.separate_rows(path), header_indices
+
+    def open_sources(self, paths):
+        if self.separate_addresses and len(paths) > 1:
+            raise ValueError('{} is written for a single source, use --per-source'.format(self.separate_addresses))
+        return super(HealthcareLicensesRUTrainingFormatter, self).open_sources(paths)
+
+    def separate_rows(self, path):
+        '''
+        Yields the rows of license_separate_addresses.tsv for the registry XML
+        at path, decoded as tsv_reader would return them
+        '''
+        if not self.separate_addresses:
+            for columns in self.separate.formatted_addresses(path):
+                yield [safe_decode(col) for col in self.separate.formatted_columns(columns)]
+            return
+
+        with open_sink(self.separate_addresses, header=self.separate_header()) as sink:
+            for columns in self.separate.formatted_addresses(path):
+                row = self.separate.formatted_columns(columns)
+                sink.writerow(row)
+                yield [safe_decode(col) for col in row]
+
+    def build_training_data(self, infile, out_dir, resume=False, **kw):
+        if self.separate_addresses and resume:
+            raise ValueError('{} cannot be written by a resumed run'.format(self.separate_addresses))
+        return super(HealthcareLicensesRUTrainingFormatter, self).build_training_data(infile, out_dir, resume=resume, **kw)
+
+
+if __name__ == '__main__':
+    # Handle argument parsing here
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('sources', nargs='*')
+
+    parser.add_argument('-i', '--healthcare-licenses-ru-file',
+                        help='Path to RU Goverment Healthcare Reestr Licenses.xml file')
+
+    parser.add_argument('-u', '--untagged',
+                        action='store_true',
+                        default=False,
+                        help='Save untagged formatted addresses')
+
+    parser.add_argument('-o', '--out-dir',
+                        default=os.getcwd(),
+                        help='Output directory')
+
+    parser.add_argument('--separate-addresses',
+                        action='store_true',
+                        default=False,
+                        help='Also write the split addresses to {} in the output directory'.format(FED_ZGDAR_SEPARATE_DATA_FILENAME))
+
+    parallel.add_arguments(parser)
+    pipeline.add_arguments(parser)
+    component_store.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    checkpoint.add_arguments(parser)
+    incremental.add_arguments(parser)
+    sinks.add_arguments(parser)
+    startup.add_arguments(parser)
+    dedup.add_arguments(parser)
+    sampling.add_arguments(parser)
+    metrics.add_arguments(parser)
+    column_batches.add_arguments(parser)
+    sources.add_arguments(parser)
+
+    args = parser.parse_args()
+    sources.check_arguments(parser, args)
+
+    inputs = sources.input_paths(args.healthcare_licenses_ru_file, args.sources)
+
+    def separate_addresses(out_dir):
+        return os.path.join(out_dir, FED_ZGDAR_SEPARATE_DATA_FILENAME) if args.separate_addresses else None
+
+    def build(infile, out_dir, source=None):
+        hl_formatter = HealthcareLicensesRUTrainingFormatter(snapshot=args.snapshot, separate_addresses=separate_addresses(out_dir))
+        profiler = instrumentation.create_profiler(args.profile, trace_memory=args.profile_memory)
+        try:
+            hl_formatter.build_training_data(infile, out_dir, tag_components=not args.untagged,
+                                             workers=args.workers, batch_size=args.batch_size,
+                                             ordered=args.ordered, seed=args.seed, threaded=args.pipeline,
+                                             queue_size=args.queue_size, stage_workers=args.stage_workers,
+                                             from_store=args.from_store, profiler=profiler,
+                                             checkpoint_every=checkpoint.checkpoint_every(args),
+                                             resume=args.resume, incremental_store=args.incremental,
+                                             sink_options=sinks.sink_options(args),
+                                             dedup_options=dedup.dedup_options(args), read_ahead=args.read_ahead,
+                                             sample_options=sampling.sample_options(args),
+                                             metrics_options=metrics.metrics_options(args, source=source),
+                                             column_batch=args.column_batch)
+        finally:
+            profiler.write_report(instrumentation.report_path(args, out_dir, source=source))
+
+    if inputs and args.ingest:
+        hl_formatter = HealthcareLicensesRUTrainingFormatter(separate_addresses=separate_addresses(args.out_dir))
+        hl_formatter.build_component_store(inputs, args.ingest, threaded=args.pipeline,
+                                           queue_size=args.queue_size, stage_workers=args.stage_workers,
+                                           read_ahead=args.read_ahead)
+    elif inputs and args.per_source:
+        sources.run_per_source(build, inputs, args.out_dir, processes=args.source_processes)
+    elif inputs or args.from_store:
+        build(inputs, args.out_dir)
+    else:
+        print(parser.format_usage())
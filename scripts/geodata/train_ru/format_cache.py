@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+import re
+import zlib
+
+from collections import OrderedDict
+
+import six
+
+from geodata.encoding import safe_encode
+
+from geodata.train_ru.cache import LRUCache
+
+DEFAULT_TEMPLATE_CACHE_SIZE = 1000
+DEFAULT_TOKENS_CACHE_SIZE = 100000
+
+# AddressFormatter methods whose result only depends on their arguments
+CACHED_METHODS = OrderedDict([
+    ('get_template', DEFAULT_TEMPLATE_CACHE_SIZE),
+    ('tag_template_separators', DEFAULT_TEMPLATE_CACHE_SIZE),
+    ('tagged_tokens', DEFAULT_TOKENS_CACHE_SIZE),
+])
+
+# separator token between the lines of a tagged address
+TAGGED_SEPARATOR = u'|'
+
+# one in this many derived variants is also rendered and compared
+DEFAULT_VARIANT_CHECK_EVERY = 50
+
+FIRST_SECTION_RE = re.compile(r'\{\{#first\}\}.*?\{\{/first\}\}', re.S)
+TEMPLATE_COMPONENT_RE = re.compile(r'\{\{\{?\s*([A-Za-z_]+)\s*\}?\}\}')
+
+_missing = object()
+
+
+class CachedMethod(object):
+    '''
+    Memoized method of one instance. Unlike a closure it can be pickled along
+    with the instance, e.g. in a startup snapshot.
+    '''
+
+    def __init__(self, owner, name, cache):
+        self.owner = owner
+        self.name = name
+        self.cache = cache
+        self.func = getattr(type(owner), name)
+
+    def __call__(self, *args, **kwargs):
+        key = args + tuple(sorted(kwargs.items())) if kwargs else args
+        value = self.cache.get(key, _missing)
+        if value is _missing:
+            value = self.func(self.owner, *args, **kwargs)
+            self.cache.set(key, value)
+        return value
+
+    def __getstate__(self):
+        return (self.owner, self.name, self.cache)
+
+    def __setstate__(self, state):
+        self.owner, self.name, self.cache = state
+        self.func = getattr(type(self.owner), self.name)
+
+
+class FormatterMethodCache(object):
+    '''
+    Memoizes the deterministic methods AddressFormatter.format_address calls
+    on one formatter instance: template selection per country/language,
+    tagging of the template separators and tokenization/tagging of component
+    values. format_address itself is called as before.
+
+    revised_template still runs on every call, since it decides at random which
+    optional components to insert, and AddressFormatter already keeps the
+    revised and parsed templates for every outcome of those choices. For the
+    same reason there is no render plan per country, language and component
+    keys to cache: the template differs between calls with the same keys.
+
+    Every listed method has to exist, so that a libpostal upgrade renaming one
+    of them fails loudly instead of silently formatting without its cache.
+    '''
+
+    def __init__(self, formatter, name=None, methods=CACHED_METHODS):
+        self.formatter = formatter
+        self.name = name or type(formatter).__name__
+        self.caches = OrderedDict()
+
+        for method, max_size in methods.items():
+            if not hasattr(formatter, method):
+                raise AttributeError('{} has no method {} to cache'.format(type(formatter).__name__, method))
+            cache = self.caches[method] = LRUCache(max_size)
+            setattr(formatter, method, CachedMethod(formatter, method, cache))
+
+        _method_caches.append(self)
+
+    def __setstate__(self, state):
+        # a formatter loaded from a startup snapshot brings its method caches along
+        self.__dict__.update(state)
+        _method_caches.append(self)
+
+    def stats(self):
+        return OrderedDict((method, cache.stats()) for method, cache in self.caches.items())
+
+
+def variant_signature(components):
+    '''
+    Hashable key of a component set, used to find variants of a record that
+    were already formatted
+    '''
+    return frozenset(six.iteritems(components))
+
+
+def drop_tagged_components(formatted, components):
+    '''
+    Removes the tokens of the given components from a tagged address like
+
+    ул./road Ленина/road 5/house_number | Москва/city | 101000/postcode
+
+    along with the separators that would be left empty, which is what the
+    formatter produces for the same components without those. Values may
+    contain "/", the label is what follows the last one.
+    '''
+    labels = set(component.replace(u' ', u'_') for component in components)
+    tokens = []
+    for token in formatted.split(u' '):
+        if token == TAGGED_SEPARATOR:
+            if tokens and tokens[-1] != TAGGED_SEPARATOR:
+                tokens.append(token)
+            continue
+        if token.rpartition(u'/')[2] in labels:
+            continue
+        tokens.append(token)
+
+    while tokens and tokens[-1] == TAGGED_SEPARATOR:
+        tokens.pop()
+    return u' '.join(tokens)
+
+
+def tagged_labels(formatted):
+    '''
+    Component labels of the tokens of a tagged address
+    '''
+    return set(token.rpartition(u'/')[2] for token in formatted.split(u' ') if token != TAGGED_SEPARATOR)
+
+
+def template_slots(template_text):
+    '''
+    The components of an address template and, of those, the plain slots:
+    the components outside {{#first}} sections. Removing a plain slot only
+    removes its tokens, removing a component of a {{#first}} section can bring
+    in the next alternative of the section.
+    '''
+    components = set(TEMPLATE_COMPONENT_RE.findall(template_text))
+    fallbacks = set()
+    for section in FIRST_SECTION_RE.findall(template_text):
+        fallbacks.update(TEMPLATE_COMPONENT_RE.findall(section))
+    return frozenset(components), frozenset(components - fallbacks)
+
+
+class VariantDeriver(object):
+    '''
+    Dropout variants of a tagged address derived from the previous variant.
+
+    A variant is derived by removing the dropped component's tokens only when
+    the formatter would render the same: the dropped component is a plain slot
+    of the country's template and the previous variant has no components the
+    template does not have (random insertions of revised_template, whose place
+    can depend on the dropped component). Otherwise, and for one in
+    check_every derived variants, the variant is rendered by format_address.
+    A checked variant that differs from its derivation is counted as a
+    mismatch and the rendered one is used.
+    '''
+
+    def __init__(self, formatter, name=None, check_every=DEFAULT_VARIANT_CHECK_EVERY):
+        self.formatter = formatter
+        self.name = name or type(formatter).__name__
+        self.check_every = check_every
+        self.templates = {}
+
+        self.derived = 0
+        self.rendered = 0
+        self.checked = 0
+        self.mismatched = 0
+
+        _variant_derivers.append(self)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _variant_derivers.append(self)
+
+    def slots(self, country, language):
+        key = (country, language)
+        slots = self.templates.get(key)
+        if slots is None:
+            template = self.formatter.get_template(country, language=language)
+            text = template.get('address_template') if template else None
+            slots = self.templates[key] = template_slots(text) if text else (frozenset(), frozenset())
+        return slots
+
+    def derivable(self, previous, component, country, language):
+        components, plain = self.slots(country, language)
+        return component in plain and tagged_labels(previous) <= components
+
+    def render(self, components, country, language):
+        return self.formatter.format_address(components, country, language=language,
+                                             tag_components=True, minimal_only=False)
+
+    def variant(self, previous, component, components, country, language):
+        '''
+        Tagged address of components, which are the components of the tagged
+        address previous without component
+        '''
+        if not previous or not self.derivable(previous, component, country, language):
+            self.rendered += 1
+            return self.render(components, country, language)
+
+        derived = drop_tagged_components(previous, (component,))
+        if not self.check_every or zlib.crc32(safe_encode(derived)) % self.check_every:
+            self.derived += 1
+            return derived
+
+        # the sample depends on the address only, so seeded runs stay reproducible
+        rendered = self.render(components, country, language)
+        self.checked += 1
+        if rendered != derived:
+            self.mismatched += 1
+        return rendered
+
+    def stats(self):
+        return OrderedDict([
+            ('derived', self.derived),
+            ('rendered', self.rendered),
+            ('checked', self.checked),
+            ('mismatched', self.mismatched),
+        ])
+
+
+_method_caches = []
+_variant_derivers = []
+
+
+def formatter_method_cache(formatter, name=None):
+    '''
+    Returns the method caches attached to a formatter, creating them on first use.
+    '''
+    cached = formatter.__dict__.get('method_caches')
+    if cached is None:
+        cached = formatter.method_caches = FormatterMethodCache(formatter, name=name)
+    return cached
+
+
+def variant_deriver(formatter, name=None):
+    '''
+    Returns the variant deriver attached to a formatter, creating it on first use.
+    '''
+    deriver = formatter.__dict__.get('variant_deriver')
+    if deriver is None:
+        deriver = formatter.variant_deriver = VariantDeriver(formatter, name=name)
+    return deriver
+
+
+def variant_stats():
+    '''
+    Derived variant counts per formatter name, summed over the instances of
+    that name
+    '''
+    stats = OrderedDict()
+    for deriver in _variant_derivers:
+        total = stats.setdefault(deriver.name, OrderedDict((key, 0) for key in deriver.stats()))
+        for key, value in deriver.stats().items():
+            total[key] += value
+    return stats
+
+
+def format_cache_stats():
+    '''
+    Cache statistics per formatter name, summed over the instances of that name
+    '''
+    stats = OrderedDict()
+    for cached in _method_caches:
+        methods = stats.setdefault(cached.name, OrderedDict())
+        for method, method_stats in cached.stats().items():
+            total = methods.get(method)
+            if total is None:
+                methods[method] = method_stats
+                continue
+            for key in ('size', 'hits', 'misses'):
+                total[key] += method_stats[key]
+            lookups = total['hits'] + total['misses']
+            total['hit_rate'] = float(total['hits']) / lookups if lookups else 0.0
+    return stats
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+from geodata.address_expansions.abbreviations import abbreviate
+from geodata.text.tokenize import token_types
+
+from geodata.train_ru.cache import LRUCache
+
+DEFAULT_PHRASE_CACHE_SIZE = 50000
+
+
+class PhraseMatches(object):
+    '''
+    Stands in for a gazetteer during one abbreviate() call. Without matches
+    it asks the gazetteer and records what filter() returned, with the matches
+    recorded for the same string it returns them again. abbreviate() calls
+    filter() once for the string and once for every hyphenated part of it, in
+    an order that only depends on the string.
+    '''
+
+    def __init__(self, gazetteer, matches=None):
+        self.gazetteer = gazetteer
+        self.recording = matches is None
+        self.matches = [] if matches is None else matches
+        self.calls = 0
+
+    def filter(self, tokens):
+        if self.recording:
+            # phrase data is a lazy map() on Python 3, so it is kept as a list
+            matches = [(t, c, length, list(data) if data is not None else None)
+                       for t, c, length, data in self.gazetteer.filter(tokens)]
+            self.matches.append(matches)
+        else:
+            matches = self.matches[self.calls]
+        self.calls += 1
+        return iter(matches)
+
+    def has_phrases(self):
+        return any(c == token_types.PHRASE for matches in self.matches for t, c, length, data in matches)
+
+    def __getattr__(self, name):
+        if name == 'gazetteer':
+            raise AttributeError(name)
+        return getattr(self.gazetteer, name)
+
+
+class CachedPhraseFilter(object):
+    '''
+    Wraps a gazetteer so tokenizing a string and matching its phrases is done
+    once per (language, string) instead of on every abbreviate() call.
+
+    A string without any phrase of the gazetteer always abbreviates to the
+    same text, which is kept and returned directly. For a string with phrases
+    the matches are kept and abbreviate() runs again on them, since it makes
+    its random abbreviate/separate choices from the tokens on every call, so
+    the output distribution does not change.
+
+    Everything except abbreviate() is delegated to the wrapped gazetteer.
+    '''
+
+    def __init__(self, gazetteer, name=None, max_size=DEFAULT_PHRASE_CACHE_SIZE):
+        self.gazetteer = gazetteer
+        self.name = name or type(gazetteer).__name__
+        self.cache = LRUCache(max_size)
+
+    def abbreviate(self, s, language, **kwargs):
+        key = (language, s)
+        matches = self.cache.get(key)
+        if matches is None:
+            recorder = PhraseMatches(self.gazetteer)
+            abbreviated = abbreviate(recorder, s, language, **kwargs)
+            self.cache.set(key, recorder.matches if recorder.has_phrases() else abbreviated)
+            return abbreviated
+        elif isinstance(matches, list):
+            return abbreviate(PhraseMatches(self.gazetteer, matches), s, language, **kwargs)
+        return matches
+
+    def __getattr__(self, name):
+        if name == 'gazetteer':
+            raise AttributeError(name)
+        return getattr(self.gazetteer, name)
+
+
+_cached_gazetteers = OrderedDict()
+
+
+def cached_gazetteer(gazetteer, name=None):
+    '''
+    Returns the shared caching wrapper for a gazetteer, creating it on first use.
+    '''
+    key = id(gazetteer)
+    cached = _cached_gazetteers.get(key)
+    if cached is None:
+        cached = CachedPhraseFilter(gazetteer, name=name)
+        _cached_gazetteers[key] = cached
+    return cached
+
+
+def phrase_cache_stats():
+    return OrderedDict((cached.name, cached.cache.stats()) for cached in _cached_gazetteers.values())
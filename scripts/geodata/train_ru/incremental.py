@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+'''
+Incremental regeneration of training rows.
+
+Every input record is keyed by a hash of its normalized components, the
+formatter settings and the seed. The rows produced for a key are kept in a
+SQLite file, so a later run over a new extract only formats records whose key
+is new. Each record is formatted with the RNG seeded from its own key, which
+makes its rows independent of where it sits in the input and of what was
+formatted before it. Keys not seen in a run (deleted or changed records) are
+purged from the store when the run completes.
+'''
+
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+import six
+
+from geodata.encoding import safe_decode, safe_encode
+
+DEFAULT_COMMIT_INTERVAL = 10000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, run INTEGER NOT NULL, rows TEXT NOT NULL);
+'''
+
+
+def formatter_fingerprint(formatter, **params):
+    '''
+    Hash of everything besides the record that changes a formatter's output:
+    its *_probability settings, its parser config if it has one and params
+    such as the seed.
+    '''
+    settings = OrderedDict()
+    cls = type(formatter)
+    settings['formatter'] = '{}.{}'.format(cls.__module__, cls.__name__)
+    for name in sorted(dir(cls)):
+        if name.endswith('_probability'):
+            settings[name] = getattr(cls, name)
+    settings['config'] = getattr(formatter, 'config', None)
+    settings['params'] = OrderedDict(sorted(params.items()))
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+
+def encoded_rows(rows):
+    return [tuple(safe_encode(cell) for cell in row) for row in rows]
+
+
+def decoded_rows(rows):
+    return [[safe_decode(cell) for cell in row] for row in rows]
+
+
+class IncrementalRows(object):
+    '''
+    Callable pipeline step mapping normalized components to training rows,
+    reusing the rows stored for an identical record of an earlier run and
+    calling format_record(components) only for new ones.
+
+    Rows are stored as JSON text and returned with UTF-8 encoded cells, like
+    tsv_string returns the formatted address, whether they were formatted or
+    reused.
+    '''
+
+    def __init__(self, path, format_record, fingerprint, commit_every=DEFAULT_COMMIT_INTERVAL):
+        self.path = path
+        self.format_record = format_record
+        self.fingerprint = fingerprint
+        self.commit_every = commit_every
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+        row = self.db.execute('SELECT value FROM meta WHERE name = ?', ('run',)).fetchone()
+        self.run = int(row[0]) + 1 if row else 1
+        self.db.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', ('run', str(self.run)))
+        self.db.commit()
+
+        self.reused = 0
+        self.formatted = 0
+        self.deleted = 0
+        self.pending = 0
+
+    def record_key(self, components):
+        data = json.dumps({k: safe_decode(v) for k, v in six.iteritems(dict(components))}, sort_keys=True, ensure_ascii=False)
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        return hashlib.sha1(self.fingerprint.encode('utf-8') + data).hexdigest()
+
+    def __call__(self, components):
+        key = self.record_key(components)
+
+        with self.lock:
+            row = self.db.execute('SELECT rows FROM rows WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.db.execute('UPDATE rows SET run = ? WHERE key = ?', (self.run, key))
+                self.reused += 1
+                self.committed()
+                return encoded_rows(json.loads(row[0]))
+
+        random.seed(int(key[:16], 16))
+        rows = self.format_record(components)
+
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO rows (key, run, rows) VALUES (?, ?, ?)',
+                            (key, self.run, json.dumps(decoded_rows(rows))))
+            self.formatted += 1
+            self.committed()
+        return encoded_rows(rows)
+
+    def committed(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self, purge=True):
+        '''
+        Commits the run. With purge, rows of records that were not in this
+        run's input are deleted.
+        '''
+        with self.lock:
+            if purge:
+                self.deleted = self.db.execute('DELETE FROM rows WHERE run != ?', (self.run,)).rowcount
+            self.db.commit()
+            self.db.close()
+
+    def stats(self):
+        return OrderedDict([
+            ('run', self.run),
+            ('reused', self.reused),
+            ('formatted', self.formatted),
+            ('deleted', self.deleted),
+        ])
+
+
+def add_arguments(parser):
+    parser.add_argument('--incremental',
+                        metavar='STORE',
+                        help='Reuse the rows of unchanged records from the SQLite file STORE and update it')
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sys
+import threading
+
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_REPORT_FILENAME = 'profile.json'
+
+# report section, module and function returning the statistics of its caches.
+# Only modules a converter has imported are asked, so a report does not load
+# libpostal's gazetteers or formatter into a converter that does not use them.
+STATS_PROVIDERS = (
+    ('startup', 'geodata.train_ru.startup', 'startup_stats'),
+    ('phrase_caches', 'geodata.train_ru.gazetteer_cache', 'phrase_cache_stats'),
+    ('encodings', 'geodata.train_ru.component_encodings', 'encoding_stats'),
+    ('formatter_caches', 'geodata.train_ru.format_cache', 'format_cache_stats'),
+    ('variants', 'geodata.train_ru.format_cache', 'variant_stats'),
+)
+
+# statistics that are the same in every process rather than summed
+SHARED_STATS = ('max_size',)
+
+# rates recomputed from the summed counts
+RATE_STATS = OrderedDict([
+    ('hit_rate', lambda stats: ratio(stats['hits'], stats['hits'] + stats['misses'])),
+    ('ftfy_rate', lambda stats: ratio(stats['ftfy_calls'], stats['values'])),
+])
+
+
+def ratio(n, total):
+    return float(n) / total if total else 0.0
+
+
+def module_stats():
+    '''
+    Statistics of the caches of the train_ru modules loaded in this process
+    '''
+    stats = OrderedDict()
+    for section, module_name, func in STATS_PROVIDERS:
+        module = sys.modules.get(module_name)
+        if module is not None:
+            stats[section] = getattr(module, func)()
+    return stats
+
+
+def merge_stats(total, stats):
+    '''
+    Adds the cache statistics of another process, e.g. a formatting worker,
+    to those in total
+    '''
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            merge_stats(total.setdefault(key, OrderedDict()), value)
+        elif key not in total:
+            total[key] = value
+        elif key not in SHARED_STATS and key not in RATE_STATS:
+            total[key] += value
+
+    for key, rate in RATE_STATS.items():
+        if key in total:
+            total[key] = rate(total)
+    return total
+
+
+def worker_stats():
+    '''
+    The last statistics sent by each formatting worker process, if any ran
+    '''
+    parallel = sys.modules.get('geodata.train_ru.parallel')
+    return parallel.worker_stats() if parallel is not None else []
+
+
+class NullProfiler(object):
+    '''
+    Stands in for Profiler when --profile is off: nothing is wrapped, so the
+    converters run exactly the same code as without instrumentation.
+    '''
+
+    enabled = False
+
+    def wrap(self, name, func, memory=False):
+        return func
+
+    def instrument(self, obj, methods, prefix=''):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def report(self):
+        return None
+
+    def write_report(self, path):
+        pass
+
+
+class Profiler(object):
+    '''
+    Accumulates call counts and wall time per named step. Steps are timed by
+    wrapping functions or the methods of an instance, and timed steps may be
+    nested, e.g. format_address inside the format stage. With trace_memory the
+    peak of traced allocations during each call of a step wrapped with
+    memory=True is recorded as well. That should only be done for the outermost
+    steps (pipeline stages and the writer) since tracemalloc has one peak per
+    process, and needs Python 3.9+ for tracemalloc.reset_peak.
+
+    Steps running in worker processes (--workers) are not seen by the profiler.
+    '''
+
+    enabled = True
+
+    def __init__(self, trace_memory=False):
+        self.steps = OrderedDict()
+        self.lock = threading.Lock()
+        self.trace_memory = trace_memory and tracemalloc is not None and hasattr(tracemalloc, 'reset_peak')
+        self.started = None
+        self.stopped = None
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.started = timer()
+
+    def stop(self):
+        self.stopped = timer()
+        if self.trace_memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def add(self, name, seconds, peak=0):
+        with self.lock:
+            step = self.steps.get(name)
+            if step is None:
+                step = self.steps[name] = [0, 0.0, 0]
+            step[0] += 1
+            step[1] += seconds
+            if peak > step[2]:
+                step[2] = peak
+
+    def wrap(self, name, func, memory=False):
+        add = self.add
+
+        if memory and self.trace_memory:
+            def timed(*args, **kwargs):
+                current = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                start = timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    seconds = timer() - start
+                    add(name, seconds, tracemalloc.get_traced_memory()[1] - current)
+        else:
+            def timed(*args, **kwargs):
+                start = timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    add(name, timer() - start)
+
+        return timed
+
+    def instrument(self, obj, methods, prefix=''):
+        '''
+        Replaces the given methods of obj (an instance, not its class) with timed wrappers
+        '''
+        for method in methods:
+            setattr(obj, method, self.wrap(prefix + method, getattr(obj, method)))
+
+    def report(self):
+        total = (self.stopped or timer()) - self.started if self.started is not None else 0.0
+
+        steps = OrderedDict()
+        for name, (calls, seconds, peak) in sorted(self.steps.items(), key=lambda item: -item[1][1]):
+            step = OrderedDict([
+                ('calls', calls),
+                ('seconds', seconds),
+                ('mean_ms', seconds * 1000.0 / calls if calls else 0.0),
+                ('share', seconds / total if total else 0.0),
+            ])
+            if peak:
+                step['peak_alloc_kb'] = peak / 1024.0
+            steps[name] = step
+
+        stats = module_stats()
+        report = OrderedDict([
+            ('seconds', total),
+            ('startup', stats.pop('startup', OrderedDict())),
+            ('steps', steps),
+        ])
+
+        # with --workers the caches are filled in the worker processes
+        workers = worker_stats()
+        for process_stats in workers:
+            process_stats = OrderedDict(process_stats)
+            process_stats.pop('startup', None)
+            merge_stats(stats, process_stats)
+        if workers:
+            report['workers'] = len(workers)
+
+        report.update(stats)
+        if self.trace_memory and self.stopped is not None:
+            report['peak_alloc_mb'] = self.peak_memory / 1048576.0
+        return report
+
+    def format_report(self, report):
+        lines = ['total {:.1f}s'.format(report['seconds'])]
+        if 'peak_alloc_mb' in report:
+            lines.append('peak traced memory {:.1f} MB'.format(report['peak_alloc_mb']))
+        for name, step in report['startup'].items():
+            lines.append('startup {}: {:.2f}s ({})'.format(name, step['seconds'], step['source']))
+        for name, step in report['steps'].items():
+            line = '{:<50} {:>10} calls {:>10.1f}s {:>8.3f} ms/call {:>6.1%}'.format(
+                name, step['calls'], step['seconds'], step['mean_ms'], step['share'])
+            if 'peak_alloc_kb' in step:
+                line += ' {:>8.1f} KB'.format(step['peak_alloc_kb'])
+            lines.append(line)
+
+        if 'workers' in report:
+            lines.append('cache statistics summed over this process and {} workers'.format(report['workers']))
+
+        for name, stats in report.get('phrase_caches', {}).items():
+            lines.append('phrase cache {}: {hits} hits, {misses} misses ({hit_rate:.1%})'.format(name, **stats))
+
+        if 'encodings' in report:
+            lines.append('encodings: {values} values, {skipped} skipped, {ftfy_calls} ftfy calls'.format(**report['encodings']))
+
+        for name, caches in report.get('formatter_caches', {}).items():
+            for method, stats in caches.items():
+                lines.append('formatter cache {}.{}: {hits} hits, {misses} misses ({hit_rate:.1%})'.format(name, method, **stats))
+
+        for name, stats in report.get('variants', {}).items():
+            lines.append('variants {}: {derived} derived, {rendered} rendered, {checked} checked, {mismatched} mismatched'.format(name, **stats))
+        return '\n'.join(lines)
+
+    def write_report(self, path):
+        report = self.report()
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(self.format_report(report))
+        print('profile written to {}'.format(path))
+
+
+def create_profiler(enabled=False, trace_memory=False):
+    if not enabled:
+        return NullProfiler()
+    return Profiler(trace_memory=trace_memory)
+
+
+def report_path(args, out_dir, source=None):
+    '''
+    --profile-report, else the default report in out_dir. Every build of a
+    per-source run writes its report into its own directory.
+    '''
+    if args.profile_report and not source:
+        return args.profile_report
+    return os.path.join(out_dir, DEFAULT_REPORT_FILENAME)
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile',
+                        action='store_true',
+                        default=False,
+                        help='Time every formatting step and write a report when done')
+
+    parser.add_argument('--profile-memory',
+                        action='store_true',
+                        default=False,
+                        help='Also record tracemalloc peaks per pipeline stage (slow)')
+
+    parser.add_argument('--profile-report',
+                        metavar='PATH',
+                        help='Where to write the JSON profile, default {} in the output directory'.format(DEFAULT_REPORT_FILENAME))
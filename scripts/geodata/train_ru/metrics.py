@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+'''
+Progress and throughput metrics of a running build.
+
+A Metrics instance counts the records read from the input, the records that
+reached the sink and the rows written. Every interval seconds (checked when
+records are sunk) it takes a snapshot with the average and recent records/sec,
+rows per record, the input position and ETA, the resident memory and the
+queue depths of a threaded pipeline, and writes it as
+
+- a status line on stdout
+- a line of a JSON lines log (--metrics-log)
+- a Prometheus textfile for the node_exporter textfile collector
+  (--metrics-prom), replaced atomically
+
+The input position is the file offset of the open input read from
+/proc/self/fdinfo, which also works for files opened by lxml or gzip (the
+offset is then in compressed bytes, as is the size). Where that is not
+available the ETA is left out, and the memory is left out without the
+resource module (Windows). A build reading several inputs reports the
+progress of each of them, and the ETA from their total size. A per-source
+build labels its metrics with the source and writes its own textfile.
+'''
+
+import json
+import os
+import sys
+import threading
+
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+import six
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_INTERVAL = 10.0
+PROMETHEUS_PREFIX = 'train_ru_'
+
+
+def resident_memory():
+    '''
+    Current RSS in bytes, the peak RSS where /proc is not available, None
+    without the resource module (Windows)
+    '''
+    if resource is None:
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class InputPosition(object):
+    '''
+    Offset of this process' open file descriptor for path
+    '''
+
+    def __init__(self, path):
+        self.name = os.path.basename(path) if path else None
+        self.path = os.path.realpath(path) if path else None
+        self.size = os.path.getsize(path) if path and os.path.isfile(path) else None
+        self.fd = None
+        self.opened = False
+
+    def find_fd(self):
+        try:
+            fds = os.listdir('/proc/self/fd')
+        except OSError:
+            return None
+        for fd in fds:
+            try:
+                if os.readlink(os.path.join('/proc/self/fd', fd)) == self.path:
+                    return fd
+            except OSError:
+                continue
+        return None
+
+    def position(self):
+        if not self.size:
+            return None
+        for attempt in range(2):
+            if self.fd is None:
+                self.fd = self.find_fd()
+                if self.fd is None:
+                    # a file that was open and is closed again has been read
+                    return self.size if self.opened else None
+                self.opened = True
+            try:
+                if os.readlink(os.path.join('/proc/self/fd', self.fd)) == self.path:
+                    with open(os.path.join('/proc/self/fdinfo', self.fd)) as f:
+                        for line in f:
+                            if line.startswith('pos:'):
+                                return int(line.split()[1])
+            except (IOError, OSError, ValueError):
+                pass
+            # the descriptor was closed or reused
+            self.fd = None
+        return None
+
+
+class Metrics(object):
+    '''
+    Collects the counters of one build and exports snapshots of them
+    '''
+
+    def __init__(self, name, input_path=None, interval=DEFAULT_INTERVAL, status=True, log_path=None, prometheus_path=None,
+                 source=None):
+        self.name = name
+        self.source = source
+        if input_path is None or isinstance(input_path, six.string_types):
+            input_path = [input_path]
+        self.inputs = [InputPosition(path) for path in input_path]
+        self.interval = interval
+        self.status = status
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        self.pipeline = None
+
+        self.records_in = 0
+        self.records_out = 0
+        self.rows = 0
+
+        self.started = timer()
+        self.last_time = self.started
+        self.last_records = 0
+        self.lock = threading.Lock()
+
+        self.log = open(log_path, 'a') if log_path else None
+
+    def attach(self, pipeline):
+        '''
+        Reports the queue depths of a threaded pipeline
+        '''
+        self.pipeline = pipeline
+
+    def counted(self, records):
+        '''
+        Wraps the input iterable to count the records read
+        '''
+        for record in records:
+            self.records_in += 1
+            yield record
+
+    def sunk(self, rows):
+        '''
+        Called by the sink with the number of rows written for one record
+        '''
+        self.records_out += 1
+        self.rows += rows
+        if self.interval:
+            now = timer()
+            if now - self.last_time >= self.interval:
+                self.export(now)
+
+    def snapshot(self, now=None):
+        now = now or timer()
+        elapsed = now - self.started
+        window = now - self.last_time
+
+        snapshot = OrderedDict([
+            ('name', self.name),
+            ('source', self.source),
+            ('elapsed', elapsed),
+            ('records_in', self.records_in),
+            ('records_out', self.records_out),
+            ('rows', self.rows),
+            ('rows_per_record', float(self.rows) / self.records_out if self.records_out else 0.0),
+            ('records_per_sec', self.records_out / elapsed if elapsed else 0.0),
+            ('recent_records_per_sec', (self.records_out - self.last_records) / window if window else 0.0),
+        ])
+
+        rss = resident_memory()
+        if rss is not None:
+            snapshot['rss_bytes'] = rss
+
+        positions = [i.position() for i in self.inputs]
+        if len(self.inputs) > 1:
+            snapshot['sources'] = OrderedDict((i.name, float(position) / i.size if position is not None else None)
+                                              for i, position in zip(self.inputs, positions))
+
+        # inputs that are not open yet count as unread, unless none is open
+        size = sum(i.size or 0 for i in self.inputs)
+        if all(i.size for i in self.inputs) and any(position is not None for position in positions):
+            position = sum(position or 0 for position in positions)
+            progress = float(position) / size
+            snapshot['input_bytes'] = position
+            snapshot['input_size'] = size
+            snapshot['progress'] = progress
+            if progress > 0.0:
+                snapshot['eta'] = elapsed * (1.0 - progress) / progress
+
+        if self.pipeline is not None and self.pipeline.queues:
+            snapshot['queues'] = self.pipeline.queue_depths()
+        return snapshot
+
+    def export(self, now=None):
+        with self.lock:
+            now = now or timer()
+            snapshot = self.snapshot(now)
+            self.last_time = now
+            self.last_records = self.records_out
+
+            if self.status:
+                print(self.status_line(snapshot))
+                sys.stdout.flush()
+            if self.log is not None:
+                self.log.write(json.dumps(snapshot) + '\n')
+                self.log.flush()
+            if self.prometheus_path:
+                self.write_prometheus(snapshot)
+
+    def status_line(self, snapshot):
+        line = '{label}: {records_out} records, {rows} rows ({rows_per_record:.1f}/record), ' \
+               '{recent_records_per_sec:.0f} rec/s (avg {records_per_sec:.0f})'.format(label=self.label(), **snapshot)
+        if 'rss_bytes' in snapshot:
+            line += ', RSS {:.0f} MB'.format(snapshot['rss_bytes'] / 1048576.0)
+        if 'progress' in snapshot:
+            line += ', {:.1%} of input'.format(snapshot['progress'])
+        if 'eta' in snapshot:
+            line += ', ETA {}'.format(format_duration(snapshot['eta']))
+        sources = [(name, progress) for name, progress in snapshot.get('sources', {}).items() if progress is not None]
+        if sources:
+            line += ', sources ' + ' '.join('{}={:.0%}'.format(name, progress) for name, progress in sources)
+        if 'queues' in snapshot:
+            line += ', queues ' + ' '.join('{}={}'.format(k, v) for k, v in snapshot['queues'].items())
+        return line
+
+    def label(self):
+        if self.source:
+            return '{}[{}]'.format(self.name, self.source)
+        return self.name
+
+    def labels(self, **extra):
+        labels = [('converter', self.name)]
+        if self.source:
+            labels.append(('source', self.source))
+        labels.extend(sorted(extra.items()))
+        return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+    def prometheus_lines(self, snapshot):
+        labels = self.labels()
+        metrics = [
+            ('records_in_total', 'counter', 'Input records read', snapshot['records_in']),
+            ('records_out_total', 'counter', 'Records written to the output', snapshot['records_out']),
+            ('rows_total', 'counter', 'Rows written to the output', snapshot['rows']),
+            ('records_per_second', 'gauge', 'Records written per second since the last snapshot', snapshot['recent_records_per_sec']),
+            ('elapsed_seconds', 'gauge', 'Seconds since the build started', snapshot['elapsed']),
+        ]
+        if 'rss_bytes' in snapshot:
+            metrics.append(('resident_memory_bytes', 'gauge', 'Resident memory of the build process', snapshot['rss_bytes']))
+        if 'progress' in snapshot:
+            metrics.append(('input_progress_ratio', 'gauge', 'Share of the input read', snapshot['progress']))
+        if 'eta' in snapshot:
+            metrics.append(('eta_seconds', 'gauge', 'Estimated seconds until the input is read', snapshot['eta']))
+
+        lines = []
+        for name, kind, help, value in metrics:
+            name = PROMETHEUS_PREFIX + name
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{}{} {}'.format(name, labels, value))
+
+        if 'queues' in snapshot:
+            name = PROMETHEUS_PREFIX + 'queue_depth'
+            lines.append('# HELP {} Items waiting in front of a pipeline stage'.format(name))
+            lines.append('# TYPE {} gauge'.format(name))
+            for stage, depth in snapshot['queues'].items():
+                lines.append('{}{} {}'.format(name, self.labels(stage=stage), depth))
+
+        if 'sources' in snapshot:
+            name = PROMETHEUS_PREFIX + 'source_progress_ratio'
+            lines.append('# HELP {} Share of an input source read'.format(name))
+            lines.append('# TYPE {} gauge'.format(name))
+            for source, progress in snapshot['sources'].items():
+                if progress is not None:
+                    lines.append('{}{} {}'.format(name, self.labels(input=source), progress))
+        return lines
+
+    def write_prometheus(self, snapshot):
+        tmp_path = self.prometheus_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(self.prometheus_lines(snapshot)) + '\n')
+        os.rename(tmp_path, self.prometheus_path)
+
+    def close(self):
+        '''
+        Exports a last snapshot
+        '''
+        self.export()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def create_metrics(name, input_path=None, options=None):
+    return Metrics(name, input_path=input_path, **(options or {}))
+
+
+def metrics_options(args, source=None):
+    '''
+    Options of create_metrics, for the build of one source of a per-source
+    build when source is given
+    '''
+    prometheus_path = args.metrics_prom
+    if source and prometheus_path:
+        # the textfile collector reads every *.prom file, one per source
+        stem, ext = os.path.splitext(prometheus_path)
+        prometheus_path = '{}.{}{}'.format(stem, source, ext)
+    return {
+        'interval': args.status_interval,
+        'log_path': args.metrics_log,
+        'prometheus_path': prometheus_path,
+        'source': source,
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--status-interval',
+                        type=float,
+                        default=DEFAULT_INTERVAL,
+                        help='Seconds between two progress snapshots, 0 to only report at the end')
+
+    parser.add_argument('--metrics-log',
+                        metavar='PATH',
+                        help='Append progress snapshots to PATH as JSON lines')
+
+    parser.add_argument('--metrics-prom',
+                        metavar='PATH',
+                        help='Keep PATH updated as a Prometheus textfile for node_exporter')
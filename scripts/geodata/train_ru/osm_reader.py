@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+'''
+Address-only OSM reader.
+
+parse_osm builds an OrderedDict of every attribute and tag of every element,
+and normalize_address_components then walks it three times: the alias
+filter, Aliases.replace and the address_formatter_fields filter. This reader
+looks at the <tag> children of each element once, keeps only the keys of a
+precompiled AddressTagTable and yields the address components directly.
+Elements without any address key are skipped.
+
+The table reproduces Aliases.replace: when several keys map to the same
+component the one listed first in the aliases wins, except that a raw tag
+named like its component (OSM "suburb") is kept over every alias of it.
+'''
+
+from lxml import etree
+
+OSM_ELEMENTS = ('node', 'way', 'relation')
+
+# a raw tag already named like its component is never replaced by an alias
+RAW_COMPONENT_PRIORITY = -1
+
+
+class AddressTagTable(object):
+    '''
+    Maps OSM tag keys to (component, priority), built once from an Aliases
+    instance. Only aliases of the given formatter fields are kept. Passthrough
+    keys are carried under their own name.
+    '''
+
+    def __init__(self, aliases, fields, passthrough=()):
+        self.entries = {}
+        for priority, key in enumerate(aliases.aliases):
+            component = aliases.get(key)
+            if component not in fields:
+                continue
+            if key == component:
+                priority = RAW_COMPONENT_PRIORITY
+            self.entries[key] = (component, priority)
+
+        for key in passthrough:
+            self.entries.setdefault(key, (key, RAW_COMPONENT_PRIORITY))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def components(self, tags):
+        '''
+        Address components for an iterable of (key, value) pairs, None if
+        there are none. A repeated key keeps its last value, like parse_osm.
+        '''
+        entries = self.entries
+        best = None
+        for key, value in tags:
+            entry = entries.get(key)
+            if entry is None:
+                continue
+            component, priority = entry
+            if best is None:
+                best = {}
+            current = best.get(component)
+            if current is None or priority <= current[0]:
+                best[component] = (priority, value)
+
+        if best is None:
+            return None
+        return {component: value for component, (priority, value) in best.items()}
+
+
+def parse_osm_address_tags(filename, table):
+    '''
+    Yields the address components of every OSM element that has any
+    '''
+    for _, elem in etree.iterparse(filename, events=('end',), tag=OSM_ELEMENTS):
+        components = table.components((tag.get('k'), tag.get('v')) for tag in elem.iterchildren('tag'))
+
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+        if components:
+            yield components
+
+
+def add_arguments(parser):
+    parser.add_argument('--address-tags-only',
+                        action='store_true',
+                        default=False,
+                        help='Read only the address tags of OSM elements and skip elements without any')
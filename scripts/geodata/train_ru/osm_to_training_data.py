@@ -8,10 +8,10 @@ import os
 
 import csv
 import six
-import ftfy
 import yaml
 
 from collections import OrderedDict
+from functools import partial
 
 from geodata.address_formatting.formatter import AddressFormatter
 from geodata.openaddresses.formatter import OpenAddressesFormatter
@@ -23,7 +23,6 @@ from geodata.addresses.components import AddressComponents
 from geodata.address_formatting.aliases import Aliases
 
 from geodata.address_expansions.gazetteers import *
-from geodata.address_expansions.abbreviations import abbreviate
 
 from geodata.encoding import safe_decode
 from geodata.countries.constants import Countries
@@ -35,17 +34,35 @@ from geodata.osm.extract import *
 
 from geodata.i18n.languages import get_country_languages
 
+from geodata.train_ru import checkpoint, component_store, dedup, incremental, instrumentation, metrics, osm_reader, parallel, pipeline, sampling, sinks, sources, startup
+from geodata.train_ru.component_encodings import fix_component_encodings
+from geodata.train_ru.component_store import ComponentStoreReader, ComponentStoreWriter
+from geodata.train_ru.format_cache import formatter_method_cache, variant_deriver, variant_signature
+from geodata.train_ru.gazetteer_cache import cached_gazetteer
+from geodata.train_ru.incremental import IncrementalRows, formatter_fingerprint
+from geodata.train_ru.instrumentation import NullProfiler
+from geodata.train_ru.osm_reader import AddressTagTable, parse_osm_address_tags
+from geodata.train_ru.pipeline import Pipeline, Stage, formatting_stages
+from geodata.train_ru.sampling import StratifiedSampler
+from geodata.train_ru.sinks import open_sink
+from geodata.train_ru.startup import lazy_state
+
 FORMAT_DATA_TAGGED_FILENAME = "osm_formatted_addresses_tagged.tsv"
 FORMAT_DATA_FILENAME = "osm_formatted_addresses.tsv"
 
 this_dir = os.path.realpath(os.path.dirname(__file__))
 
-csv.register_dialect('csv_no_quote', delimiter=';', quoting=csv.QUOTE_NONE, quotechar='')
+csv.register_dialect('csv_no_quote', delimiter=';', quoting=csv.QUOTE_NONE, quotechar=None)
 
 OSM_PARSER_DATA_DEFAULT_CONFIG = os.path.join(this_dir, os.pardir, os.pardir, os.pardir,
                                               'resources', 'parser', 'data_sets', 'osm.yaml')
 
 
+def parse_osm_values(path):
+    for node_id, value, deps in parse_osm(path):
+        yield value
+
+
 class OSMAddressRUFormatter(object):
     aliases = Aliases(
         OrderedDict([
@@ -133,10 +150,40 @@ class OSMAddressRUFormatter(object):
         u'Российская Федерация',
     ]
 
-    def __init__(self):
-        self.config = yaml.safe_load(open(OSM_PARSER_DATA_DEFAULT_CONFIG))
-        self.formatter = AddressFormatter(scratch_dir=os.environ['TEMP'])
-        self.components = AddressComponents(None, None, None)
+    # raw OSM tags carried from the normalize step to the expand step
+    passthrough_tags = (
+        'addr:city_official_status',
+    )
+
+    # built on first use, or loaded from a startup snapshot
+    snapshot_state = ('config', 'formatter', 'components')
+
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+        if snapshot:
+            startup.restore_snapshot(self, snapshot, self.snapshot_state)
+        self.street_gazetteer = cached_gazetteer(street_and_synonyms_gazetteer, 'street_and_synonyms')
+        self.toponym_gazetteer = cached_gazetteer(toponym_abbreviations_gazetteer, 'toponym_abbreviations')
+        self.address_tags = AddressTagTable(self.aliases, AddressFormatter.address_formatter_fields,
+                                            passthrough=self.passthrough_tags)
+
+    @lazy_state
+    def config(self):
+        return yaml.safe_load(open(OSM_PARSER_DATA_DEFAULT_CONFIG))
+
+    @lazy_state
+    def formatter(self):
+        formatter = AddressFormatter(scratch_dir=os.environ['TEMP'])
+        formatter_method_cache(formatter, 'osm')
+        return formatter
+
+    @lazy_state
+    def components(self):
+        return AddressComponents(None, None, None)
+
+    @property
+    def variants(self):
+        return variant_deriver(self.formatter, 'osm')
 
     component_validators = {
         AddressFormatter.HOUSE_NUMBER: OpenAddressesFormatter.validators.validate_house_number,
@@ -158,6 +205,31 @@ class OSMAddressRUFormatter(object):
 
     exchange_type_position_probability = 0.25
 
+    # steps timed by --profile
+    profiled_component_steps = (
+        'abbreviate_admin_components',
+        'strip_unit_phrases_for_language',
+        'replace_name_affixes',
+        'replace_names',
+        'prune_duplicate_names',
+        'cleanup_house_number',
+        'add_postcode_phrase',
+        'normalize_sub_building_components',
+        'add_house_number_phrase',
+        'drop_invalid_components',
+        'add_genitives',
+        'address_level_dropout_order',
+    )
+
+    profiled_steps = (
+        'added_country',
+        'set_state_altname',
+        'normalized_street_name',
+        'abbreviated_street',
+        'fix_component_encodings',
+        'formatted_places',
+    )
+
     @classmethod
     def cleanup_number(cls, num, strip_commas=False):
         num = num.strip()
@@ -232,29 +304,45 @@ class OSMAddressRUFormatter(object):
         abbreviate_prob = float(nested_get(self.config, ('streets', 'abbreviate_probability'), default=0.0))
         separate_prob = float(nested_get(self.config, ('streets', 'separate_probability'), default=0.0))
 
-        return abbreviate(street_and_synonyms_gazetteer, street, language,
-                          abbreviate_prob=abbreviate_prob, separate_prob=separate_prob)
+        return self.street_gazetteer.abbreviate(street, language,
+                                                abbreviate_prob=abbreviate_prob, separate_prob=separate_prob)
 
     def fix_component_encodings(self, tags):
-        return {k: ftfy.fix_encoding(safe_decode(v)) for k, v in six.iteritems(tags)}
+        return fix_component_encodings(tags)
 
-    def formatted_places(self, address_components, country, language, tag_components=True):
+    def formatted_places(self, address_components, country, language, tag_components=True, variants=None):
+        '''
+        With a variants dict (signature -> formatted address) place component
+        sets that were already formatted for this record are not formatted again
+        '''
         formatted_addresses = []
 
         place_components = self.components.drop_address(address_components)
-        formatted_address = self.formatter.format_address(place_components, country, language=language,
-                                                          tag_components=tag_components, minimal_only=False)
-        formatted_addresses.append(formatted_address)
+        formatted_address = self.formatted_variant(place_components, country, language, tag_components, variants)
+        if formatted_address is not None:
+            formatted_addresses.append(formatted_address)
 
         if AddressFormatter.POSTCODE in address_components:
             drop_postcode_prob = float(nested_get(self.config, ('places', 'drop_postcode_probability'), default=0.0))
             if random.random() < drop_postcode_prob:
                 place_components = self.components.drop_postcode(place_components)
-                formatted_address = self.formatter.format_address(place_components, country, language=language,
-                                                                  tag_components=tag_components, minimal_only=False)
-                formatted_addresses.append(formatted_address)
+                formatted_address = self.formatted_variant(place_components, country, language, tag_components, variants)
+                if formatted_address is not None:
+                    formatted_addresses.append(formatted_address)
         return formatted_addresses
 
+    def formatted_variant(self, components, country, language, tag_components=True, variants=None):
+        if variants is None:
+            return self.formatter.format_address(components, country, language=language,
+                                                 tag_components=tag_components, minimal_only=False)
+
+        signature = variant_signature(components)
+        if signature in variants:
+            return None
+        formatted_address = variants[signature] = self.formatter.format_address(components, country, language=language,
+                                                                                tag_components=tag_components, minimal_only=False)
+        return formatted_address
+
     def formatted_addresses_with_venue_names(self, address_components, venue_names, country, language=None,
                                              tag_components=True, minimal_only=False):
         # Since venue names are only one-per-record, this wrapper will try them all (name, alt_name, etc.)
@@ -269,7 +357,7 @@ class OSMAddressRUFormatter(object):
 
     def components_expanded(self, address_components, country):
 
-        candidate_languages = get_country_languages(country).items()
+        candidate_languages = list(get_country_languages(country).items())
         language = candidate_languages[0][0]
 
         self.added_country(address_components)
@@ -304,12 +392,11 @@ class OSMAddressRUFormatter(object):
 
         return address_components, country, language
 
-    def formatted_addresses(self, tags, tag_components=True):
+    def normalized_components(self, tags):
 
         #osm_components = self.components.osm_reverse_geocoded_components(latitude, longitude)
         osm_components = tags
         #country, candidate_languages = self.components.osm_country_and_languages(osm_components)
-        country = Countries.RUSSIA
 
         #all_local_languages = set([l for l, d in candidate_languages])
 
@@ -336,6 +423,58 @@ class OSMAddressRUFormatter(object):
 
         revised_tags = self.fix_component_encodings(revised_tags)
 
+        # keep the raw tags that the expand step still needs
+        for tag in self.passthrough_tags:
+            value = tags.get(tag)
+            if value:
+                revised_tags[tag] = value
+
+        return revised_tags
+
+    def normalized_address_tags(self, address_tags):
+        '''
+        normalized_components for the records of parse_osm_address_tags,
+        which are already mapped to address components
+        '''
+        tags = {tag: address_tags.pop(tag) for tag in self.passthrough_tags if tag in address_tags}
+
+        revised_tags = self.fix_component_encodings(address_tags)
+
+        for tag, value in six.iteritems(tags):
+            if value:
+                revised_tags[tag] = value
+
+        return revised_tags
+
+    def read_records(self, infile, address_tags_only=False):
+        '''
+        Returns the input records and the normalize step for them, the records
+        of several files merged
+        '''
+        paths = sources.input_paths(infile)
+        if address_tags_only:
+            records = [parse_osm_address_tags(sources.open_source(path), self.address_tags) for path in paths]
+            return sources.merged(records), self.normalized_address_tags
+
+        # parse_osm opens the file by name
+        records = [sources.decompressed(parse_osm_values, path) for path in paths]
+        return sources.merged(records), self.normalized_components
+
+    def record_state(self, record):
+        '''
+        Region of a raw OSM record or of a component record, for sampling
+        '''
+        state = record.get(AddressFormatter.STATE)
+        if state is None:
+            components = self.address_tags.components(six.iteritems(record))
+            state = components.get(AddressFormatter.STATE) if components else None
+        return state
+
+    def expanded_components(self, revised_tags):
+        tags = {tag: revised_tags.pop(tag) for tag in self.passthrough_tags if tag in revised_tags}
+
+        country = Countries.RUSSIA
+
         address_components, country, language = self.components_expanded(revised_tags, country)
 
         #languages = list(country_languages[country])
@@ -364,21 +503,26 @@ class OSMAddressRUFormatter(object):
             #if city_name == address_components.get(AddressFormatter.SUBURB):
             #    address_components.pop(AddressFormatter.SUBURB)
             city_name = self.normalize_city_name(city_name, tags)
-            address_components[AddressFormatter.CITY] = abbreviate(toponym_abbreviations_gazetteer, city_name, language,
-                                                                    abbreviate_prob=self.abbreviate_city_probability)
+            address_components[AddressFormatter.CITY] = self.toponym_gazetteer.abbreviate(city_name, language,
+                                                                                          abbreviate_prob=self.abbreviate_city_probability)
 
         state = address_components.get(AddressFormatter.STATE)
         if state:
-            address_components[AddressFormatter.STATE] = abbreviate(toponym_abbreviations_gazetteer, state, language,
-                                                        abbreviate_prob=self.abbreviate_state_probability)
+            address_components[AddressFormatter.STATE] = self.toponym_gazetteer.abbreviate(state, language,
+                                                                                           abbreviate_prob=self.abbreviate_state_probability)
 
         state_district = address_components.get(AddressFormatter.STATE_DISTRICT)
         if state_district:
-            address_components[AddressFormatter.STATE_DISTRICT] = abbreviate(toponym_abbreviations_gazetteer, state_district, language,
-                                                        abbreviate_prob=self.abbreviate_state_district_probability)
+            address_components[AddressFormatter.STATE_DISTRICT] = self.toponym_gazetteer.abbreviate(state_district, language,
+                                                                                                    abbreviate_prob=self.abbreviate_state_district_probability)
 
         if not address_components:
-            return None, None, None
+            return None
+
+        return address_components, country, language
+
+    def formatted_expanded_addresses(self, expanded, tag_components=True, reuse_variants=False):
+        address_components, country, language = expanded
 
         #venue tra-la-la
         reduced_venue_names = []
@@ -386,6 +530,9 @@ class OSMAddressRUFormatter(object):
         formatted_addresses = self.formatted_addresses_with_venue_names(address_components, reduced_venue_names, country, language=language,
                                                                 tag_components=tag_components, minimal_only=not tag_components)
 
+        if reuse_variants and tag_components:
+            return self.reused_variant_addresses(address_components, country, language, formatted_addresses)
+
         formatted_addresses.extend(self.formatted_places(address_components, country, language))
 
         if tag_components and address_components:
@@ -403,9 +550,111 @@ class OSMAddressRUFormatter(object):
                 formatted_addresses.extend(self.formatted_addresses_with_venue_names(address_components, dropout_venue_names, country, language=language,
                                                                                      tag_components=tag_components, minimal_only=False))
 
-        return OrderedDict.fromkeys(formatted_addresses).keys(), country, language
+        return OrderedDict.fromkeys(formatted_addresses).keys()
 
-    def build_training_data(self, infile, out_dir, tag_components=True):
+    def reused_variant_addresses(self, address_components, country, language, formatted_addresses):
+        '''
+        Tagged variants of one record without formatting a component set twice.
+        Place variants matching a set that was already formatted are skipped, and
+        a dropout variant is derived from the tagged tokens of the previous one
+        by removing the dropped component where the formatter would render the
+        same, see geodata.train_ru.format_cache.VariantDeriver.
+        '''
+        full_components = {c: v for c, v in six.iteritems(address_components) if c != AddressFormatter.HOUSE}
+        variants = {variant_signature(full_components): formatted_addresses[0]}
+
+        formatted_addresses.extend(self.formatted_places(address_components, country, language, variants=variants))
+
+        if address_components:
+            dropout_order = self.components.address_level_dropout_order(address_components, country)
+
+            previous = formatted_addresses[0]
+            for component in dropout_order:
+                if address_components.pop(component, None) is None or component == AddressFormatter.HOUSE:
+                    continue
+
+                components = {c: v for c, v in six.iteritems(address_components) if c != AddressFormatter.HOUSE}
+                signature = variant_signature(components)
+                formatted_address = variants.get(signature)
+                if formatted_address is None:
+                    formatted_address = self.variants.variant(previous, component, components, country, language)
+                    variants[signature] = formatted_address
+                    formatted_addresses.append(formatted_address)
+                previous = formatted_address
+
+        return OrderedDict.fromkeys(formatted_addresses).keys()
+
+    def formatted_addresses(self, tags, tag_components=True):
+        expanded = self.expanded_components(self.normalized_components(tags))
+        if expanded is None:
+            return None, None, None
+
+        address_components, country, language = expanded
+        return self.formatted_expanded_addresses(expanded, tag_components=tag_components), country, language
+
+    def normalized_rows(self, revised_tags, tag_components=True, reuse_variants=False):
+        expanded = self.expanded_components(revised_tags)
+        if expanded is None:
+            return []
+        return self.expanded_rows(expanded, tag_components=tag_components, reuse_variants=reuse_variants)
+
+    def expanded_rows(self, expanded, tag_components=True, reuse_variants=False):
+        address_components, country, language = expanded
+        var_formatted_addresses = self.formatted_expanded_addresses(expanded, tag_components=tag_components,
+                                                                    reuse_variants=reuse_variants)
+        return self.address_rows(var_formatted_addresses, country, language, tag_components=tag_components)
+
+    def address_rows(self, var_formatted_addresses, country, language, tag_components=True):
+        rows = []
+
+        if not var_formatted_addresses:
+            return rows
+
+        for formatted_address in var_formatted_addresses:
+            if formatted_address and formatted_address.strip():
+                formatted_address = tsv_string(formatted_address)
+                if not formatted_address or not formatted_address.strip():
+                    continue
+
+                if tag_components:
+                    row = (language, country, formatted_address)
+                else:
+                    row = (formatted_address,)
+
+                rows.append(row)
+
+        return rows
+
+    def instrument(self, profiler):
+        profiler.instrument(self.components, self.profiled_component_steps, prefix='components.')
+        profiler.instrument(self, self.profiled_steps)
+        profiler.instrument(self.formatter, ('format_address',), prefix='formatter.')
+
+    def component_store_fields(self):
+        return sorted(AddressFormatter.address_formatter_fields) + list(self.passthrough_tags)
+
+    def build_component_store(self, infile, store_path, threaded=False,
+                              queue_size=pipeline.DEFAULT_QUEUE_SIZE, stage_workers=None, address_tags_only=False,
+                              read_ahead=pipeline.DEFAULT_READ_AHEAD):
+        records, normalize = self.read_records(infile, address_tags_only=address_tags_only)
+        records = pipeline.read_ahead(records, read_ahead)
+
+        stage_workers = stage_workers or {}
+        stages = [Stage(pipeline.NORMALIZE, normalize, workers=stage_workers.get(pipeline.NORMALIZE))]
+
+        metadata = {'source': sources.input_key(sources.input_paths(infile))}
+        with ComponentStoreWriter(store_path, self.component_store_fields(), metadata=metadata) as store:
+            Pipeline(records, stages, store, queue_size=queue_size, threaded=threaded).run()
+
+        print('wrote {} records to {}'.format(store.count, store_path))
+
+    def build_training_data(self, infile, out_dir, tag_components=True, workers=1,
+                            batch_size=parallel.DEFAULT_BATCH_SIZE, ordered=False, seed=None,
+                            threaded=False, queue_size=pipeline.DEFAULT_QUEUE_SIZE, stage_workers=None,
+                            from_store=None, profiler=None, checkpoint_every=None, resume=False,
+                            incremental_store=None, sink_options=None, dedup_options=None, address_tags_only=False,
+                            reuse_variants=False, read_ahead=pipeline.DEFAULT_READ_AHEAD, sample_options=None,
+                            metrics_options=None):
         '''
         Creates formatted address training data for supervised sequence labeling (or potentially
         for unsupervised learning e.g. for word vectors) using addr:* tags in OSM.
@@ -433,40 +682,133 @@ class OSMAddressRUFormatter(object):
 
         This may be useful in learning word representations, statistical phrases, morphology
         or other models requiring only the sequence of words.
+
+        With checkpoint_every set, progress is saved every that many records and
+        resume=True continues from the last checkpoint of the output file.
+
+        address_tags_only reads the input with parse_osm_address_tags, which
+        skips elements without address tags altogether.
+
+        reuse_variants formats every component set of a record once and derives
+        the dropout variants from the tagged tokens of the previous variant
+        where the country's template allows it, checking a sample of them
+        against the formatter.
+
+        sample_options (fraction, per_state, seed) restrict the input to a
+        sample stratified by region, see geodata.train_ru.sampling.
+
+        metrics_options (interval, status, log_path, prometheus_path) set where
+        progress snapshots go, see geodata.train_ru.metrics.
+
+        infile is an .osm file or a list of them, also compressed ones, merged
+        into one output, see geodata.train_ru.sources.
         '''
 
+        if dedup_options and (checkpoint_every or resume):
+            raise ValueError('Deduplicated output cannot be checkpointed')
+        pipeline.check_formatting_workers(stage_workers)
+
         if tag_components:
-            formatted_tagged_file = open(os.path.join(out_dir, FORMAT_DATA_TAGGED_FILENAME), 'wb')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
+            out_path = os.path.join(out_dir, FORMAT_DATA_TAGGED_FILENAME)
         else:
-            formatted_tagged_file = open(os.path.join(out_dir, FORMAT_DATA_FILENAME), 'wb')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
+            out_path = os.path.join(out_dir, FORMAT_DATA_FILENAME)
+        sink = open_sink(out_path, append=resume, **(sink_options or {}))
 
-        i = 0
+        # rows already written for an earlier record are dropped before the sink
+        deduplicator = dedup.open_deduplicator(out_path, **dedup_options) if dedup_options else None
 
-        for node_id, value, deps in parse_osm(infile):
-            var_formatted_addresses, country, language = self.formatted_addresses(value, tag_components=tag_components)
-            if not var_formatted_addresses:
-                continue
+        progress = {'records': 0}
+        paths = sources.input_paths(infile)
+        monitor = metrics.create_metrics('osm', from_store or paths, metrics_options)
 
-            for formatted_address in var_formatted_addresses:
-                if formatted_address and formatted_address.strip():
-                    formatted_address = tsv_string(formatted_address)
-                    if not formatted_address or not formatted_address.strip():
-                        continue
+        def write_rows(rows):
+            if deduplicator is not None:
+                rows = deduplicator(rows)
+            monitor.sunk(len(rows))
+            if not rows:
+                return
 
-                    if tag_components:
-                        row = (language, country, formatted_address)
-                    else:
-                        row = (formatted_address,)
-
-                    writer.writerow(row)
+            sink(rows)
 
-            i += 1
+            i = progress['records'] = progress['records'] + 1
             if i % 1000 == 0 and i > 0:
-                formatted_tagged_file.flush()
-                print('did {} formatted addresses'.format(i))
-                #break
+                sink.flush()
+
+        if from_store:
+            records = ComponentStoreReader(from_store)
+            normalize = None
+        else:
+            records, normalize = self.read_records(paths, address_tags_only=address_tags_only)
+        records = monitor.counted(records)
+
+        sampler = StratifiedSampler(self.record_state, **sample_options) if sample_options else None
+        if sampler is not None:
+            records = sampler(records)
+
+        checkpointer, skip = checkpoint.resumable(sink, checkpoint=bool(checkpoint_every), resume=resume,
+                                                  every=checkpoint_every or checkpoint.DEFAULT_CHECKPOINT_INTERVAL,
+                                                  params={'input': from_store or sources.input_key(paths), 'seed': seed,
+                                                          'batch_size': batch_size, 'tag_components': tag_components,
+                                                          'address_tags_only': address_tags_only and not from_store,
+                                                          'reuse_variants': reuse_variants, 'sample': sample_options},
+                                                  batch_size=batch_size if seed is not None else None)
+        if checkpointer is not None:
+            # checkpoints need every record before the saved position to be written
+            ordered = True
+            records = checkpoint.skip_records(records, skip)
+        records = pipeline.read_ahead(records, read_ahead)
+
+        profiler = profiler or NullProfiler()
+        self.instrument(profiler)
+        # worker processes normalize the raw records on their own instances
+        pooled_normalize = parallel.WorkerMethod(normalize.__name__) if normalize is not None else None
+        if normalize is not None:
+            normalize = profiler.wrap(pipeline.NORMALIZE, normalize, memory=True)
+
+        if incremental_store:
+            # unchanged records reuse their stored rows, new ones are formatted
+            # in this process with the RNG seeded per record
+            stored_rows = IncrementalRows(incremental_store, partial(self.normalized_rows, tag_components=tag_components,
+                                                                     reuse_variants=reuse_variants),
+                                          formatter_fingerprint(self, seed=seed, tag_components=tag_components,
+                                                                reuse_variants=reuse_variants))
+            stages = [Stage(pipeline.NORMALIZE, normalize, workers=(stage_workers or {}).get(pipeline.NORMALIZE))] if normalize else []
+            stages.append(Stage(pipeline.FORMAT, profiler.wrap(pipeline.FORMAT, stored_rows, memory=True)))
+        else:
+            stored_rows = None
+            stages = formatting_stages(self, normalize,
+                                       profiler.wrap(pipeline.EXPAND, self.expanded_components, memory=True),
+                                       profiler.wrap(pipeline.FORMAT, self.expanded_rows, memory=True),
+                                       'normalized_rows', stage_workers=stage_workers, workers=workers,
+                                       batch_size=batch_size, ordered=ordered, seed=seed, start_batch=skip // batch_size,
+                                       pooled_normalize=pooled_normalize, tag_components=tag_components,
+                                       reuse_variants=reuse_variants)
+
+        completed = False
+        profiler.start()
+        try:
+            with sink:
+                p = Pipeline(records, stages, profiler.wrap(pipeline.SINK, write_rows, memory=True),
+                             queue_size=queue_size, ordered=ordered, threaded=threaded, progress=checkpointer)
+                monitor.attach(p)
+                p.run()
+            completed = True
+        finally:
+            profiler.stop()
+            monitor.close()
+            if stored_rows is not None:
+                # a resumed run has not seen the skipped records, so it cannot tell what was deleted
+                stored_rows.close(purge=completed and not skip)
+                print('incremental: {reused} records reused, {formatted} formatted, {deleted} deleted'.format(**stored_rows.stats()))
+            if deduplicator is not None:
+                deduplicator.close()
+                deduplicator.report()
+
+        if sampler is not None:
+            sampler.report()
+
+        if checkpointer is not None:
+            checkpointer.finish()
 
         print("KONEC")
 
@@ -494,10 +836,58 @@ if __name__ == '__main__':
                         default=os.getcwd(),
                         help='Output directory')
 
+    parser.add_argument('--reuse-variants',
+                        action='store_true',
+                        default=False,
+                        help='Derive dropout variants of plain template components from the previous tagged variant instead of formatting each one')
+
+    parallel.add_arguments(parser)
+    pipeline.add_arguments(parser)
+    component_store.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    checkpoint.add_arguments(parser)
+    incremental.add_arguments(parser)
+    sinks.add_arguments(parser)
+    startup.add_arguments(parser)
+    dedup.add_arguments(parser)
+    osm_reader.add_arguments(parser)
+    sampling.add_arguments(parser)
+    metrics.add_arguments(parser)
+    sources.add_arguments(parser)
+
     args = parser.parse_args()
+    sources.check_arguments(parser, args)
 
-    if args.csv_osm_file and args.format:
+    inputs = sources.input_paths(args.csv_osm_file, args.sources)
+
+    def build(infile, out_dir, source=None):
+        ru_formatter = OSMAddressRUFormatter(snapshot=args.snapshot)
+        profiler = instrumentation.create_profiler(args.profile, trace_memory=args.profile_memory)
+        try:
+            ru_formatter.build_training_data(infile, out_dir, tag_components=not args.untagged,
+                                             workers=args.workers, batch_size=args.batch_size,
+                                             ordered=args.ordered, seed=args.seed, threaded=args.pipeline,
+                                             queue_size=args.queue_size, stage_workers=args.stage_workers,
+                                             from_store=args.from_store, profiler=profiler,
+                                             checkpoint_every=checkpoint.checkpoint_every(args),
+                                             resume=args.resume, incremental_store=args.incremental,
+                                             sink_options=sinks.sink_options(args),
+                                             dedup_options=dedup.dedup_options(args),
+                                             address_tags_only=args.address_tags_only,
+                                             reuse_variants=args.reuse_variants, read_ahead=args.read_ahead,
+                                             sample_options=sampling.sample_options(args),
+                                             metrics_options=metrics.metrics_options(args, source=source))
+        finally:
+            profiler.write_report(instrumentation.report_path(args, out_dir, source=source))
+
+    if inputs and args.ingest:
         ru_formatter = OSMAddressRUFormatter()
-        ru_formatter.build_training_data(args.csv_osm_file, args.out_dir, tag_components=not args.untagged)
+        ru_formatter.build_component_store(inputs, args.ingest, threaded=args.pipeline,
+                                           queue_size=args.queue_size, stage_workers=args.stage_workers,
+                                           address_tags_only=args.address_tags_only, read_ahead=args.read_ahead)
+    elif inputs and args.format and args.per_source:
+        sources.run_per_source(build, inputs, args.out_dir, processes=args.source_processes)
+    elif (inputs or args.from_store) and args.format:
+        build(inputs, args.out_dir)
     else:
         print(parser.format_usage())
\ No newline at end of file
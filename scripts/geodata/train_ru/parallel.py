@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import random
+
+from collections import OrderedDict, deque
+
+from geodata.train_ru.instrumentation import module_stats
+
+DEFAULT_BATCH_SIZE = 200
+PENDING_BATCHES_PER_WORKER = 2
+POLL_INTERVAL = 0.01
+
+_worker_formatter = None
+_worker_seed = None
+
+# cache statistics last reported by each worker process, by pid
+_worker_stats = OrderedDict()
+
+
+def worker_stats():
+    return list(_worker_stats.values())
+
+
+class WorkerMethod(object):
+    '''
+    A formatter method called by name on the formatter of the process it runs
+    in, so a worker can run it on its own instance. With batches=True the
+    method takes the list of records and returns one result per record.
+    '''
+
+    def __init__(self, name, batches=False, **kwargs):
+        self.name = name
+        self.batches = batches
+        self.kwargs = kwargs
+
+    def __call__(self, formatter, records):
+        method = getattr(formatter, self.name)
+        if not self.batches:
+            return [method(record, **self.kwargs) if record is not None else None for record in records]
+
+        present = [i for i, record in enumerate(records) if record is not None]
+        results = [None] * len(records)
+        for i, result in zip(present, method([records[i] for i in present], **self.kwargs)):
+            results[i] = result
+        return results
+
+
+def _init_worker(formatter_cls, seed, snapshot=None):
+    global _worker_formatter, _worker_seed
+    _worker_formatter = formatter_cls(snapshot=snapshot) if snapshot else formatter_cls()
+    _worker_seed = seed
+    if seed is None:
+        # Python 2 does not reseed after fork, every worker would draw the
+        # parent's sequence
+        random.seed()
+
+
+def _format_batch(task):
+    batch_index, method, records, kwargs, normalize = task
+    results = format_batch(_worker_formatter, batch_index, method, records, kwargs, seed=_worker_seed,
+                           normalize=normalize)
+    # the worker's caches are reported along with every batch, the parent
+    # keeps the last ones of each worker for the --profile report
+    return os.getpid(), module_stats(), results
+
+
+def format_batch(formatter, batch_index, method, records, kwargs, seed=None, normalize=None):
+    '''
+    Formats one batch of records, after normalizing the raw records with the
+    WorkerMethod normalize if given. When a seed is given the RNG is reset per
+    batch, so the rows of a batch do not depend on which process formatted it.
+    None records (dropped by an earlier step or by normalize) keep their place
+    and give None.
+    '''
+    if seed is not None:
+        random.seed(seed + batch_index)
+    if normalize is not None:
+        records = normalize(formatter, records)
+    format_record = getattr(formatter, method)
+    return [format_record(record, **kwargs) if record is not None else None for record in records]
+
+
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ParallelFormatter(object):
+    '''
+    Maps a formatter method over parsed records using a pool of worker processes.
+    With a WorkerMethod normalize the records are raw input records, which the
+    workers normalize before formatting them, so the parent only reads input.
+
+    Every worker builds its own formatter instance (and so its own AddressFormatter
+    and AddressComponents, unless it loads them from the formatter's startup
+    snapshot), records are sent in batches to amortize pickling, and at most a
+    few batches per worker are in flight so memory stays bounded on
+    country-sized inputs. Results are yielded per input record.
+
+    start_batch numbers the first batch, so a resumed run that skipped
+    start_batch * batch_size records reseeds its batches like the full run did.
+    '''
+
+    def __init__(self, formatter, method, workers=1, batch_size=DEFAULT_BATCH_SIZE,
+                 ordered=False, seed=None, start_batch=0, normalize=None, **kwargs):
+        self.formatter = formatter
+        self.method = method
+        self.normalize = normalize
+        self.workers = max(int(workers or 1), 1)
+        self.batch_size = max(int(batch_size or DEFAULT_BATCH_SIZE), 1)
+        self.ordered = ordered
+        self.seed = seed
+        self.start_batch = start_batch
+        self.kwargs = kwargs
+
+    def imap(self, records):
+        # the workers of an earlier run are gone, only report those of this one
+        _worker_stats.clear()
+        if self.workers == 1:
+            return self.imap_serial(records)
+        return self.imap_pool(records)
+
+    def imap_serial(self, records):
+        for batch_index, batch in enumerate(batched(records, self.batch_size), self.start_batch):
+            for result in format_batch(self.formatter, batch_index, self.method, batch, self.kwargs, seed=self.seed,
+                                       normalize=self.normalize):
+                yield result
+
+    def imap_pool(self, records):
+        pool = multiprocessing.Pool(self.workers, initializer=_init_worker,
+                                    initargs=(type(self.formatter), self.seed, getattr(self.formatter, 'snapshot', None)))
+        max_pending = self.workers * PENDING_BATCHES_PER_WORKER
+        pending = deque()
+
+        try:
+            for batch_index, batch in enumerate(batched(records, self.batch_size), self.start_batch):
+                task = (batch_index, self.method, batch, self.kwargs, self.normalize)
+                pending.append(pool.apply_async(_format_batch, (task,)))
+
+                while len(pending) >= max_pending:
+                    for result in self.completed(pending):
+                        yield result
+
+            while pending:
+                for result in self.completed(pending):
+                    yield result
+
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def completed(self, pending):
+        '''
+        Pops finished batches off the pending queue. In ordered mode only the oldest
+        batch may be returned, otherwise any batch that is ready.
+        '''
+        if self.ordered:
+            batch_results = [pending.popleft().get()]
+        else:
+            pending[0].wait(POLL_INTERVAL)
+            ready = [r for r in pending if r.ready()]
+            for r in ready:
+                pending.remove(r)
+            batch_results = [r.get() for r in ready]
+
+        for pid, stats, batch_result in batch_results:
+            _worker_stats[pid] = stats
+            for result in batch_result:
+                yield result
+
+
+def add_arguments(parser):
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes formatting records')
+
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help='Records per batch sent to a worker')
+
+    parser.add_argument('--ordered',
+                        action='store_true',
+                        default=False,
+                        help='Keep output rows in input order when using several workers')
+
+    parser.add_argument('--seed',
+                        type=int,
+                        default=None,
+                        help='Seed the RNG per batch so the rows do not depend on the number of workers (their order only with --ordered)')
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+
+from collections import OrderedDict, deque
+
+import six
+from six.moves import queue
+
+from functools import partial
+
+from geodata.train_ru.parallel import DEFAULT_BATCH_SIZE, ParallelFormatter
+
+DEFAULT_QUEUE_SIZE = 1000
+QUEUE_TIMEOUT = 0.1
+
+DEFAULT_READ_AHEAD = 0
+READ_AHEAD_CHUNK_SIZE = 256
+
+SOURCE = 'source'
+NORMALIZE = 'normalize'
+EXPAND = 'expand'
+FORMAT = 'format'
+SINK = 'sink'
+
+_STOP = object()
+_DROPPED = object()
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class Stage(object):
+    '''
+    A stage maps one item to one item. Returning None drops the item.
+    Stages with more than one worker run their function on several threads,
+    so the function must not depend on the order items arrive in.
+    '''
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(int(workers or 1), 1)
+
+    def iterate(self, items):
+        func = self.func
+        for seq, value in items:
+            if value is not _DROPPED:
+                value = func(value)
+            yield seq, value if value is not None else _DROPPED
+
+    def start(self, pipeline, in_queue, out_queue, downstream_workers):
+        self.remaining = self.workers
+        self.lock = threading.Lock()
+        return [pipeline.thread('{}-{}'.format(self.name, i), self.work,
+                                pipeline, in_queue, out_queue, downstream_workers)
+                for i in range(self.workers)]
+
+    def work(self, pipeline, in_queue, out_queue, downstream_workers):
+        func = self.func
+        while True:
+            item = pipeline.get(in_queue)
+            if item is _STOP:
+                break
+            seq, value = item
+            if value is not _DROPPED:
+                value = func(value)
+            pipeline.put(out_queue, (seq, value if value is not None else _DROPPED))
+
+        with self.lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+
+        if last:
+            for i in range(downstream_workers):
+                pipeline.put(out_queue, _STOP)
+
+
+class IteratorStage(Stage):
+    '''
+    A stage whose function takes the whole stream of items and returns an
+    iterator over the results, e.g. a ParallelFormatter backed by a process pool.
+    The function must return exactly one result per item, in input order.
+    Items dropped upstream are passed in as None and must come back as None, so
+    the n-th value the function sees is always the n-th source item. An
+    unordered ParallelFormatter returns the records' results in the order they
+    complete, which is only used when the position of a record does not matter
+    (no checkpoints).
+    '''
+
+    def __init__(self, name, func):
+        super(IteratorStage, self).__init__(name, func, workers=1)
+
+    def iterate(self, items):
+        seqs = deque()
+
+        def values():
+            for seq, value in items:
+                seqs.append(seq)
+                yield value if value is not _DROPPED else None
+
+        for value in self.func(values()):
+            yield seqs.popleft(), value if value is not None else _DROPPED
+
+    def work(self, pipeline, in_queue, out_queue, downstream_workers):
+        seqs = deque()
+
+        def values():
+            while True:
+                item = pipeline.get(in_queue)
+                if item is _STOP:
+                    return
+                seq, value = item
+                seqs.append(seq)
+                yield value if value is not _DROPPED else None
+
+        for value in self.func(values()):
+            pipeline.put(out_queue, (seqs.popleft(), value if value is not None else _DROPPED))
+
+        for i in range(downstream_workers):
+            pipeline.put(out_queue, _STOP)
+
+
+class ReadAhead(object):
+    '''
+    Iterates a source on a background thread, keeping up to buffer_size items
+    read ahead of the consumer. Decompression, file reads and XML/CSV parsing
+    of the source then overlap with the work on the consumer's thread. Items
+    are handed over in chunks to keep the queue overhead per item low, and an
+    error raised by the source is raised again by the consumer.
+    '''
+
+    def __init__(self, source, buffer_size, chunk_size=READ_AHEAD_CHUNK_SIZE):
+        self.source = source
+        self.chunk_size = max(min(chunk_size, buffer_size), 1)
+        self.queue = queue.Queue(max(buffer_size // self.chunk_size, 1))
+        self.closed = threading.Event()
+        self.error = None
+
+    def read(self):
+        try:
+            chunk = []
+            for item in self.source:
+                chunk.append(item)
+                if len(chunk) >= self.chunk_size:
+                    if not self.put(chunk):
+                        return
+                    chunk = []
+            if chunk:
+                self.put(chunk)
+        except BaseException:
+            self.error = sys.exc_info()
+        self.put(_STOP)
+
+    def put(self, item):
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        t = threading.Thread(name='read-ahead', target=self.read)
+        t.daemon = True
+        t.start()
+
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is _STOP:
+                    break
+                for item in chunk:
+                    yield item
+        finally:
+            # stops the reader when the consumer gives up early
+            self.closed.set()
+
+        if self.error is not None:
+            six.reraise(*self.error)
+
+
+def read_ahead(source, buffer_size=DEFAULT_READ_AHEAD):
+    if not buffer_size:
+        return source
+    return ReadAhead(source, buffer_size)
+
+
+class Pipeline(object):
+    '''
+    Streams items from a source iterable through a list of stages into a sink.
+
+    In threaded mode the source and every stage run on their own threads and
+    are joined by bounded queues, so slow reading or writing overlaps with the
+    formatting work instead of stalling it. The sink runs on the calling thread.
+    With ordered=True the sink sees items in source order even when a stage
+    has several workers.
+
+    progress, if given, is called on the sink's thread with the number of
+    source items that have been completely handled (sunk or dropped), in
+    source order. It is only called in serial or ordered mode.
+    '''
+
+    def __init__(self, source, stages, sink, queue_size=DEFAULT_QUEUE_SIZE, ordered=True, threaded=True,
+                 progress=None):
+        self.source = source
+        self.stages = stages
+        self.sink = sink
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.threaded = threaded
+        self.progress = progress
+
+        self.queues = []
+        self.failed = threading.Event()
+        self.errors = []
+
+    def run(self):
+        if self.threaded:
+            return self.run_threaded()
+        return self.run_serial()
+
+    def run_serial(self):
+        items = enumerate(self.source)
+        for stage in self.stages:
+            items = stage.iterate(items)
+
+        sink = self.sink
+        progress = self.progress
+        n = 0
+        for seq, value in items:
+            if value is not _DROPPED:
+                sink(value)
+                n += 1
+            if progress is not None:
+                progress(seq + 1)
+        return n
+
+    def queue_depths(self):
+        names = [SOURCE] + [stage.name for stage in self.stages]
+        return OrderedDict((name, q.qsize()) for name, q in zip(names, self.queues))
+
+    def thread(self, name, target, *args):
+        def run():
+            try:
+                target(*args)
+            except PipelineAborted:
+                pass
+            except BaseException:
+                self.errors.append(sys.exc_info())
+                self.failed.set()
+
+        t = threading.Thread(name=name, target=run)
+        t.daemon = True
+        return t
+
+    def put(self, q, item):
+        while True:
+            if self.failed.is_set():
+                raise PipelineAborted()
+            try:
+                q.put(item, timeout=QUEUE_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, q):
+        while True:
+            if self.failed.is_set():
+                raise PipelineAborted()
+            try:
+                return q.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                continue
+
+    def read_source(self, out_queue, downstream_workers):
+        for seq, value in enumerate(self.source):
+            self.put(out_queue, (seq, value))
+
+        for i in range(downstream_workers):
+            self.put(out_queue, _STOP)
+
+    def run_threaded(self):
+        self.queues = [queue.Queue(self.queue_size) for i in range(len(self.stages) + 1)]
+
+        downstream = [stage.workers for stage in self.stages] + [1]
+        threads = [self.thread(SOURCE, self.read_source, self.queues[0], downstream[0])]
+        for i, stage in enumerate(self.stages):
+            threads.extend(stage.start(self, self.queues[i], self.queues[i + 1], downstream[i + 1]))
+
+        for t in threads:
+            t.start()
+
+        try:
+            n = self.drain(self.queues[-1])
+        except PipelineAborted:
+            n = None
+        except BaseException:
+            self.failed.set()
+            raise
+        finally:
+            for t in threads:
+                t.join()
+
+        if self.errors:
+            six.reraise(*self.errors[0])
+        return n
+
+    def drain(self, in_queue):
+        sink = self.sink
+        ordered = self.ordered
+        progress = self.progress
+        pending = {}
+        next_seq = 0
+        n = 0
+
+        while True:
+            item = self.get(in_queue)
+            if item is _STOP:
+                break
+
+            seq, value = item
+            if not ordered:
+                if value is not _DROPPED:
+                    sink(value)
+                    n += 1
+                continue
+
+            pending[seq] = value
+            while next_seq in pending:
+                value = pending.pop(next_seq)
+                next_seq += 1
+                if value is not _DROPPED:
+                    sink(value)
+                    n += 1
+                if progress is not None:
+                    progress(next_seq)
+
+        return n
+
+
+def normalize_stage(normalize, stage_workers=None):
+    '''
+    The normalize stage for a normalize function, or normalize itself if it
+    already is a Stage
+    '''
+    if isinstance(normalize, Stage):
+        return normalize
+    return Stage(NORMALIZE, normalize, workers=(stage_workers or {}).get(NORMALIZE))
+
+
+def check_formatting_workers(stage_workers):
+    '''
+    Raises ValueError if the expand or format stage of a training data builder
+    is given more than one thread
+    '''
+    for name in (EXPAND, FORMAT):
+        if ((stage_workers or {}).get(name) or 1) > 1:
+            raise ValueError('The {} stage draws random numbers and runs on one thread, '
+                             'use --workers for parallel formatting'.format(name))
+
+
+def formatting_stages(formatter, normalize, expand, format, pooled_method, stage_workers=None,
+                      workers=1, batch_size=DEFAULT_BATCH_SIZE, ordered=True, seed=None, start_batch=0,
+                      pooled_normalize=None, **kwargs):
+    '''
+    Builds the normalize -> expand -> format stages for a formatter. The expand and
+    format steps draw random numbers, so with worker processes or a fixed seed they
+    run together as one stage through a ParallelFormatter calling pooled_method.
+    normalize may be None when the source already yields normalized components,
+    or a Stage of its own. pooled_normalize, a parallel.WorkerMethod doing the
+    same as normalize, moves normalizing into that ParallelFormatter, so the
+    workers get the raw records. With ordered=False the worker processes hand
+    back batches as soon as they are done.
+
+    Threads would share the random state and draw from it in no fixed order,
+    so expand and format only take one worker each, --workers runs them in
+    parallel instead.
+    '''
+    stage_workers = stage_workers or {}
+    check_formatting_workers(stage_workers)
+
+    pooled = workers > 1 or seed is not None
+    if normalize is None or not pooled:
+        pooled_normalize = None
+
+    stages = []
+    if normalize is not None and pooled_normalize is None:
+        stages.append(normalize_stage(normalize, stage_workers))
+
+    if pooled:
+        pool = ParallelFormatter(formatter, pooled_method, workers=workers, batch_size=batch_size,
+                                 ordered=ordered, seed=seed, start_batch=start_batch,
+                                 normalize=pooled_normalize, **kwargs)
+        stages.append(IteratorStage(FORMAT, pool.imap))
+    else:
+        stages.append(Stage(EXPAND, expand, workers=stage_workers.get(EXPAND)))
+        stages.append(Stage(FORMAT, partial(format, **kwargs), workers=stage_workers.get(FORMAT)))
+
+    return stages
+
+
+def parse_stage_workers(spec):
+    '''
+    Parses a per-stage concurrency setting like "normalize=2,format=4".
+    '''
+    workers = {}
+    if not spec:
+        return workers
+
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, sep, value = part.partition('=')
+        if not sep:
+            raise ValueError('Stage workers must look like name=N, got {!r}'.format(part))
+        workers[name.strip()] = int(value)
+    return workers
+
+
+def add_arguments(parser):
+    parser.add_argument('--pipeline',
+                        action='store_true',
+                        default=False,
+                        help='Run source, stages and sink on separate threads joined by bounded queues')
+
+    parser.add_argument('--queue-size',
+                        type=int,
+                        default=DEFAULT_QUEUE_SIZE,
+                        help='Maximum number of records buffered between two pipeline stages')
+
+    parser.add_argument('--stage-workers',
+                        type=parse_stage_workers,
+                        default={},
+                        help='Threads per pipeline stage, e.g. normalize=2 (the training data builders run expand and format with --workers)')
+
+    parser.add_argument('--read-ahead',
+                        type=int,
+                        default=DEFAULT_READ_AHEAD,
+                        help='Read up to this many input records ahead on a background thread')
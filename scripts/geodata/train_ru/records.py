@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+'''
+Compact fixed-schema records for the reader-to-writer path.
+
+A dict per record costs a hash table of its own, and the converters used to
+build three of them for every input record (the reader's, the normalized
+components and the copy made by fix_component_encodings). A Record subclass
+declares its fields once as __slots__, so an instance is a fixed array of
+references without a __dict__, and is updated in place along the pipeline.
+
+Records behave like the dicts they replace: a field holding None is absent,
+so get, in, len, keys, items and pop see only the fields that are set. Fields
+can also be read by their position in the schema, like the reader's
+index-keyed dicts. Subclasses are defined at module level so they pickle to
+worker processes.
+
+Values of the high-repeat columns (regions, cities) are passed through an
+Interner, so millions of records share one string per distinct value.
+'''
+
+from operator import attrgetter
+
+import six
+
+DEFAULT_INTERN_SIZE = 100000
+
+
+def values_getter(fields):
+    '''
+    Function returning the tuple of the given attributes of an object
+    '''
+    if len(fields) == 1:
+        get = attrgetter(fields[0])
+        return lambda obj: (get(obj),)
+    if not fields:
+        return lambda obj: ()
+    return attrgetter(*fields)
+
+
+class RecordType(type):
+    '''
+    Builds __slots__ and the key lookup table of a Record subclass from its
+    fields, so that subclasses only declare fields
+    '''
+
+    def __new__(mcs, name, bases, namespace):
+        fields = namespace.get('fields')
+        if fields is not None:
+            fields = namespace['fields'] = tuple(fields)
+            namespace['__slots__'] = fields
+            names = {field: field for field in fields}
+            names.update(enumerate(fields))
+            namespace['names'] = names
+            namespace['field_values'] = staticmethod(values_getter(fields))
+        else:
+            namespace.setdefault('__slots__', ())
+        return super(RecordType, mcs).__new__(mcs, name, bases, namespace)
+
+
+@six.add_metaclass(RecordType)
+class Record(object):
+    '''
+    Base class of slotted records, a field holding None is absent
+    '''
+
+    fields = ()
+
+    def __init__(self, values=None):
+        for name in self.fields:
+            setattr(self, name, None)
+        if values:
+            for key, value in six.iteritems(values):
+                self[key] = value
+
+    def get(self, key, default=None):
+        name = self.names.get(key)
+        if name is None:
+            return default
+        value = getattr(self, name)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        # an unknown field raises KeyError
+        setattr(self, self.names[key], value)
+
+    def __delitem__(self, key):
+        if self.pop(key, None) is None:
+            raise KeyError(key)
+
+    def pop(self, key, *default):
+        value = self.get(key)
+        if value is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        setattr(self, self.names[key], None)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return sum(1 for value in self.field_values(self) if value is not None)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [name for name, value in zip(self.fields, self.field_values(self)) if value is not None]
+
+    def items(self):
+        return [(name, value) for name, value in zip(self.fields, self.field_values(self)) if value is not None]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def values(self):
+        return [value for value in self.field_values(self) if value is not None]
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def as_tuple(self, default=None):
+        '''
+        Values of all fields in schema order, default for the absent ones
+        '''
+        return tuple(default if value is None else value for value in self.field_values(self))
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.field_values(self)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.fields, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.as_dict())
+
+
+class Interner(object):
+    '''
+    Maps equal values to one shared instance. Once max_size distinct values
+    are held new ones are returned as they are, so a column that turns out to
+    be unique cannot grow the table without bound.
+    '''
+
+    def __init__(self, max_size=DEFAULT_INTERN_SIZE):
+        self.max_size = max_size
+        self.table = {}
+
+    def __call__(self, value):
+        if value is None:
+            return None
+        interned = self.table.get(value)
+        if interned is not None:
+            return interned
+        if len(self.table) < self.max_size:
+            self.table[value] = value
+        return value
+
+    def __len__(self):
+        return len(self.table)
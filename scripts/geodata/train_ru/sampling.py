@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+'''
+Sampling of input records for development runs.
+
+--sample 0.01 (or 1%) is a systematic sample per region: the first record of
+every region and then every 100th record of it, so each region keeps its
+share of the input, rounded up, and small regions are not lost. It streams
+and does not draw random numbers. --sample-per-state N keeps a uniform sample
+of at most N records of every region, by reservoir sampling per region in one
+pass; the sample is only emitted once the input is exhausted, in input order.
+
+Regions are read from the raw records, so the records that are dropped are
+never normalized or formatted. The reservoir sampler draws from its own
+random.Random, seeded with --sample-seed, so the sample is the same whatever
+--seed the formatting uses and does not shift the formatters' random numbers.
+'''
+
+import math
+import random
+
+from collections import OrderedDict
+
+DEFAULT_SAMPLE_SEED = 0
+
+UNKNOWN_STATE = u''
+
+# absorbs float error in seen * fraction, e.g. 100 * 0.07 == 7.000000000000001
+FRACTION_EPSILON = 1e-9
+
+
+def parse_fraction(value):
+    '''
+    Parses a sampling fraction like 0.01 or 1%
+    '''
+    value = value.strip()
+    if value.endswith('%'):
+        fraction = float(value[:-1]) / 100.0
+    else:
+        fraction = float(value)
+    if not 0.0 < fraction <= 1.0:
+        raise ValueError('Sample fraction must be in (0, 1], got {!r}'.format(value))
+    return fraction
+
+
+def field_getter(index):
+    '''
+    Key function for records that are lists or dicts indexed by column or
+    component name
+    '''
+    def get(record):
+        try:
+            return record[index]
+        except (IndexError, KeyError):
+            return None
+    return get
+
+
+class StratifiedSampler(object):
+    '''
+    Samples an iterable of records by the region returned by key(record),
+    either a fraction of all records or at most per_state records per region.
+    The per-state quota takes precedence when both are given.
+    '''
+
+    def __init__(self, key, fraction=None, per_state=None, seed=DEFAULT_SAMPLE_SEED):
+        if not (fraction or per_state):
+            raise ValueError('Either a sample fraction or a per-state quota is needed')
+        self.key = key
+        self.fraction = fraction
+        self.per_state = per_state
+        self.random = random.Random(seed)
+
+        self.seen = OrderedDict()
+        self.sampled = OrderedDict()
+
+    def state(self, record):
+        return self.key(record) or UNKNOWN_STATE
+
+    def count(self, counts, state):
+        counts[state] = counts.get(state, 0) + 1
+
+    def __call__(self, records):
+        if self.per_state:
+            return self.reservoir(records)
+        return self.systematic(records)
+
+    def systematic(self, records):
+        # keeps a record whenever the region's sample falls behind
+        # ceil(seen * fraction), i.e. its first record and then one record
+        # per 1 / fraction records of the region
+        fraction = self.fraction
+        seen = self.seen
+        sampled = self.sampled
+        for record in records:
+            state = self.state(record)
+            self.count(seen, state)
+            kept = sampled.get(state, 0)
+            if kept < math.ceil(seen[state] * fraction - FRACTION_EPSILON):
+                sampled[state] = kept + 1
+                yield record
+
+    def reservoir(self, records):
+        per_state = self.per_state
+        randint = self.random.randint
+        reservoirs = {}
+
+        for i, record in enumerate(records):
+            state = self.state(record)
+            self.count(self.seen, state)
+            n = self.seen[state]
+
+            reservoir = reservoirs.get(state)
+            if reservoir is None:
+                reservoir = reservoirs[state] = []
+            if n <= per_state:
+                reservoir.append((i, record))
+            else:
+                j = randint(0, n - 1)
+                if j < per_state:
+                    reservoir[j] = (i, record)
+
+        sample = []
+        for state, reservoir in reservoirs.items():
+            self.sampled[state] = len(reservoir)
+            sample.extend(reservoir)
+        sample.sort(key=lambda item: item[0])
+
+        for i, record in sample:
+            yield record
+
+    def stats(self):
+        return OrderedDict([
+            ('records', sum(self.seen.values())),
+            ('sampled', sum(self.sampled.values())),
+            ('states', OrderedDict((state, OrderedDict([('records', n), ('sampled', self.sampled.get(state, 0))]))
+                                   for state, n in self.seen.items())),
+        ])
+
+    def report(self):
+        stats = self.stats()
+        print('sample: {} of {} records from {} regions'.format(stats['sampled'], stats['records'], len(stats['states'])))
+
+
+def sample_options(args):
+    if not (args.sample or args.sample_per_state):
+        return None
+    return {
+        'fraction': args.sample,
+        'per_state': args.sample_per_state,
+        'seed': args.sample_seed,
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--sample',
+                        type=parse_fraction,
+                        default=None,
+                        metavar='FRACTION',
+                        help='Only use this fraction of the input records of every region, '
+                             'e.g. 0.01 or 1%% for the first and every 100th record of a region')
+
+    parser.add_argument('--sample-per-state',
+                        type=int,
+                        default=None,
+                        metavar='N',
+                        help='Only use a uniform sample of at most N input records per region')
+
+    parser.add_argument('--sample-seed',
+                        type=int,
+                        default=DEFAULT_SAMPLE_SEED,
+                        help='Seed of --sample-per-state, independent of --seed')
@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+import os
+import sys
+import threading
+import zlib
+
+from timeit import default_timer as timer
+
+from collections import OrderedDict
+
+import six
+from six.moves import queue
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from geodata.train_ru.compat import native_row, open_tsv, text_buffer
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+COMPRESSIONS = (GZIP, ZSTD)
+
+COMPRESSED_SUFFIXES = {
+    None: '',
+    GZIP: '.gz',
+    ZSTD: '.zst',
+}
+
+DEFAULT_COMPRESSION_LEVELS = {
+    GZIP: 6,
+    ZSTD: 3,
+}
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+DEFAULT_COMPRESS_THREADS = 2
+PENDING_CHUNKS_PER_THREAD = 4
+
+DEFAULT_FLUSH_BYTES = 8 << 20
+DEFAULT_FLUSH_INTERVAL = 5.0
+PENDING_BLOCKS = 8
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+SIZE_UNITS = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+_STOP = object()
+
+
+class TSVSink(object):
+    '''
+    Writes rows to a tab separated file with the tsv_no_quote dialect.
+    The sink is callable with a list of rows, which is what a pipeline format
+    stage produces for one input record.
+
+    With append=True an existing file is kept, which is how a resumed build
+    continues the output it truncated back to its last checkpoint. A header
+    row is written at the start of the file and not counted in rows.
+    '''
+
+    def __init__(self, path, append=False, header=None):
+        self.path = path
+        self.header = header
+        self.f = open_tsv(path, 'a' if append else 'w')
+        self.writer = csv.writer(self.f, 'tsv_no_quote')
+        self.rows = 0
+        if header and not append:
+            self.writer.writerow(header)
+
+    def writerow(self, row):
+        self.writer.writerow(native_row(row))
+        self.rows += 1
+
+    def __call__(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        self.f.flush()
+
+    def sync(self):
+        '''
+        Makes everything written so far durable, e.g. before a checkpoint
+        '''
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def tell(self):
+        # the file position is not reliable in append mode, the size is
+        self.f.flush()
+        return os.fstat(self.f.fileno()).st_size
+
+    def truncate(self, size):
+        self.f.flush()
+        self.f.truncate(size)
+        if size == 0 and self.header:
+            self.writer.writerow(self.header)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _Sync(object):
+    __slots__ = ('done',)
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class WriteBehindSink(TSVSink):
+    '''
+    TSVSink writing on a background thread. Rows are serialized on the calling
+    thread into blocks of about block_size bytes and a writer thread writes
+    whole blocks to the file. The file is flushed by the writer once
+    flush_bytes have been written since the last flush or flush_interval
+    seconds have passed, so flush() from the caller does nothing.
+
+    sync(), tell() and truncate() first wait for every handed over row to be
+    written, so checkpoints work as with TSVSink.
+    '''
+
+    def __init__(self, path, append=False, header=None, block_size=DEFAULT_CHUNK_SIZE,
+                 flush_bytes=DEFAULT_FLUSH_BYTES, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        TSVSink.__init__(self, path, append=append, header=header)
+        self.block_size = block_size
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+
+        self.buffer = text_buffer()
+        self.writer = csv.writer(self.buffer, 'tsv_no_quote')
+
+        self.errors = []
+        self.blocks = queue.Queue(PENDING_BLOCKS)
+        self.thread = threading.Thread(name='write-behind', target=self.write_blocks)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def writerow(self, row):
+        self.writer.writerow(native_row(row))
+        self.rows += 1
+        if self.buffer.tell() >= self.block_size:
+            self.submit()
+
+    def submit(self):
+        data = self.buffer.getvalue()
+        if not data:
+            return
+        # blocks are written to the file as they are, which is text on Python 3
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.put(data)
+
+    def put(self, item):
+        self.check_errors()
+        self.blocks.put(item)
+
+    def write_blocks(self):
+        f = self.f
+        unflushed = 0
+        last_flush = timer()
+        while True:
+            try:
+                block = self.blocks.get(timeout=self.flush_interval)
+            except queue.Empty:
+                block = None
+
+            try:
+                if block is _STOP:
+                    break
+                elif isinstance(block, _Sync):
+                    f.flush()
+                    os.fsync(f.fileno())
+                    unflushed = 0
+                    last_flush = timer()
+                    block.done.set()
+                    continue
+                elif block is not None:
+                    f.write(block)
+                    unflushed += len(block)
+
+                if unflushed and (unflushed >= self.flush_bytes or timer() - last_flush >= self.flush_interval):
+                    f.flush()
+                    unflushed = 0
+                    last_flush = timer()
+            except BaseException:
+                self.errors.append(sys.exc_info())
+                if isinstance(block, _Sync):
+                    block.done.set()
+
+    def check_errors(self):
+        if self.errors:
+            six.reraise(*self.errors[0])
+
+    def flush(self):
+        # the writer thread flushes by size and time
+        pass
+
+    def sync(self):
+        self.submit()
+        marker = _Sync()
+        self.put(marker)
+        marker.done.wait()
+        self.check_errors()
+
+    def tell(self):
+        self.sync()
+        return TSVSink.tell(self)
+
+    def truncate(self, size):
+        self.sync()
+        TSVSink.truncate(self, size)
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.submit()
+        self.put(_STOP)
+        self.thread.join()
+        self.thread = None
+        self.f.close()
+        self.check_errors()
+
+
+def gzip_compress(data, level):
+    # every chunk is a complete gzip member, concatenated members are a valid gzip file
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def zstd_compress(data, level):
+    # ZstdCompressor is not thread safe, frames are concatenated like gzip members
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+COMPRESSORS = {
+    GZIP: gzip_compress,
+    ZSTD: zstd_compress,
+}
+
+
+class _Chunk(object):
+    __slots__ = ('shard', 'data', 'last', 'done')
+
+    def __init__(self, shard, data, last):
+        self.shard = shard
+        self.data = data
+        self.last = last
+        self.done = threading.Event()
+
+
+class ShardedSink(object):
+    '''
+    TSV sink compressing its output on background threads and rolling over
+    into numbered shards.
+
+    Rows are serialized into chunks of about chunk_size bytes on the calling
+    thread. The chunks are compressed by a pool of threads (zlib and zstandard
+    release the GIL), each into an independent gzip member or zstd frame, and a
+    writer thread appends them to the current shard in order. A new shard is
+    started once shard_rows rows or shard_bytes uncompressed bytes have been
+    written, always on a row boundary:
+
+        osm_formatted_addresses_tagged.00001.tsv.zst
+        osm_formatted_addresses_tagged.00002.tsv.zst
+
+    Without sharding the output is the path itself plus the compression suffix.
+    close() writes a manifest listing the rows and sizes of every shard.
+    '''
+
+    def __init__(self, path, compression=None, shard_rows=None, shard_bytes=None, header=None,
+                 level=None, threads=DEFAULT_COMPRESS_THREADS, chunk_size=DEFAULT_CHUNK_SIZE):
+        if compression is not None and compression not in COMPRESSORS:
+            raise ValueError('Unknown compression {!r}, expected one of {}'.format(compression, COMPRESSIONS))
+        if compression == ZSTD and zstandard is None:
+            raise ValueError('zstd output needs the zstandard package')
+
+        self.path = path
+        self.compression = compression
+        self.compress = COMPRESSORS.get(compression)
+        self.level = level if level is not None else DEFAULT_COMPRESSION_LEVELS.get(compression)
+        self.shard_rows = shard_rows
+        self.shard_bytes = shard_bytes
+        self.header = header
+        self.chunk_size = chunk_size
+
+        self.shards = []
+        self.rows = 0
+        self.shard_row_count = 0
+        self.shard_size = 0
+
+        self.buffer = text_buffer()
+        self.writer = csv.writer(self.buffer, 'tsv_no_quote')
+
+        self.errors = []
+        threads = max(int(threads or 1), 1) if self.compress else 0
+        self.chunks = queue.Queue(max(threads, 1) * PENDING_CHUNKS_PER_THREAD)
+        self.ordered_chunks = queue.Queue(max(threads, 1) * PENDING_CHUNKS_PER_THREAD)
+        self.threads = [threading.Thread(name='compress-{}'.format(i), target=self.compress_chunks)
+                        for i in range(threads)]
+        self.threads.append(threading.Thread(name='shard-writer', target=self.write_chunks))
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+        self.start_shard()
+
+    def shard_path(self, index):
+        suffix = COMPRESSED_SUFFIXES[self.compression]
+        if not (self.shard_rows or self.shard_bytes):
+            return self.path + suffix
+        stem, ext = os.path.splitext(self.path)
+        return '{}.{:05d}{}{}'.format(stem, index, ext, suffix)
+
+    def start_shard(self):
+        self.shards.append(OrderedDict([
+            ('path', self.shard_path(len(self.shards) + 1)),
+            ('rows', 0),
+            ('bytes', 0),
+            ('compressed_bytes', 0),
+        ]))
+        self.shard_row_count = 0
+        self.shard_size = 0
+        if self.header:
+            self.writer.writerow(self.header)
+
+    def writerow(self, row):
+        self.writer.writerow(native_row(row))
+        self.rows += 1
+        self.shard_row_count += 1
+
+        size = self.buffer.tell()
+        if size >= self.chunk_size:
+            self.submit()
+            size = 0
+
+        if (self.shard_rows and self.shard_row_count >= self.shard_rows) or \
+           (self.shard_bytes and self.shard_size + size >= self.shard_bytes):
+            self.submit(last=True)
+            self.start_shard()
+
+    def __call__(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def submit(self, last=False):
+        self.check_errors()
+
+        data = self.buffer.getvalue()
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+        shard = self.shards[-1]
+        shard['rows'] = self.shard_row_count
+        shard['bytes'] += len(data)
+        self.shard_size += len(data)
+
+        chunk = _Chunk(len(self.shards) - 1, data, last)
+        self.ordered_chunks.put(chunk)
+        if self.compress:
+            self.chunks.put(chunk)
+        else:
+            chunk.done.set()
+
+    def compress_chunks(self):
+        compress = self.compress
+        level = self.level
+        while True:
+            chunk = self.chunks.get()
+            if chunk is _STOP:
+                break
+            try:
+                chunk.data = compress(chunk.data, level)
+            except BaseException:
+                self.errors.append(sys.exc_info())
+            chunk.done.set()
+
+    def write_chunks(self):
+        f = None
+        while True:
+            chunk = self.ordered_chunks.get()
+            if chunk is _STOP:
+                break
+            chunk.done.wait()
+            if self.errors:
+                continue
+            try:
+                shard = self.shards[chunk.shard]
+                if f is None:
+                    f = open(shard['path'], 'wb')
+                f.write(chunk.data)
+                shard['compressed_bytes'] += len(chunk.data)
+                if chunk.last:
+                    f.close()
+                    f = None
+            except BaseException:
+                self.errors.append(sys.exc_info())
+        if f is not None:
+            f.close()
+
+    def check_errors(self):
+        if self.errors:
+            six.reraise(*self.errors[0])
+
+    def flush(self):
+        # chunks are handed to the compressors when full, flushing smaller
+        # ones would only make the compression worse
+        pass
+
+    def manifest_path(self):
+        stem, ext = os.path.splitext(self.path)
+        return stem + MANIFEST_SUFFIX
+
+    def manifest(self):
+        return OrderedDict([
+            ('compression', self.compression),
+            ('rows', self.rows),
+            ('shards', [OrderedDict([('path', os.path.basename(shard['path']))] +
+                                    [(k, v) for k, v in shard.items() if k != 'path'])
+                        for shard in self.shards]),
+        ])
+
+    def close(self):
+        if not self.threads:
+            return
+
+        if self.shard_row_count or len(self.shards) == 1:
+            self.submit(last=True)
+        else:
+            # the last rollover started a shard nothing was written to
+            self.shards.pop()
+
+        for t in self.threads[:-1]:
+            self.chunks.put(_STOP)
+        self.ordered_chunks.put(_STOP)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+        self.check_errors()
+
+        with open(self.manifest_path(), 'w') as f:
+            json.dump(self.manifest(), f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def parse_size(value):
+    '''
+    Parses a byte count like 500000, 512M or 2G
+    '''
+    value = value.strip().lower()
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+def open_sink(path, append=False, header=None, compression=None, shard_rows=None, shard_bytes=None,
+              compress_threads=DEFAULT_COMPRESS_THREADS, write_behind=False,
+              flush_bytes=DEFAULT_FLUSH_BYTES, flush_interval=DEFAULT_FLUSH_INTERVAL):
+    '''
+    Returns a plain TSVSink unless compression, sharding or writing on a
+    background thread was asked for. ShardedSink always writes in the background.
+    '''
+    if compression or shard_rows or shard_bytes:
+        if append:
+            raise ValueError('Compressed or sharded output cannot be resumed')
+        return ShardedSink(path, compression=compression, shard_rows=shard_rows, shard_bytes=shard_bytes,
+                           header=header, threads=compress_threads)
+    if write_behind:
+        return WriteBehindSink(path, append=append, header=header,
+                               flush_bytes=flush_bytes, flush_interval=flush_interval)
+    return TSVSink(path, append=append, header=header)
+
+
+def sink_options(args):
+    return {
+        'compression': args.compress,
+        'shard_rows': args.shard_rows,
+        'shard_bytes': args.shard_bytes,
+        'compress_threads': args.compress_threads,
+        'write_behind': args.write_behind,
+        'flush_bytes': args.flush_bytes,
+        'flush_interval': args.flush_interval,
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--compress',
+                        choices=COMPRESSIONS,
+                        default=None,
+                        help='Compress the output on background threads')
+
+    parser.add_argument('--compress-threads',
+                        type=int,
+                        default=DEFAULT_COMPRESS_THREADS,
+                        help='Number of compression threads')
+
+    parser.add_argument('--shard-rows',
+                        type=int,
+                        default=None,
+                        help='Start a new output shard after this many rows')
+
+    parser.add_argument('--shard-bytes',
+                        type=parse_size,
+                        default=None,
+                        help='Start a new output shard after this many uncompressed bytes, e.g. 512M')
+
+    parser.add_argument('--write-behind',
+                        action='store_true',
+                        default=False,
+                        help='Write the output in large blocks on a background thread')
+
+    parser.add_argument('--flush-bytes',
+                        type=parse_size,
+                        default=DEFAULT_FLUSH_BYTES,
+                        help='With --write-behind, flush the output after this many bytes, e.g. 8M')
+
+    parser.add_argument('--flush-interval',
+                        type=float,
+                        default=DEFAULT_FLUSH_INTERVAL,
+                        help='With --write-behind, flush the output at least every this many seconds')
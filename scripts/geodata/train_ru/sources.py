@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+'''
+Several input files per build.
+
+Every converter reads the file given with -i and the positional sources.
+Compressed inputs (.gz, .bz2, .xz, .zst) are decompressed while reading, by
+suffix, and can be mixed with plain ones.
+
+By default the sources go into one merged output. Each source is parsed on
+its own thread into a bounded queue and the records are taken from the
+sources in turns of chunk_size records. The merged order only depends on the
+inputs, not on which thread is faster, so a merged build is reproducible with
+--seed and can be checkpointed like a single input. The threads overlap file
+reads, decompression and lxml's parsing, the Python side of the readers still
+shares one core.
+
+With --per-source every source is built into its own subdirectory of the
+output directory, named after the file, by up to --source-processes
+processes at a time:
+
+    out/north_western/osm_formatted_addresses_tagged.tsv
+    out/siberian/osm_formatted_addresses_tagged.tsv
+
+The progress of every source is reported by geodata.train_ru.metrics, from
+the file offset of each input for a merged build and under the source's name
+for per-source builds.
+'''
+
+import bz2
+import gzip
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+
+from collections import deque
+
+import six
+from six.moves import queue
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+XZ = 'xz'
+ZSTD = 'zstd'
+
+COMPRESSION_SUFFIXES = {
+    '.gz': GZIP,
+    '.bz2': BZIP2,
+    '.xz': XZ,
+    '.zst': ZSTD,
+}
+
+DEFAULT_CHUNK_SIZE = 256
+DEFAULT_BUFFER_CHUNKS = 16
+COPY_BUFFER_SIZE = 1 << 20
+
+QUEUE_TIMEOUT = 0.1
+POLL_INTERVAL = 0.5
+
+_STOP = object()
+
+
+class SourcesFailed(Exception):
+    pass
+
+
+class _Error(object):
+    __slots__ = ('exc_info',)
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def input_paths(path=None, sources=()):
+    '''
+    The input files of a build: path (one path or a list of them), then the
+    positional sources, every file once
+    '''
+    if not path:
+        paths = []
+    elif isinstance(path, six.string_types):
+        paths = [path]
+    else:
+        paths = list(path)
+
+    seen = set()
+    unique = []
+    for p in paths + list(sources or ()):
+        if p not in seen:
+            seen.add(p)
+            unique.append(p)
+    return unique
+
+
+def input_key(paths):
+    '''
+    The inputs as recorded in checkpoints and component stores, a single path
+    as before multiple sources
+    '''
+    return paths[0] if len(paths) == 1 else list(paths)
+
+
+def compression(path):
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+
+def open_source(path):
+    '''
+    Opens path for reading bytes, decompressing it according to its suffix
+    '''
+    kind = compression(path)
+    if kind == GZIP:
+        return gzip.open(path, 'rb')
+    elif kind == BZIP2:
+        return bz2.BZ2File(path, 'rb')
+    elif kind == XZ:
+        if lzma is None:
+            raise ValueError('{} needs the lzma module'.format(path))
+        return lzma.open(path, 'rb')
+    elif kind == ZSTD:
+        if zstandard is None:
+            raise ValueError('{} needs the zstandard package'.format(path))
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def open_text(path):
+    '''
+    Opens path for csv.reader: bytes on Python 2, UTF-8 text on Python 3
+    '''
+    f = open_source(path)
+    if six.PY2:
+        return f
+    return io.TextIOWrapper(f, encoding='utf-8', newline='')
+
+
+def copy_to_pipe(f, fd):
+    try:
+        with f, io.open(fd, 'wb') as out:
+            shutil.copyfileobj(f, out, COPY_BUFFER_SIZE)
+    except (IOError, OSError):
+        # the reader stopped early and closed its end of the pipe
+        pass
+
+
+def decompressed(read, path):
+    '''
+    Yields what read(path) yields, for readers that only take a file name.
+    A compressed path is decompressed into a pipe on a background thread and
+    read gets the name of the pipe's read end instead.
+    '''
+    if compression(path) is None:
+        for item in read(path):
+            yield item
+        return
+
+    f = open_source(path)
+    r, w = os.pipe()
+    t = threading.Thread(name='decompress', target=copy_to_pipe, args=(f, w))
+    t.daemon = True
+    t.start()
+    try:
+        for item in read('/dev/fd/{}'.format(r)):
+            yield item
+    finally:
+        os.close(r)
+
+
+class MergedSources(object):
+    '''
+    Iterates several sources, each on its own thread that keeps up to
+    buffer_chunks chunks of chunk_size items read ahead. The consumer takes a
+    chunk from every unfinished source in turn, so the merged order is fixed.
+    An error raised by a source is raised again by the consumer.
+    '''
+
+    def __init__(self, sources, chunk_size=DEFAULT_CHUNK_SIZE, buffer_chunks=DEFAULT_BUFFER_CHUNKS):
+        self.sources = sources
+        self.chunk_size = max(int(chunk_size), 1)
+        self.buffer_chunks = max(int(buffer_chunks), 1)
+        self.closed = threading.Event()
+
+    def read(self, source, chunks):
+        try:
+            chunk = []
+            for item in source:
+                chunk.append(item)
+                if len(chunk) >= self.chunk_size:
+                    if not self.put(chunks, chunk):
+                        return
+                    chunk = []
+            if chunk and not self.put(chunks, chunk):
+                return
+        except BaseException:
+            self.put(chunks, _Error(sys.exc_info()))
+            return
+        self.put(chunks, _STOP)
+
+    def put(self, chunks, item):
+        while not self.closed.is_set():
+            try:
+                chunks.put(item, timeout=QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        queues = [queue.Queue(self.buffer_chunks) for source in self.sources]
+        for i, (source, chunks) in enumerate(zip(self.sources, queues)):
+            t = threading.Thread(name='source-{}'.format(i), target=self.read, args=(source, chunks))
+            t.daemon = True
+            t.start()
+
+        active = list(range(len(self.sources)))
+        try:
+            while active:
+                for i in list(active):
+                    chunk = queues[i].get()
+                    if chunk is _STOP:
+                        active.remove(i)
+                        continue
+                    elif isinstance(chunk, _Error):
+                        six.reraise(*chunk.exc_info)
+                    for item in chunk:
+                        yield item
+        finally:
+            # stops the readers when the consumer gives up early
+            self.closed.set()
+
+
+def merged(sources, chunk_size=DEFAULT_CHUNK_SIZE):
+    if len(sources) == 1:
+        return sources[0]
+    return MergedSources(sources, chunk_size=chunk_size)
+
+
+def source_names(paths):
+    '''
+    Output subdirectory of every path: the file name without the compression
+    suffix and extension, numbered when two sources share it
+    '''
+    names = []
+    counts = {}
+    for path in paths:
+        name = os.path.basename(path)
+        if compression(name):
+            name = os.path.splitext(name)[0]
+        name = os.path.splitext(name)[0] or name
+        counts[name] = counts.get(name, 0) + 1
+        names.append(name if counts[name] == 1 else '{}-{}'.format(name, counts[name]))
+    return names
+
+
+def process_context():
+    # build functions are usually closures, which only a forked child can run
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def run_per_source(build, paths, out_dir, processes=None):
+    '''
+    Calls build(path, source_dir, name) for every path in a process of its
+    own, up to processes at a time. Raises SourcesFailed once every source is
+    done if any of them failed.
+    '''
+    context = process_context()
+    processes = max(int(processes or multiprocessing.cpu_count()), 1)
+    pending = deque(zip(paths, source_names(paths)))
+    running = []
+    failed = []
+
+    try:
+        while pending or running:
+            while pending and len(running) < processes:
+                path, name = pending.popleft()
+                source_dir = os.path.join(out_dir, name)
+                if not os.path.isdir(source_dir):
+                    os.makedirs(source_dir)
+                process = context.Process(name='source-{}'.format(name), target=build, args=(path, source_dir, name))
+                process.start()
+                running.append((process, path))
+
+            running[0][0].join(POLL_INTERVAL)
+            for process, path in list(running):
+                if not process.is_alive():
+                    running.remove((process, path))
+                    if process.exitcode != 0:
+                        failed.append(path)
+    except BaseException:
+        for process, path in running:
+            process.terminate()
+        raise
+    finally:
+        for process, path in running:
+            process.join()
+
+    if failed:
+        raise SourcesFailed('Building failed for {}'.format(', '.join(failed)))
+
+
+def check_arguments(parser, args):
+    '''
+    Rejects the options a per-source build cannot split between its sources
+    '''
+    if not args.per_source:
+        return
+    if getattr(args, 'from_store', None):
+        parser.error('--per-source builds read the input files, not --from-store')
+    if getattr(args, 'incremental', None):
+        parser.error('--incremental keeps a single store and cannot be used with --per-source')
+
+
+def add_arguments(parser):
+    parser.add_argument('--per-source',
+                        action='store_true',
+                        default=False,
+                        help='Build every input into its own subdirectory of the output directory instead of one merged output')
+
+    parser.add_argument('--source-processes',
+                        type=int,
+                        default=None,
+                        metavar='N',
+                        help='Build up to N inputs at a time with --per-source (default: number of CPUs)')
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+'''
+Lazy construction and snapshots of the formatters' initialized state.
+
+The YAML parser config, AddressFormatter and AddressComponents take seconds
+to build, and every worker process builds its own. Attributes declared with
+lazy_state are only built when a step first uses them, so e.g. --ingest never
+builds the AddressFormatter. A snapshot pickles the built state once; with
+--snapshot PATH a formatter loads it from PATH instead of building it, and
+builds and saves it when PATH does not exist yet or was written by another
+Python or formatter class.
+
+The gazetteers are built by the star imports of geodata modules outside this
+package at import time and are not part of the snapshot.
+
+Build and load times are kept per step and reported by the profiler.
+'''
+
+import os
+import sys
+import threading
+
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+from six.moves import cPickle as pickle
+
+SNAPSHOT_VERSION = 1
+
+BUILT = 'built'
+SNAPSHOT = 'snapshot'
+
+_startup_steps = OrderedDict()
+_lock = threading.RLock()
+
+_missing = object()
+
+
+def record_step(name, seconds, source=BUILT):
+    _startup_steps[name] = OrderedDict([
+        ('seconds', seconds),
+        ('source', source),
+    ])
+
+
+def startup_stats():
+    return OrderedDict((name, OrderedDict(step)) for name, step in _startup_steps.items())
+
+
+class lazy_state(object):
+    '''
+    Method decorator for an attribute built by the method on first access and
+    then stored on the instance. Building is serialized so threaded stages
+    never build the same attribute twice.
+    '''
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+
+        with _lock:
+            value = obj.__dict__.get(self.name, _missing)
+            if value is _missing:
+                start = timer()
+                value = obj.__dict__[self.name] = self.func(obj)
+                record_step('{}.{}'.format(type(obj).__name__, self.name), timer() - start)
+        return value
+
+
+def class_name(obj):
+    cls = type(obj)
+    return '{}.{}'.format(cls.__module__, cls.__name__)
+
+
+def save_snapshot(obj, path, names):
+    '''
+    Builds the given lazy attributes of obj and pickles them to path
+    '''
+    state = OrderedDict((name, getattr(obj, name)) for name in names)
+
+    start = timer()
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'class': class_name(obj),
+        'python': list(sys.version_info[:2]),
+        'state': state,
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+    record_step('snapshot.save', timer() - start)
+
+
+def load_snapshot(obj, path, names):
+    '''
+    Sets the attributes of obj from the snapshot at path. Returns False if there
+    is none or it does not match this Python and the class of obj.
+    '''
+    if not os.path.exists(path):
+        return False
+
+    start = timer()
+    with open(path, 'rb') as f:
+        snapshot = pickle.load(f)
+
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('class') != class_name(obj) or \
+       snapshot.get('python') != list(sys.version_info[:2]) or set(snapshot['state']) != set(names):
+        print('snapshot {} was written for {} on Python {}, rebuilding'.format(
+            path, snapshot.get('class'), '.'.join(str(v) for v in snapshot.get('python') or ())))
+        return False
+
+    obj.__dict__.update(snapshot['state'])
+    record_step('snapshot.load', timer() - start, source=SNAPSHOT)
+    return True
+
+
+def restore_snapshot(obj, path, names):
+    '''
+    Loads the state of obj from the snapshot at path, or builds it and saves a
+    new snapshot there. State that cannot be pickled is built normally.
+    '''
+    if load_snapshot(obj, path, names):
+        return True
+
+    try:
+        save_snapshot(obj, path, names)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        print('could not save snapshot {}: {}'.format(path, e))
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+    return False
+
+
+def add_arguments(parser):
+    parser.add_argument('--snapshot',
+                        metavar='PATH',
+                        help='Load the initialized formatter state from PATH, or build it and save it there')
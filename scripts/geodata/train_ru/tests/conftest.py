@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+'''
+The tests import the converters as geodata.train_ru, from a libpostal
+checkout whose scripts directory is on the path, and skip the modules whose
+libpostal or third-party dependencies are missing.
+'''
+
+import os
+import sys
+
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, os.pardir))
+
+if SCRIPTS_DIR not in sys.path:
+    sys.path.append(SCRIPTS_DIR)
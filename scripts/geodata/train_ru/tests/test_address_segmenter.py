@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+license_to_csv = pytest.importorskip('geodata.train_ru.fed_med_nadzor.fed_nadzor_zdrav_reestr_license_to_csv')
+
+from geodata.train_ru.benchmarks.fixtures import license_components
+
+
+def expanded(formatter, records, use_segmenter):
+    formatter.use_segmenter = use_segmenter
+    return [formatter.expanded_components(dict(components)) for components in records]
+
+
+def test_segmenter_matches_try_move_chain():
+    formatter = license_to_csv.HealthcareLicensesRUFormatter()
+    records = list(license_components(5000, seed=1))
+
+    assert expanded(formatter, records, True) == expanded(formatter, records, False)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import pytest
+
+from geodata.train_ru import checkpoint
+
+sinks = pytest.importorskip('geodata.train_ru.sinks')
+
+RECORDS = 10
+EVERY = 3
+PARAMS = {'input': 'licenses.tsv', 'seed': None}
+
+
+def write_records(sink, checkpointer, start, stop):
+    for i in range(start, stop):
+        sink.writerow([u'{}'.format(i), u'Москва', u'{:.6f}'.format(random.random())])
+        if checkpointer is not None:
+            checkpointer(i + 1 - checkpointer.skipped)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_resumed_build_writes_the_uninterrupted_output(tmpdir):
+    full_path = str(tmpdir.join('full.tsv'))
+    random.seed(0)
+    with sinks.TSVSink(full_path) as sink:
+        write_records(sink, None, 0, RECORDS)
+
+    path = str(tmpdir.join('out.tsv'))
+    random.seed(0)
+    sink = sinks.TSVSink(path)
+    checkpointer = checkpoint.Checkpointer(sink, every=EVERY, params=PARAMS)
+    # interrupted two records after the checkpoint at 6
+    write_records(sink, checkpointer, 0, 8)
+    sink.close()
+    random.seed(1)
+
+    sink = sinks.TSVSink(path, append=True)
+    checkpointer = checkpoint.Checkpointer(sink, every=EVERY, params=PARAMS)
+    skip = checkpointer.resume()
+    assert skip == 6
+    assert sink.rows == 6
+    write_records(sink, checkpointer, skip, RECORDS)
+    sink.close()
+    checkpointer.finish()
+
+    assert read(path) == read(full_path)
+    assert checkpoint.load_checkpoint(path) is None
+
+
+def test_resume_rejects_other_params(tmpdir):
+    path = str(tmpdir.join('out.tsv'))
+    with sinks.TSVSink(path) as sink:
+        checkpointer = checkpoint.Checkpointer(sink, every=EVERY, params=PARAMS)
+        write_records(sink, checkpointer, 0, EVERY)
+
+    with sinks.TSVSink(path, append=True) as sink:
+        checkpointer = checkpoint.Checkpointer(sink, every=EVERY, params=dict(PARAMS, seed=1))
+        with pytest.raises(checkpoint.CheckpointError):
+            checkpointer.resume()
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+dedup = pytest.importorskip('geodata.train_ru.dedup')
+
+ADDRESS = u'ул./road Ленина/road 5/house_number | Москва/city'
+
+# formatted addresses come from tsv_string as UTF-8 bytes
+ROWS = [
+    (u'ru', u'ru', ADDRESS.encode('utf-8')),
+    (u'ru', u'ru', u'Москва/city | Московская/state область/state'.encode('utf-8')),
+]
+
+
+@pytest.mark.parametrize('mode', dedup.DEDUP_MODES)
+def test_rows_are_written_once(tmpdir, mode):
+    deduplicator = dedup.open_deduplicator(str(tmpdir.join('out.tsv')), mode)
+    try:
+        assert deduplicator(ROWS) == ROWS
+        assert deduplicator(ROWS) == []
+        # the same row with text cells
+        assert deduplicator([(u'ru', u'ru', ADDRESS)]) == []
+        assert deduplicator.stats()['suppressed'] == 3
+    finally:
+        deduplicator.close()
+
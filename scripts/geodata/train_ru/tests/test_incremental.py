@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+incremental = pytest.importorskip('geodata.train_ru.incremental')
+
+COMPONENTS = {'road': u'улица Ленина', 'house_number': u'5', 'city': u'Москва'}
+
+
+class Formatter(object):
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, components):
+        self.records.append(components)
+        address = u'{road}/road {house_number}/house_number | {city}/city'.format(**components)
+        return [(u'ru', u'ru', address.encode('utf-8'))]
+
+
+def expected_rows(components):
+    address = u'{road}/road {house_number}/house_number | {city}/city'.format(**components)
+    return [(b'ru', b'ru', address.encode('utf-8'))]
+
+
+def test_reused_rows_match_formatted_rows(tmpdir):
+    path = str(tmpdir.join('rows.sqlite'))
+    formatter = Formatter()
+
+    rows = incremental.IncrementalRows(path, formatter, 'fingerprint')
+    formatted = rows(dict(COMPONENTS))
+    rows.close()
+
+    rows = incremental.IncrementalRows(path, formatter, 'fingerprint')
+    # the same record with UTF-8 encoded values
+    reused = rows({k: v.encode('utf-8') for k, v in COMPONENTS.items()})
+    rows.close()
+
+    assert formatted == reused == expected_rows(COMPONENTS)
+    assert len(formatter.records) == 1
+    assert rows.stats()['reused'] == 1
+
+
+def test_records_not_seen_again_are_purged(tmpdir):
+    path = str(tmpdir.join('rows.sqlite'))
+    moved = dict(COMPONENTS, house_number=u'7')
+
+    rows = incremental.IncrementalRows(path, Formatter(), 'fingerprint')
+    rows(dict(COMPONENTS))
+    rows(moved)
+    rows.close()
+
+    formatter = Formatter()
+    rows = incremental.IncrementalRows(path, formatter, 'fingerprint')
+    assert rows(moved) == expected_rows(moved)
+    rows.close()
+    assert formatter.records == []
+    assert rows.stats()['deleted'] == 1
+
+    # a new fingerprint formats everything again
+    rows = incremental.IncrementalRows(path, formatter, 'other fingerprint')
+    rows(moved)
+    rows.close()
+    assert formatter.records == [moved]
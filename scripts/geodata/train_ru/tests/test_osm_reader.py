@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+import pytest
+
+osm_to_training_data = pytest.importorskip('geodata.train_ru.osm_to_training_data')
+
+from geodata.train_ru.osm_reader import AddressTagTable, parse_osm_address_tags
+
+OTHER_TAGS = ['building', 'addr:flats', 'addr:city_official_status', 'name:en']
+
+
+def aliased_components(aliases, fields, tags):
+    # OSMAddressRUFormatter.normalize_address_components, which the table replaces
+    address_components = {k: v for k, v in tags.items() if aliases.get(k)}
+    aliases.replace(address_components)
+    return {k: v for k, v in address_components.items() if k in fields}
+
+
+def random_tags(rnd, keys):
+    return {key: u'{} {}'.format(key, rnd.randint(0, 2)) for key in rnd.sample(keys, rnd.randint(1, 8))}
+
+
+def test_table_matches_aliases_replace():
+    formatter = osm_to_training_data.OSMAddressRUFormatter
+    fields = osm_to_training_data.AddressFormatter.address_formatter_fields
+    table = AddressTagTable(formatter.aliases, fields)
+
+    keys = list(formatter.aliases.aliases) + OTHER_TAGS
+    rnd = random.Random(0)
+    for i in range(5000):
+        tags = random_tags(rnd, keys)
+        assert (table.components(tags.items()) or {}) == aliased_components(formatter.aliases, fields, tags)
+
+
+def test_reader_skips_elements_without_address_tags(tmpdir):
+    path = tmpdir.join('extract.osm')
+    path.write_text(u'''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="55.75" lon="37.61">
+    <tag k="addr:street" v="улица Ленина"/>
+    <tag k="addr:housenumber" v="5"/>
+    <tag k="building" v="yes"/>
+  </node>
+  <node id="2" lat="55.75" lon="37.61">
+    <tag k="amenity" v="bench"/>
+  </node>
+  <way id="3">
+    <tag k="addr:suburb" v="Северный"/>
+    <tag k="suburb" v="Южный"/>
+  </way>
+</osm>
+''', encoding='utf-8')
+
+    table = AddressTagTable(osm_to_training_data.OSMAddressRUFormatter.aliases,
+                            osm_to_training_data.AddressFormatter.address_formatter_fields)
+    assert list(parse_osm_address_tags(str(path), table)) == [
+        {'road': u'улица Ленина', 'house_number': u'5'},
+        {'suburb': u'Южный'},
+    ]
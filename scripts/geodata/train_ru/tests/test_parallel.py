@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+from geodata.train_ru import parallel
+
+RECORDS = 50
+
+
+class Formatter(object):
+    def normalized(self, record):
+        # every fifth record has no address
+        return record if record % 5 else None
+
+    def normalized_batch(self, records):
+        return [self.normalized(record) for record in records]
+
+    def rows(self, record, label=u'ru'):
+        return [(label, record, random.random())]
+
+
+def formatted(workers, normalize=None, seed=0, ordered=True):
+    pool = parallel.ParallelFormatter(Formatter(), 'rows', workers=workers, batch_size=7, ordered=ordered,
+                                      seed=seed, normalize=normalize, label=u'en')
+    return list(pool.imap(range(RECORDS)))
+
+
+def test_seeded_pool_matches_serial():
+    normalize = parallel.WorkerMethod('normalized')
+    serial = formatted(1, normalize=normalize)
+
+    assert len(serial) == RECORDS
+    assert [result is None for result in serial] == [i % 5 == 0 for i in range(RECORDS)]
+    assert all(result[0][:2] == (u'en', i) for i, result in enumerate(serial) if result is not None)
+    assert formatted(3, normalize=normalize) == serial
+    assert formatted(3, normalize=parallel.WorkerMethod('normalized_batch', batches=True)) == serial
+
+
+def test_unordered_pool_returns_every_record():
+    results = formatted(3, ordered=False)
+    assert sorted(result[0][1] for result in results) == list(range(RECORDS))
+
+
+def test_workers_report_their_stats():
+    formatted(3)
+    assert 1 <= len(parallel.worker_stats()) <= 3
+
+    formatted(1)
+    assert parallel.worker_stats() == []
+
+
+def test_batch_method_keeps_dropped_records_in_place():
+    normalize = parallel.WorkerMethod('normalized_batch', batches=True)
+    assert normalize(Formatter(), [1, None, 5, 6]) == [1, None, None, 6]
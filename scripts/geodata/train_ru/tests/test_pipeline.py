@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import random
+import time
+
+import pytest
+
+pipeline = pytest.importorskip('geodata.train_ru.pipeline')
+
+from geodata.train_ru.parallel import ParallelFormatter
+
+RECORDS = 200
+
+
+def normalized(record):
+    # every seventh record has no address
+    return record if record % 7 else None
+
+
+def slow_expanded(record):
+    # workers finish out of order
+    time.sleep(random.random() * 0.001)
+    return record * 10
+
+
+class Formatter(object):
+    def rows(self, record):
+        return [record + 1]
+
+
+def run(stages, threaded=True, ordered=True):
+    sunk = []
+    progress = []
+    n = pipeline.Pipeline(range(RECORDS), stages, sunk.append, queue_size=8, ordered=ordered,
+                          threaded=threaded, progress=progress.append).run()
+    assert n == len(sunk)
+    return sunk, progress
+
+
+def expected():
+    return [i * 10 for i in range(RECORDS) if normalized(i) is not None]
+
+
+@pytest.mark.parametrize('threaded', [False, True])
+def test_ordered_drain_keeps_source_order(threaded):
+    stages = [pipeline.Stage(pipeline.NORMALIZE, normalized, workers=3),
+              pipeline.Stage(pipeline.EXPAND, slow_expanded, workers=4)]
+    sunk, progress = run(stages, threaded=threaded)
+
+    assert sunk == expected()
+    # dropped records count as handled
+    assert progress == list(range(1, RECORDS + 1))
+
+
+def test_unordered_drain_sinks_every_item():
+    stages = [pipeline.Stage(pipeline.NORMALIZE, normalized, workers=3),
+              pipeline.Stage(pipeline.EXPAND, slow_expanded, workers=4)]
+    sunk, progress = run(stages, ordered=False)
+    assert sorted(sunk) == expected()
+
+
+@pytest.mark.parametrize('threaded', [False, True])
+def test_iterator_stage_gets_dropped_items_as_none(threaded):
+    pool = ParallelFormatter(Formatter(), 'rows', batch_size=16)
+    stages = [pipeline.Stage(pipeline.NORMALIZE, normalized),
+              pipeline.IteratorStage(pipeline.FORMAT, pool.imap)]
+    sunk, progress = run(stages, threaded=threaded)
+    assert sunk == [[i + 1] for i in range(RECORDS) if normalized(i) is not None]
+
+
+def test_stage_error_is_raised_by_run():
+    def failing(record):
+        if record == 50:
+            raise ValueError(record)
+        return record
+
+    stages = [pipeline.Stage(pipeline.NORMALIZE, normalized, workers=2),
+              pipeline.Stage(pipeline.EXPAND, failing, workers=2)]
+    with pytest.raises(ValueError):
+        run(stages)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import os
+
+import pytest
+
+sinks = pytest.importorskip('geodata.train_ru.sinks')
+
+
+def address(i):
+    return u'{}/house_number улица/road Ленина/road'.format(i)
+
+
+def rows(n):
+    # formatted addresses come from tsv_string as UTF-8 bytes
+    return [[u'ru', u'ru', address(i).encode('utf-8')] for i in range(n)]
+
+
+def read_shard(path):
+    with gzip.open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('n, shard_rows', [(7, 3), (6, 3)])
+def test_manifest_lists_every_shard(tmpdir, n, shard_rows):
+    path = str(tmpdir.join('out.tsv'))
+    with sinks.ShardedSink(path, compression=sinks.GZIP, shard_rows=shard_rows, threads=2) as sink:
+        sink(rows(n))
+
+    with open(str(tmpdir.join('out.manifest.json'))) as f:
+        manifest = json.load(f)
+
+    shards = manifest['shards']
+    assert manifest['compression'] == sinks.GZIP
+    assert manifest['rows'] == n
+    assert [shard['path'] for shard in shards] == ['out.{:05d}.tsv.gz'.format(i + 1) for i in range(len(shards))]
+    assert [shard['rows'] for shard in shards] == [min(shard_rows, n - i) for i in range(0, n, shard_rows)]
+
+    lines = []
+    for shard in shards:
+        shard_path = str(tmpdir.join(shard['path']))
+        data = read_shard(shard_path)
+        shard_lines = data.decode('utf-8').splitlines()
+        assert len(shard_lines) == shard['rows']
+        assert shard['bytes'] == len(data)
+        assert shard['compressed_bytes'] == os.path.getsize(shard_path)
+        lines.extend(shard_lines)
+
+    assert lines == [u'ru\tru\t' + address(i) for i in range(n)]
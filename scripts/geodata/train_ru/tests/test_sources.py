@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import time
+
+import pytest
+
+sources = pytest.importorskip('geodata.train_ru.sources')
+
+
+def slow_source(name, n):
+    rnd = random.Random(name)
+    for i in range(n):
+        # the reader threads finish in no fixed order
+        time.sleep(rnd.random() * 0.0005)
+        yield (name, i)
+
+
+def failing_source():
+    yield ('failing', 0)
+    raise ValueError('unreadable input')
+
+
+def test_merged_order_is_round_robin_by_chunk():
+    merged = sources.MergedSources([slow_source('a', 7), slow_source('b', 2), slow_source('c', 5)],
+                                   chunk_size=3, buffer_chunks=1)
+    assert list(merged) == (
+        [('a', 0), ('a', 1), ('a', 2), ('b', 0), ('b', 1), ('c', 0), ('c', 1), ('c', 2)] +
+        [('a', 3), ('a', 4), ('a', 5), ('c', 3), ('c', 4)] +
+        [('a', 6)]
+    )
+
+
+def test_merged_raises_a_source_error():
+    merged = sources.MergedSources([slow_source('a', 10), failing_source()], chunk_size=2)
+    with pytest.raises(ValueError):
+        list(merged)
+
+
+def build(path, source_dir, name):
+    if name == 'broken':
+        raise ValueError(path)
+    with open(os.path.join(source_dir, 'out.tsv'), 'w') as f:
+        f.write(path)
+
+
+def test_run_per_source_reports_failed_sources(tmpdir):
+    paths = [str(tmpdir.join(name)) for name in ('north_western.osm', 'broken.osm.gz', 'siberian.osm')]
+    out_dir = str(tmpdir.join('out'))
+
+    with pytest.raises(sources.SourcesFailed) as error:
+        sources.run_per_source(build, paths, out_dir, processes=2)
+    assert 'broken.osm.gz' in str(error.value)
+
+    # the other sources are still built
+    assert tmpdir.join('out', 'north_western', 'out.tsv').read() == paths[0]
+    assert tmpdir.join('out', 'siberian', 'out.tsv').read() == paths[2]
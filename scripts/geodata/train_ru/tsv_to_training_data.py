@@ -3,11 +3,10 @@
 import argparse
 import os
 
-import csv
 import six
-import ftfy
 
 from collections import OrderedDict
+from functools import partial
 
 from geodata.address_formatting.formatter import AddressFormatter
 from geodata.openaddresses.formatter import OpenAddressesFormatter
@@ -18,13 +17,31 @@ from geodata.addresses.components import AddressComponents
 
 from geodata.encoding import safe_decode
 from geodata.countries.constants import Countries
-from geodata.csv_utils import tsv_string, unicode_csv_reader
+from geodata.csv_utils import tsv_string
 
 from geodata.i18n.languages import get_country_languages
 
+from geodata.train_ru import checkpoint, column_batches, component_store, dedup, incremental, instrumentation, metrics, parallel, pipeline, sampling, sinks, sources, startup
+from geodata.train_ru.cache import LRUCache
+from geodata.train_ru.column_batches import ColumnBatch, batched
+from geodata.train_ru.compat import tsv_reader
+from geodata.train_ru.component_encodings import fix_component_encoding, fix_component_encodings
+from geodata.train_ru.component_store import ComponentStoreReader, ComponentStoreWriter
+from geodata.train_ru.format_cache import formatter_method_cache
+from geodata.train_ru.gazetteer_cache import cached_gazetteer
+from geodata.train_ru.incremental import IncrementalRows, formatter_fingerprint
+from geodata.train_ru.instrumentation import NullProfiler
+from geodata.train_ru.pipeline import IteratorStage, Pipeline, Stage, formatting_stages
+from geodata.train_ru.records import Interner, Record
+from geodata.train_ru.sampling import StratifiedSampler, field_getter
+from geodata.train_ru.sinks import open_sink
+from geodata.train_ru.startup import lazy_state
+
 FORMAT_DATA_TAGGED_FILENAME = "_formatted_addresses_tagged.tsv"
 FORMAT_DATA_FILENAME = "_formatted_addresses.tsv"
 
+STREET_CACHE_SIZE = 100000
+
 class HealthcareLicensesRUFormatter(object):
     field_map = OrderedDict([
         ('index', AddressFormatter.POSTCODE),
@@ -43,8 +60,34 @@ class HealthcareLicensesRUFormatter(object):
         u'город'
     ]
 
-    def __init__(self):
-        self.formatter = AddressFormatter(scratch_dir=os.environ['TEMP'])
+    # the same few values repeat on most rows
+    interned_components = (
+        AddressFormatter.STATE,
+        AddressFormatter.STATE_DISTRICT,
+        AddressFormatter.CITY,
+        AddressFormatter.CITY_DISTRICT,
+    )
+
+    # dicts by default, use_records fills slotted RowComponents (--records)
+    use_records = False
+
+    # built on first use, or loaded from a startup snapshot
+    snapshot_state = ('formatter',)
+
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+        if snapshot:
+            startup.restore_snapshot(self, snapshot, self.snapshot_state)
+        self.street_types_gazetteer = cached_gazetteer(street_types_gazetteer, 'street_types')
+        self.toponym_gazetteer = cached_gazetteer(toponym_abbreviations_gazetteer, 'toponym_abbreviations')
+        self.interners = {key: Interner() for key in self.interned_components}
+        self.cleaned_streets = LRUCache(STREET_CACHE_SIZE)
+
+    @lazy_state
+    def formatter(self):
+        formatter = AddressFormatter(scratch_dir=os.environ['TEMP'])
+        formatter_method_cache(formatter, 'tsv')
+        return formatter
 
     component_validators = {
         AddressFormatter.HOUSE_NUMBER: OpenAddressesFormatter.validators.validate_house_number,
@@ -57,6 +100,13 @@ class HealthcareLicensesRUFormatter(object):
     drop_address_probability = 0.6
     drop_address_and_postcode_probability = 0.1
 
+    # steps timed by --profile
+    profiled_steps = (
+        'row_components',
+        'fix_component_encodings',
+        'formatted_expanded_addresses',
+    )
+
     @classmethod
     def cleanup_number(cls, num, strip_commas=False):
         num = num.strip()
@@ -81,140 +131,205 @@ class HealthcareLicensesRUFormatter(object):
         return num
 
     def fix_component_encodings(self, components):
-        return {k: ftfy.fix_encoding(safe_decode(v)) for k, v in six.iteritems(components)}
+        return fix_component_encodings(components)
+
+    def cleaned_value(self, key, value):
+        '''
+        Cleaned value of a cell of component key, None if it is empty, a
+        placeholder or not valid
+        '''
+        if not value:
+            return None
+        value = value.strip()
+        if not value:
+            return None
+
+        if not_applicable_regex.match(value) or null_regex.match(value) or unknown_regex.match(value):
+            return None
+
+        value = value.strip(', -')
+
+        validator = self.component_validators.get(key, None)
+
+        if validator is not None and not validator(value):
+            return None
+
+        return value or None
+
+    def row_components(self, row, header_indices):
+        components = RowComponents() if self.use_records else {}
+
+        for i, key in six.iteritems(header_indices):
+            value = self.cleaned_value(key, row[i])
+            if value:
+                intern = self.interners.get(key)
+                components[key] = intern(value) if intern is not None else value
+
+        return components
+
+    def normalized_components(self, row, header_indices):
+        components = self.row_components(row, header_indices)
+        if not components:
+            return None
+
+        # remove unit
+        # components.pop(AddressFormatter.UNIT)
+
+        return self.fix_component_encodings(components)
+
+    def normalized_value(self, key, value):
+        value = self.cleaned_value(key, value)
+        if value is None:
+            return None
+        return fix_component_encoding(value, key)
+
+    def normalized_batch(self, rows, header_indices):
+        '''
+        normalized_components of a list of rows, with every distinct value of
+        a column cleaned once, see geodata.train_ru.column_batches
+        '''
+        batch = ColumnBatch(rows, header_indices)
+        columns = [(key, batch.mapped(i, partial(self.normalized_value, key)))
+                   for i, key in six.iteritems(header_indices)]
+
+        results = []
+        for j in range(batch.size):
+            components = RowComponents() if self.use_records else {}
+            for key, values in columns:
+                value = values[j]
+                if value:
+                    components[key] = value
+            results.append(components if components else None)
+        return results
+
+    def cleaned_street(self, street):
+        '''
+        The street name as cleaned by AddressComponents, None if it is not
+        valid. Both steps are deterministic, so results are memoized.
+        '''
+        cleaned = self.cleaned_streets.get(street)
+        if cleaned is None:
+            cleaned = AddressComponents.cleaned_name(street.strip())
+            if not AddressComponents.street_name_is_valid(cleaned):
+                cleaned = u''
+            self.cleaned_streets.set(street, cleaned)
+        return cleaned or None
+
+    def expanded_components(self, components):
+        if isinstance(components, Record):
+            # AddressComponents copies and extends plain dicts from here on
+            components = components.as_dict()
 
-    def formatted_addresses(self, path, tag_components=True):
         country = Countries.RUSSIA
-        candidate_languages = get_country_languages(country).items()
-
-        f = open(path)
-        if not f:
-            print("Input file not found")
-            return
+        candidate_languages = list(get_country_languages(country).items())
 
-        reader = unicode_csv_reader(f, dialect='tsv_no_quote')
-        headers = reader.next()
+        language = AddressComponents.address_language(components, candidate_languages)
 
-        header_indices = {i: self.field_map[k] for i, k in enumerate(headers) if k in self.field_map}
-
-        no_city = 0
-
-        for row in reader:
-            components = {}
+        street = components.get(AddressFormatter.ROAD, None)
+        if street is not None:
+            street = self.cleaned_street(street)
+            if street is not None:
+                street = self.street_types_gazetteer.abbreviate(street, language)
+                components[AddressFormatter.ROAD] = street
+            else:
+                components.pop(AddressFormatter.ROAD)
 
-            for i, key in six.iteritems(header_indices):
-                value = row[i]
-                if not value:
-                    continue
-                value = row[i].strip()
-                if not value:
-                    continue
+        house_number = components.get(AddressFormatter.HOUSE_NUMBER, None)
+        if house_number:
+            house_number = self.cleanup_number(house_number, strip_commas=True)
 
-                if not_applicable_regex.match(value) or null_regex.match(value) or unknown_regex.match(value):
-                    continue
+            if house_number is not None:
+                components[AddressFormatter.HOUSE_NUMBER] = house_number
 
-                value = value.strip(', -')
+        postcode = components.get(AddressFormatter.POSTCODE, None)
 
-                validator = self.component_validators.get(key, None)
+        # If there's a postcode, we can still use just the city/state/postcode, otherwise discard
+        if not street or (street and house_number and (street.lower() == house_number.lower())):
+            if not postcode:
+                return None
+            components = AddressComponents.drop_address(components)
 
-                if validator is not None and not validator(value):
-                    continue
+        country_name = AddressComponents.cldr_country_name(country, language)
+        if country_name:
+            components[AddressFormatter.COUNTRY] = country_name
 
-                if value:
-                    components[key] = value
+        for component_key in AddressFormatter.BOUNDARY_COMPONENTS:
+            component = components.get(component_key, None)
+            if component is not None:
+                component = self.toponym_gazetteer.abbreviate(component, language)
+                component = AddressComponents.name_hyphens(component)
+                components[component_key] = component
 
-            if components:
-                # remove unit
-                # components.pop(AddressFormatter.UNIT)
+        AddressComponents.replace_names(components)
 
-                components = self.fix_component_encodings(components)
+        AddressComponents.prune_duplicate_names(components)
 
-                language = AddressComponents.address_language(components, candidate_languages)
+        AddressComponents.remove_numeric_boundary_names(components)
+        AddressComponents.add_house_number_phrase(components, language, country=country)
 
-                street = components.get(AddressFormatter.ROAD, None)
-                if street is not None:
-                    street = street.strip()
-                    street = AddressComponents.cleaned_name(street)
-                    if AddressComponents.street_name_is_valid(street):
-                        street = abbreviate(street_types_gazetteer, street, language)
-                        components[AddressFormatter.ROAD] = street
-                    else:
-                        components.pop(AddressFormatter.ROAD)
-                        street = None
+        # Component dropout
+        components = place_config.dropout_components(components, country=country)
 
-                house_number = components.get(AddressFormatter.HOUSE_NUMBER, None)
-                if house_number:
-                    house_number = self.cleanup_number(house_number, strip_commas=True)
+        return components, language, street, house_number
 
-                    if house_number is not None:
-                        components[AddressFormatter.HOUSE_NUMBER] = house_number
-
-                postcode = components.get(AddressFormatter.POSTCODE, None)
+    def formatted_expanded_addresses(self, expanded, tag_components=True):
+        components, language, street, house_number = expanded
+        country = Countries.RUSSIA
 
-                # If there's a postcode, we can still use just the city/state/postcode, otherwise discard
-                if not street or (street and house_number and (street.lower() == house_number.lower())):
-                    if not postcode:
-                        continue
-                    components = AddressComponents.drop_address(components)
+        addresses = []
 
-                country_name = AddressComponents.cldr_country_name(country, language)
-                if country_name:
-                    components[AddressFormatter.COUNTRY] = country_name
+        formatted = self.formatter.format_address(components, country, language=language,
+                                    minimal_only=False, tag_components=tag_components)
 
-                for component_key in AddressFormatter.BOUNDARY_COMPONENTS:
-                    component = components.get(component_key, None)
-                    if component is not None:
-                        component = abbreviate(toponym_abbreviations_gazetteer, component, language)
-                        component = AddressComponents.name_hyphens(component)
-                        components[component_key] = component
+        addresses.append((language, country, formatted))
 
-                AddressComponents.replace_names(components)
+        if random.random() < self.address_only_probability and street:
+            address_only_components = AddressComponents.drop_places(components)
+            address_only_components = AddressComponents.drop_postcode(address_only_components)
+            formatted = self.formatter.format_address(address_only_components, country, language=language,
+                                                      minimal_only=False, tag_components=tag_components)
+            addresses.append((language, country, formatted))
 
-                AddressComponents.prune_duplicate_names(components)
+        rand_val = random.random()
 
-                AddressComponents.remove_numeric_boundary_names(components)
-                AddressComponents.add_house_number_phrase(components, language, country=country)
+        if street and house_number and rand_val < self.drop_address_probability:
+            components = AddressComponents.drop_address(components)
 
-                # Component dropout
-                components = place_config.dropout_components(components, country=country)
+            if rand_val < self.drop_address_and_postcode_probability:
+                components = AddressComponents.drop_postcode(components)
 
+            if components and (len(components) > 1):
                 formatted = self.formatter.format_address(components, country, language=language,
-                                            minimal_only=False, tag_components=tag_components)
+                                                          minimal_only=False, tag_components=tag_components)
+                addresses.append((language, country, formatted))
 
-                yield (language, country, formatted)
+        return addresses
 
-                if random.random() < self.address_only_probability and street:
-                    address_only_components = AddressComponents.drop_places(components)
-                    address_only_components = AddressComponents.drop_postcode(address_only_components)
-                    formatted = self.formatter.format_address(address_only_components, country, language=language,
-                                                              minimal_only=False, tag_components=tag_components)
-                    yield (language, country, formatted)
+    def formatted_row_addresses(self, row, header_indices, tag_components=True):
+        components = self.normalized_components(row, header_indices)
+        if components is None:
+            return []
 
-                rand_val = random.random()
+        expanded = self.expanded_components(components)
+        if expanded is None:
+            return []
 
-                if street and house_number and rand_val < self.drop_address_probability:
-                    components = AddressComponents.drop_address(components)
+        return self.formatted_expanded_addresses(expanded, tag_components=tag_components)
 
-                    if rand_val < self.drop_address_and_postcode_probability:
-                        components = AddressComponents.drop_postcode(components)
+    def normalized_rows(self, components, tag_components=True):
+        expanded = self.expanded_components(components)
+        if expanded is None:
+            return []
+        return self.expanded_rows(expanded, tag_components=tag_components)
 
-                    if components and (len(components) > 1):
-                        formatted = self.formatter.format_address(components, country, language=language,
-                                                                  minimal_only=False, tag_components=tag_components)
-                        yield (language, country, formatted)
+    def expanded_rows(self, expanded, tag_components=True):
+        addresses = self.formatted_expanded_addresses(expanded, tag_components=tag_components)
+        return self.address_rows(addresses, tag_components=tag_components)
 
+    def address_rows(self, addresses, tag_components=True):
+        rows = []
 
-    def build_training_data(self, infile, out_dir, tag_components=True):
-        if tag_components:
-            formatted_tagged_file = open(os.path.join(out_dir, FORMAT_DATA_TAGGED_FILENAME), 'wb')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
-        else:
-            formatted_tagged_file = open(os.path.join(out_dir, FORMAT_DATA_FILENAME), 'wb')
-            writer = csv.writer(formatted_tagged_file, 'tsv_no_quote')
-
-        i = 0
-
-        for language, country, formatted_address in self.formatted_addresses(infile, tag_components=tag_components):
+        for language, country, formatted_address in addresses:
             if not formatted_address or not formatted_address.strip():
                 continue
 
@@ -223,19 +338,214 @@ class HealthcareLicensesRUFormatter(object):
                 continue
 
             if tag_components:
-                row = (language, country, formatted_address)
+                rows.append((language, country, formatted_address))
             else:
-                row = (formatted_address,)
+                rows.append((formatted_address,))
 
-            writer.writerow(row)
-            i += 1
-            if i % 1000 == 0 and i > 0:
-                formatted_tagged_file.flush()
-                print('did {} formatted addresses'.format(i))
+        return rows
+
+    def open_reader(self, path):
+        f = sources.open_text(path)
+        if not f:
+            print("Input file not found")
+            return None, None
+
+        reader = tsv_reader(f)
+        headers = next(reader)
+
+        header_indices = {i: self.field_map[k] for i, k in enumerate(headers) if k in self.field_map}
+        return reader, header_indices
+
+    def open_sources(self, paths):
+        '''
+        Merged reader of the rows of every path and their header indices, the
+        files must have the same columns
+        '''
+        readers = []
+        header_indices = None
+        for path in paths:
+            reader, indices = self.open_reader(path)
+            if reader is None:
+                return None, None
+            if header_indices is not None and indices != header_indices:
+                raise ValueError('{} does not have the columns of {}'.format(path, paths[0]))
+            header_indices = indices
+            readers.append(reader)
+        return sources.merged(readers), header_indices
+
+    def state_index(self, header_indices):
+        for i, key in six.iteritems(header_indices):
+            if key == AddressFormatter.STATE:
+                return i
+        return None
+
+    def formatted_addresses(self, path, tag_components=True):
+        reader, header_indices = self.open_reader(path)
+        if reader is None:
+            return
+
+        for row in reader:
+            for address in self.formatted_row_addresses(row, header_indices, tag_components=tag_components):
+                yield address
+
+    def instrument(self, profiler):
+        profiler.instrument(self, self.profiled_steps)
+        profiler.instrument(self.formatter, ('format_address',), prefix='formatter.')
+
+    def build_component_store(self, infile, store_path, threaded=False,
+                              queue_size=pipeline.DEFAULT_QUEUE_SIZE, stage_workers=None,
+                              read_ahead=pipeline.DEFAULT_READ_AHEAD):
+        paths = sources.input_paths(infile)
+        reader, header_indices = self.open_sources(paths)
+        if reader is None:
+            return
+        reader = pipeline.read_ahead(reader, read_ahead)
+
+        stage_workers = stage_workers or {}
+        stages = [Stage(pipeline.NORMALIZE, partial(self.normalized_components, header_indices=header_indices),
+                        workers=stage_workers.get(pipeline.NORMALIZE))]
+
+        with ComponentStoreWriter(store_path, self.field_map.values(), metadata={'source': sources.input_key(paths)}) as store:
+            Pipeline(reader, stages, store, queue_size=queue_size, threaded=threaded).run()
+
+        print('wrote {} records to {}'.format(store.count, store_path))
+
+    def build_training_data(self, infile, out_dir, tag_components=True, workers=1,
+                            batch_size=parallel.DEFAULT_BATCH_SIZE, ordered=False, seed=None,
+                            threaded=False, queue_size=pipeline.DEFAULT_QUEUE_SIZE, stage_workers=None,
+                            from_store=None, profiler=None, checkpoint_every=None, resume=False,
+                            incremental_store=None, sink_options=None, dedup_options=None,
+                            read_ahead=pipeline.DEFAULT_READ_AHEAD, sample_options=None, metrics_options=None,
+                            column_batch=column_batches.DEFAULT_COLUMN_BATCH):
+        '''
+        column_batch > 0 normalizes that many rows at a time, cleaning every
+        distinct value of a column once. The normalize stage then runs on one
+        thread. With worker processes or a seed every batch sent to a worker is
+        normalized as one column batch in that worker.
+
+        infile is a TSV file or a list of them, also compressed ones, merged
+        into one output.
+        '''
+        paths = sources.input_paths(infile)
+        if from_store:
+            records = ComponentStoreReader(from_store)
+            header_indices = None
+            state_key = field_getter(AddressFormatter.STATE)
+        else:
+            records, header_indices = self.open_sources(paths)
+            if records is None:
+                return
+            state_key = field_getter(self.state_index(header_indices))
+
+        monitor = metrics.create_metrics('tsv', from_store or paths, metrics_options)
+        records = monitor.counted(records)
+
+        sampler = StratifiedSampler(state_key, **sample_options) if sample_options else None
+        if sampler is not None:
+            records = sampler(records)
+
+        if dedup_options and (checkpoint_every or resume):
+            raise ValueError('Deduplicated output cannot be checkpointed')
+        pipeline.check_formatting_workers(stage_workers)
+
+        if tag_components:
+            out_path = os.path.join(out_dir, FORMAT_DATA_TAGGED_FILENAME)
+        else:
+            out_path = os.path.join(out_dir, FORMAT_DATA_FILENAME)
+        sink = open_sink(out_path, append=resume, **(sink_options or {}))
+
+        # rows already written for an earlier record are dropped before the sink
+        deduplicator = dedup.open_deduplicator(out_path, **dedup_options) if dedup_options else None
+
+        def write_rows(rows):
+            if deduplicator is not None:
+                rows = deduplicator(rows)
+            monitor.sunk(len(rows))
+            for row in rows:
+                sink.writerow(row)
+                i = sink.rows
+                if i % 1000 == 0 and i > 0:
+                    sink.flush()
+
+        checkpointer, skip = checkpoint.resumable(sink, checkpoint=bool(checkpoint_every), resume=resume,
+                                                  every=checkpoint_every or checkpoint.DEFAULT_CHECKPOINT_INTERVAL,
+                                                  params={'input': from_store or sources.input_key(paths), 'seed': seed,
+                                                          'batch_size': batch_size, 'tag_components': tag_components,
+                                                          'sample': sample_options},
+                                                  batch_size=batch_size if seed is not None else None)
+        if checkpointer is not None:
+            # checkpoints need every record before the saved position to be written
+            ordered = True
+            records = checkpoint.skip_records(records, skip)
+        records = pipeline.read_ahead(records, read_ahead)
+
+        profiler = profiler or NullProfiler()
+        self.instrument(profiler)
+        # worker processes normalize the raw rows on their own instances, a
+        # column batch at a time
+        if header_indices is None:
+            normalize = pooled_normalize = None
+        elif column_batch:
+            normalize = IteratorStage(pipeline.NORMALIZE,
+                                      partial(batched, profiler.wrap(pipeline.NORMALIZE,
+                                                                     partial(self.normalized_batch, header_indices=header_indices),
+                                                                     memory=True),
+                                              size=column_batch))
+            pooled_normalize = parallel.WorkerMethod('normalized_batch', batches=True, header_indices=header_indices)
+        else:
+            normalize = profiler.wrap(pipeline.NORMALIZE, partial(self.normalized_components, header_indices=header_indices),
+                                      memory=True)
+            pooled_normalize = parallel.WorkerMethod('normalized_components', header_indices=header_indices)
+
+        if incremental_store:
+            # unchanged records reuse their stored rows, new ones are formatted
+            # in this process with the RNG seeded per record
+            stored_rows = IncrementalRows(incremental_store, partial(self.normalized_rows, tag_components=tag_components),
+                                          formatter_fingerprint(self, seed=seed, tag_components=tag_components))
+            stages = [pipeline.normalize_stage(normalize, stage_workers)] if normalize else []
+            stages.append(Stage(pipeline.FORMAT, profiler.wrap(pipeline.FORMAT, stored_rows, memory=True)))
+        else:
+            stored_rows = None
+            stages = formatting_stages(self, normalize,
+                                       profiler.wrap(pipeline.EXPAND, self.expanded_components, memory=True),
+                                       profiler.wrap(pipeline.FORMAT, self.expanded_rows, memory=True),
+                                       'normalized_rows', stage_workers=stage_workers, workers=workers,
+                                       batch_size=batch_size, ordered=ordered, seed=seed, start_batch=skip // batch_size,
+                                       pooled_normalize=pooled_normalize, tag_components=tag_components)
+
+        completed = False
+        profiler.start()
+        try:
+            with sink:
+                p = Pipeline(records, stages, profiler.wrap(pipeline.SINK, write_rows, memory=True),
+                             queue_size=queue_size, ordered=ordered, threaded=threaded, progress=checkpointer)
+                monitor.attach(p)
+                p.run()
+            completed = True
+        finally:
+            profiler.stop()
+            monitor.close()
+            if stored_rows is not None:
+                # a resumed run has not seen the skipped records, so it cannot tell what was deleted
+                stored_rows.close(purge=completed and not skip)
+                print('incremental: {reused} records reused, {formatted} formatted, {deleted} deleted'.format(**stored_rows.stats()))
+            if deduplicator is not None:
+                deduplicator.close()
+                deduplicator.report()
+
+        if sampler is not None:
+            sampler.report()
+
+        if checkpointer is not None:
+            checkpointer.finish()
 
         print("KONEC")
 
 
+class RowComponents(Record):
+    fields = HealthcareLicensesRUFormatter.field_map.values()
+
+
 if __name__ == '__main__':
     # Handle argument parsing here
     parser = argparse.ArgumentParser()
@@ -259,10 +569,59 @@ if __name__ == '__main__':
                         default=os.getcwd(),
                         help='Output directory')
 
+    parser.add_argument('--records',
+                        action='store_true',
+                        default=False,
+                        help='Carry components as slotted records instead of dicts (less memory, slower)')
+
+    parallel.add_arguments(parser)
+    pipeline.add_arguments(parser)
+    component_store.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    checkpoint.add_arguments(parser)
+    incremental.add_arguments(parser)
+    sinks.add_arguments(parser)
+    startup.add_arguments(parser)
+    dedup.add_arguments(parser)
+    sampling.add_arguments(parser)
+    metrics.add_arguments(parser)
+    column_batches.add_arguments(parser)
+    sources.add_arguments(parser)
+
     args = parser.parse_args()
+    sources.check_arguments(parser, args)
+
+    inputs = sources.input_paths(args.tsv_ru_file, args.sources)
 
-    if args.tsv_ru_file and args.format:
+    def build(infile, out_dir, source=None):
+        hl_formatter = HealthcareLicensesRUFormatter(snapshot=args.snapshot)
+        hl_formatter.use_records = args.records
+        profiler = instrumentation.create_profiler(args.profile, trace_memory=args.profile_memory)
+        try:
+            hl_formatter.build_training_data(infile, out_dir, tag_components=not args.untagged,
+                                             workers=args.workers, batch_size=args.batch_size,
+                                             ordered=args.ordered, seed=args.seed, threaded=args.pipeline,
+                                             queue_size=args.queue_size, stage_workers=args.stage_workers,
+                                             from_store=args.from_store, profiler=profiler,
+                                             checkpoint_every=checkpoint.checkpoint_every(args),
+                                             resume=args.resume, incremental_store=args.incremental,
+                                             sink_options=sinks.sink_options(args),
+                                             dedup_options=dedup.dedup_options(args), read_ahead=args.read_ahead,
+                                             sample_options=sampling.sample_options(args),
+                                             metrics_options=metrics.metrics_options(args, source=source),
+                                             column_batch=args.column_batch)
+        finally:
+            profiler.write_report(instrumentation.report_path(args, out_dir, source=source))
+
+    if inputs and args.ingest:
         hl_formatter = HealthcareLicensesRUFormatter()
-        hl_formatter.build_training_data(args.tsv_ru_file, args.out_dir, tag_components=not args.untagged)
+        hl_formatter.use_records = args.records
+        hl_formatter.build_component_store(inputs, args.ingest, threaded=args.pipeline,
+                                           queue_size=args.queue_size, stage_workers=args.stage_workers,
+                                           read_ahead=args.read_ahead)
+    elif inputs and args.format and args.per_source:
+        sources.run_per_source(build, inputs, args.out_dir, processes=args.source_processes)
+    elif (inputs or args.from_store) and args.format:
+        build(inputs, args.out_dir)
     else:
         print(parser.format_usage())
\ No newline at end of file